@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+########################################################################
+# bench_mssql.py
+# Licence : GPL - http://www.fsf.org/licenses/gpl.txt
+#
+# Offline benchmark of every mode of check_mssql_server.py and
+# check_mssql_database.py against the fake pymssql in bench/fake.
+# Each case runs in its own forked process and reports wall time,
+# connections and queries made, and the peak memory the check added.
+#
+# usage: bench/bench_mssql.py --databases 1,100,1000,5000 --query-latency 0.002
+########################################################################
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import resource
+try:
+    import json
+except ImportError:
+    import simplejson as json
+from optparse import OptionParser
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, os.path.join(BENCH_DIR, 'fake'))
+
+import pymssql
+import mssql_state
+from mssql_snapshot import COUNTER_QUERY_RE
+import check_mssql_server
+import check_mssql_database
+
+PLUGINS = [
+    ('server', check_mssql_server),
+    ('database', check_mssql_database),
+]
+
+SKIPPED_MODES = ['test']
+
+HEADER = '%-9s %-18s %9s %10s %6s %8s %10s %5s' % ('plugin', 'mode', 'databases', 'wall_ms', 'conns', 'queries', 'peak_kb', 'code')
+ROW = '%-9s %-18s %9d %10.2f %6d %8d %10d %5s'
+
+def make_cases(plugin_name, plugin):
+    base = ['-H', 'bench', '-U', 'bench', '-P', 'bench']
+    modes = sorted([mode for mode in plugin.MODES if mode not in SKIPPED_MODES])
+    cases = [(mode, base + ['--%s' % mode]) for mode in modes]
+    multi = []
+    for mode in modes:
+        if COUNTER_QUERY_RE.match(plugin.MODES[mode].get('query', '')):
+            multi += ['--multi', mode]
+    cases.append(('multi', base + multi))
+    return cases
+
+def run_case(plugin, args, repeat):
+    #~ Runs in the forked child, delta modes get a first run to seed their state
+    options = plugin.parse_args(args)
+    samples = []
+    code = None
+    for i in range(repeat + 1):
+        pymssql.reset_stats()
+        start = time.time()
+        try:
+            mssql, total, host = plugin.connect_db(options)
+            plugin.run_check(mssql, options, host, total)
+        except plugin.NagiosReturn, e:
+            code = e.code
+        samples.append((time.time() - start, pymssql.STATS['connections'], pymssql.STATS['queries']))
+    samples = samples[1:]
+    return { 'wall'        : min([sample[0] for sample in samples]),
+             'connections' : samples[-1][1],
+             'queries'     : samples[-1][2],
+             'code'        : code }
+
+def fork_case(plugin, args, repeat):
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_end)
+        try:
+            #~ Build the fake catalog first so only the check counts towards peak memory
+            pymssql.performance_counters()
+            before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            result = run_case(plugin, args, repeat)
+            result['peak'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+        except Exception, e:
+            result = { 'error' : '%s: %s' % (type(e).__name__, e) }
+        os.write(write_end, json.dumps(result))
+        os._exit(0)
+    os.close(write_end)
+    output = ''
+    while True:
+        chunk = os.read(read_end, 65536)
+        if not chunk:
+            break
+        output += chunk
+    os.close(read_end)
+    os.waitpid(pid, 0)
+    return json.loads(output)
+
+def parse_args():
+    usage = "usage: %prog [--databases 1,100,1000,5000]"
+    parser = OptionParser(usage=usage)
+    parser.add_option('--databases', help='Comma separated database counts to benchmark', default='1,100,1000,5000')
+    parser.add_option('--connect-latency', type='float', help='Seconds added to every connect', default=0)
+    parser.add_option('--query-latency', type='float', help='Seconds added to every query', default=0)
+    parser.add_option('--repeat', type='int', help='Timed runs per case, the fastest is reported', default=3)
+    parser.add_option('--plugin', help='Only benchmark this plugin: server or database', default=None)
+    parser.add_option('--mode', action='append', help='Only benchmark this mode, may be given several times', default=None)
+    options, _ = parser.parse_args()
+    try:
+        options.databases = [int(x) for x in options.databases.split(',')]
+    except ValueError:
+        parser.error('Databases must be a comma separated list of numbers.')
+    if options.repeat < 1:
+        parser.error('Repeat must be at least 1.')
+    return options
+
+def main():
+    options = parse_args()
+    mssql_state.STATE_DIR = tempfile.mkdtemp(prefix='mssql-bench-')
+    try:
+        print HEADER
+        for databases in options.databases:
+            pymssql.configure(databases=databases,
+                              connect_latency=options.connect_latency,
+                              query_latency=options.query_latency)
+            for plugin_name, plugin in PLUGINS:
+                if options.plugin and options.plugin != plugin_name:
+                    continue
+                for mode, args in make_cases(plugin_name, plugin):
+                    if options.mode and mode not in options.mode:
+                        continue
+                    result = fork_case(plugin, args, options.repeat)
+                    if 'error' in result:
+                        print '%-9s %-18s %9d failed with %s' % (plugin_name, mode, databases, result['error'])
+                        continue
+                    print ROW % (plugin_name, mode, databases, result['wall'] * 1000,
+                                 result['connections'], result['queries'], result['peak'], result['code'])
+                    sys.stdout.flush()
+    finally:
+        shutil.rmtree(mssql_state.STATE_DIR, True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,398 @@
+########################################################################
+# Fake pymssql for offline benchmarking of check_mssql_collection
+# Licence : GPL - http://www.fsf.org/licenses/gpl.txt
+#
+# Serves a synthetic sys.dm_os_performance_counters, sys.sysdatabases,
+# sys.dm_os_wait_stats, sys.dm_io_virtual_file_stats and
+# sys.dm_exec_query_stats for a configurable number of databases, with
+# injected connect and query latency, and counts connections and queries.
+# Rows are produced as the cursor fetches them, so large results are
+# streamed the way the real driver streams them. Put this directory
+# first on the path to use it in place of the real module:
+#
+#   PYTHONPATH=bench/fake ./check_mssql_database.py -H bench -U u -P p --logfileusage
+#
+# Configured with configure() or the environment:
+#   FAKE_PYMSSQL_DATABASES        number of user databases (default 10)
+#   FAKE_PYMSSQL_CONNECT_LATENCY  seconds added to every connect()
+#   FAKE_PYMSSQL_QUERY_LATENCY    seconds added to every execute()
+#   FAKE_PYMSSQL_DOWN_HOSTS       comma separated hosts whose logins fail
+#   FAKE_PYMSSQL_QUERY_STATS      rows in sys.dm_exec_query_stats (default 2000)
+########################################################################
+
+import os
+import re
+import time
+import zlib
+import struct
+import threading
+from itertools import chain, islice
+
+class Error(Exception):
+    pass
+
+class InterfaceError(Error):
+    pass
+
+class DatabaseError(Error):
+    pass
+
+class OperationalError(DatabaseError):
+    pass
+
+PERF_COUNTER_LARGE_RAWCOUNT = 65792
+PERF_COUNTER_BULK_COUNT     = 272696576
+PERF_LARGE_RAW_FRACTION     = 537003264
+PERF_AVERAGE_BULK           = 1073874176
+PERF_LARGE_RAW_BASE         = 1073939712
+
+SYSTEM_DATABASES = ['master', 'tempdb', 'model', 'msdb']
+
+#~ (object, counter, cntr_type, instances) where instances is a list or 'databases'
+SERVER_COUNTERS = [
+    ('Buffer Manager', 'Buffer cache hit ratio', PERF_LARGE_RAW_FRACTION, ['']),
+    ('Buffer Manager', 'Buffer cache hit ratio base', PERF_LARGE_RAW_BASE, ['']),
+    ('Buffer Manager', 'Page lookups/sec', PERF_COUNTER_BULK_COUNT, ['']),
+    ('Buffer Manager', 'Free pages', PERF_COUNTER_LARGE_RAWCOUNT, ['']),
+    ('Buffer Manager', 'Total pages', PERF_COUNTER_LARGE_RAWCOUNT, ['']),
+    ('Buffer Manager', 'Target pages', PERF_COUNTER_LARGE_RAWCOUNT, ['']),
+    ('Buffer Manager', 'Database pages', PERF_COUNTER_LARGE_RAWCOUNT, ['']),
+    ('Buffer Manager', 'Stolen pages', PERF_COUNTER_LARGE_RAWCOUNT, ['']),
+    ('Buffer Manager', 'Lazy writes/sec', PERF_COUNTER_BULK_COUNT, ['']),
+    ('Buffer Manager', 'Readahead pages/sec', PERF_COUNTER_BULK_COUNT, ['']),
+    ('Buffer Manager', 'Page reads/sec', PERF_COUNTER_BULK_COUNT, ['']),
+    ('Buffer Manager', 'Checkpoint pages/sec', PERF_COUNTER_BULK_COUNT, ['']),
+    ('Buffer Manager', 'Page writes/sec', PERF_COUNTER_BULK_COUNT, ['']),
+    ('Buffer Manager', 'Page life expectancy', PERF_COUNTER_LARGE_RAWCOUNT, ['']),
+    ('Buffer Node', 'Page life expectancy', PERF_COUNTER_LARGE_RAWCOUNT, ['000']),
+    ('Locks', 'Lock Requests/sec', PERF_COUNTER_BULK_COUNT, ['_Total', 'Database', 'Object', 'Page', 'Key']),
+    ('Locks', 'Lock Timeouts/sec', PERF_COUNTER_BULK_COUNT, ['_Total', 'Database', 'Object', 'Page', 'Key']),
+    ('Locks', 'Number of Deadlocks/sec', PERF_COUNTER_BULK_COUNT, ['_Total', 'Database', 'Object', 'Page', 'Key']),
+    ('Locks', 'Lock Waits/sec', PERF_COUNTER_BULK_COUNT, ['_Total', 'Database', 'Object', 'Page', 'Key']),
+    ('Locks', 'Lock Wait Time (ms)', PERF_COUNTER_BULK_COUNT, ['_Total', 'Database', 'Object', 'Page', 'Key']),
+    ('Locks', 'Average Wait Time (ms)', PERF_AVERAGE_BULK, ['_Total', 'Database', 'Object', 'Page', 'Key']),
+    ('Locks', 'Average Wait Time Base', PERF_LARGE_RAW_BASE, ['_Total', 'Database', 'Object', 'Page', 'Key']),
+    ('Access Methods', 'Page Splits/sec', PERF_COUNTER_BULK_COUNT, ['']),
+    ('Access Methods', 'Full Scans/sec', PERF_COUNTER_BULK_COUNT, ['']),
+    ('Plan Cache', 'Cache Hit Ratio', PERF_LARGE_RAW_FRACTION, ['_Total', 'SQL Plans', 'Object Plans']),
+    ('Plan Cache', 'Cache Hit Ratio Base', PERF_LARGE_RAW_BASE, ['_Total', 'SQL Plans', 'Object Plans']),
+    ('SQL Statistics', 'Batch Requests/sec', PERF_COUNTER_BULK_COUNT, ['']),
+    ('SQL Statistics', 'SQL Compilations/sec', PERF_COUNTER_BULK_COUNT, ['']),
+    ('Databases', 'Log Cache Hit Ratio', PERF_LARGE_RAW_FRACTION, 'databases'),
+    ('Databases', 'Log Cache Hit Ratio Base', PERF_LARGE_RAW_BASE, 'databases'),
+    ('Databases', 'Active Transactions', PERF_COUNTER_LARGE_RAWCOUNT, 'databases'),
+    ('Databases', 'Log Flushes/sec', PERF_COUNTER_BULK_COUNT, 'databases'),
+    ('Databases', 'Percent Log Used', PERF_COUNTER_LARGE_RAWCOUNT, 'databases'),
+    ('Databases', 'Transactions/sec', PERF_COUNTER_BULK_COUNT, 'databases'),
+    ('Databases', 'Log Growths', PERF_COUNTER_LARGE_RAWCOUNT, 'databases'),
+    ('Databases', 'Log Shrinks', PERF_COUNTER_LARGE_RAWCOUNT, 'databases'),
+    ('Databases', 'Log Truncations', PERF_COUNTER_LARGE_RAWCOUNT, 'databases'),
+    ('Databases', 'Log Flush Wait Time', PERF_COUNTER_LARGE_RAWCOUNT, 'databases'),
+    ('Databases', 'Data File(s) Size (KB)', PERF_COUNTER_LARGE_RAWCOUNT, 'databases'),
+    ('Databases', 'Log File(s) Size (KB)', PERF_COUNTER_LARGE_RAWCOUNT, 'databases'),
+]
+
+#~ A few of every category plus idle waits, padded with preemptive waits to a realistic row count
+WAIT_TYPES = ['LCK_M_S', 'LCK_M_X', 'LCK_M_IX', 'PAGEIOLATCH_SH', 'PAGEIOLATCH_EX', 'PAGELATCH_EX',
+              'LATCH_EX', 'WRITELOG', 'ASYNC_NETWORK_IO', 'SOS_SCHEDULER_YIELD', 'CXPACKET',
+              'CXCONSUMER', 'RESOURCE_SEMAPHORE', 'CMEMTHREAD', 'IO_COMPLETION', 'LAZYWRITER_SLEEP',
+              'SLEEP_TASK', 'XE_TIMER_EVENT', 'REQUEST_FOR_DEADLOCK_SEARCH', 'CHECKPOINT_QUEUE',
+              'BROKER_TO_FLUSH', 'DIRTY_PAGE_POLL'] + ['PREEMPTIVE_OS_%03d' % i for i in range(300)]
+
+#~ Cumulative counters grow from this point in time so deltas give a rate
+EPOCH = 1000000000
+
+CONFIG = {
+    'databases'       : int(os.environ.get('FAKE_PYMSSQL_DATABASES', 10)),
+    'connect_latency' : float(os.environ.get('FAKE_PYMSSQL_CONNECT_LATENCY', 0)),
+    'query_latency'   : float(os.environ.get('FAKE_PYMSSQL_QUERY_LATENCY', 0)),
+    'down_hosts'      : [x for x in os.environ.get('FAKE_PYMSSQL_DOWN_HOSTS', '').split(',') if x],
+    'query_stats'     : int(os.environ.get('FAKE_PYMSSQL_QUERY_STATS', 2000)),
+}
+
+STATS = { 'connections' : 0, 'queries' : 0 }
+
+_lock = threading.Lock()
+_catalog = {}
+
+def configure(**kwargs):
+    CONFIG.update(kwargs)
+
+def reset_stats():
+    STATS['connections'] = 0
+    STATS['queries'] = 0
+
+def count(name):
+    _lock.acquire()
+    try:
+        STATS[name] += 1
+    finally:
+        _lock.release()
+
+def pad(name):
+    #~ The DMV columns are nchar(128)
+    return name.ljust(128)
+
+def stable(*names):
+    return zlib.crc32('|'.join(names)) & 0x7fffffff
+
+def database_names():
+    return SYSTEM_DATABASES + ['db%05d' % i for i in range(CONFIG['databases'])]
+
+def database_state(name):
+    #~ Every hundredth user database is offline or restoring and reports no counters
+    if name in SYSTEM_DATABASES or int(name[2:]) % 100 != 99:
+        return 'ONLINE'
+    elif int(name[2:]) % 200 == 99:
+        return 'OFFLINE'
+    return 'RESTORING'
+
+def online_database_names():
+    return [name for name in database_names() if database_state(name) == 'ONLINE']
+
+def counter_value(object_name, counter_name, cntr_type, instance, now):
+    seed = stable(object_name, counter_name, instance)
+    if cntr_type == PERF_COUNTER_BULK_COUNT:
+        return long((seed % 1000 + 1) * (now - EPOCH))
+    elif cntr_type == PERF_AVERAGE_BULK:
+        return long((seed % 50 + 1) * (now - EPOCH))
+    elif cntr_type == PERF_LARGE_RAW_BASE:
+        if counter_name.endswith('Wait Time Base'):
+            return long(now - EPOCH)
+        return 1000
+    elif cntr_type == PERF_LARGE_RAW_FRACTION:
+        return 900 + seed % 100
+    elif counter_name == 'Percent Log Used':
+        return seed % 100
+    return seed % 100000
+
+def performance_counters():
+    #~ Rows are built once per scale, cntr_value is computed from the clock when selected
+    databases = CONFIG['databases']
+    if databases not in _catalog:
+        rows = []
+        names = online_database_names() + ['_Total']
+        for object_name, counter_name, cntr_type, instances in SERVER_COUNTERS:
+            if instances == 'databases':
+                instances = names
+            for instance in instances:
+                rows.append({ 'object_name'   : pad('SQLServer:' + object_name),
+                              'counter_name'  : pad(counter_name),
+                              'instance_name' : pad(instance),
+                              'cntr_type'     : cntr_type,
+                              'cntr_value'    : (object_name, counter_name, cntr_type, instance),
+                              #~ Normalized copies used when matching WHERE conditions
+                              '_object_name'   : ('SQLServer:' + object_name).lower(),
+                              '_counter_name'  : counter_name.lower(),
+                              '_instance_name' : instance.lower() })
+        _catalog.clear()
+        _catalog[databases] = rows
+    return _catalog[databases]
+
+CONDITION_RE = re.compile(r"^\(?\s*(\w+)\s*(=|LIKE)\s*'((?:[^']|'')*)'\s*\)?$", re.IGNORECASE)
+SELECT_RE = re.compile(r"^SELECT (?P<columns>.+?) FROM (?P<table>[\w.]+)(?:\([^)]*\))?(?: WHERE (?P<where>.+?))?;?$", re.IGNORECASE | re.DOTALL)
+
+def like_to_regex(pattern):
+    return re.compile('^' + re.escape(pattern).replace('\\%', '.*').replace('\\_', '.') + '$', re.IGNORECASE)
+
+def compile_where(where):
+    #~ Supports column = 'x' and column LIKE 'x%' joined by AND and OR
+    if not where:
+        return lambda row: True
+    alternatives = []
+    #~ Alternatives that are a single equality are looked up in a set per column
+    equalities = {}
+    for alternative in re.split(r'\s+OR\s+', where, flags=re.IGNORECASE):
+        conditions = []
+        for condition in re.split(r'\s+AND\s+', alternative, flags=re.IGNORECASE):
+            match = CONDITION_RE.match(condition.strip())
+            if not match:
+                raise OperationalError('fake pymssql cannot evaluate condition: %s' % condition)
+            column, operator, value = match.groups()
+            value = value.replace("''", "'")
+            if operator.upper() == 'LIKE':
+                conditions.append((column, like_to_regex(value)))
+            else:
+                conditions.append((column, value.strip().lower()))
+        if len(conditions) == 1 and not hasattr(conditions[0][1], 'match'):
+            equalities.setdefault(conditions[0][0], set()).add(conditions[0][1])
+        else:
+            alternatives.append(conditions)
+
+    def field_of(row, column):
+        field = row.get('_' + column)
+        if field is None:
+            field = str(row[column]).strip().lower()
+        return field
+
+    def matches(row):
+        for column, values in equalities.items():
+            if field_of(row, column) in values:
+                return True
+        for conditions in alternatives:
+            for column, value in conditions:
+                field = field_of(row, column)
+                if hasattr(value, 'match'):
+                    if not value.match(field):
+                        break
+                elif field.lower() != value:
+                    break
+            else:
+                return True
+        return False
+    return matches
+
+def wait_stats():
+    if 'waits' not in _catalog:
+        rows = []
+        for wait_type in WAIT_TYPES:
+            seed = stable(wait_type)
+            if wait_type.startswith('PREEMPTIVE_'):
+                rate = seed % 3
+            else:
+                rate = seed % 200 + 1
+            rows.append({ 'wait_type'           : pad(wait_type),
+                          'waiting_tasks_count' : lambda now, rate=rate: long(rate * (now - EPOCH) / 10),
+                          'wait_time_ms'        : lambda now, rate=rate: long(rate * (now - EPOCH)),
+                          'signal_wait_time_ms' : lambda now, rate=rate, seed=seed: long(rate * (now - EPOCH) * (seed % 30) / 100),
+                          '_wait_type'          : wait_type.lower() })
+        _catalog['waits'] = rows
+    return _catalog['waits']
+
+def virtual_file_stats():
+    #~ A data and a log file per online database, the latency of each file is fixed by its name
+    databases = CONFIG['databases']
+    if ('files', databases) not in _catalog:
+        rows = []
+        for name in online_database_names():
+            for file_id in (1, 2):
+                seed = stable(name, str(file_id))
+                ios = seed % 50 + 1
+                latency = seed % 7 == 0 and seed % 40 + 10 or seed % 5 + 1
+                rows.append({ 'db_name(database_id)' : name,
+                              'file_id'              : file_id,
+                              'num_of_reads'         : lambda now, ios=ios: long(ios * (now - EPOCH)),
+                              'io_stall_read_ms'     : lambda now, ios=ios, latency=latency: long(ios * latency * (now - EPOCH)),
+                              'num_of_writes'        : lambda now, ios=ios: long(ios * (now - EPOCH) / 2),
+                              'io_stall_write_ms'    : lambda now, ios=ios, latency=latency: long(ios * latency * (now - EPOCH))})
+        _catalog[('files', databases)] = rows
+    return _catalog[('files', databases)]
+
+def query_stats():
+    #~ Generated row by row so a plan cache of any size costs no memory, a few statements are expensive
+    elapsed = time.time() - EPOCH
+    for i in xrange(CONFIG['query_stats']):
+        seed = stable('plan', str(i))
+        cpu = (seed % 1000) ** 3 / 10000
+        yield { 'plan_handle'             : '\x06\x00\x05\x00' + struct.pack('>Q', i / 3) + '\x00' * 32,
+                'statement_start_offset'  : (i % 3) * 100,
+                'total_worker_time'       : long(cpu * elapsed),
+                'total_logical_reads'     : long((seed % 500) * elapsed),
+                'total_elapsed_time'      : long(cpu * 3 / 2 * elapsed) }
+
+def table_rows(table):
+    table = table.lower()
+    if table == 'sys.dm_os_performance_counters':
+        return performance_counters()
+    elif table == 'sys.dm_exec_query_stats':
+        return query_stats()
+    elif table == 'sys.dm_io_virtual_file_stats':
+        return virtual_file_stats()
+    elif table == 'sys.dm_os_wait_stats':
+        return wait_stats()
+    elif table in ('sys.sysdatabases', 'sys.databases'):
+        return [{ 'name'                : name,
+                  '_name'               : name.lower(),
+                  'state_desc'          : database_state(name),
+                  'recovery_model_desc' : name == 'tempdb' and 'SIMPLE' or 'FULL',
+                  'is_read_only'        : 0,
+                  'source_database_id'  : None } for name in database_names()]
+    raise OperationalError('fake pymssql has no table %s' % table)
+
+def run_query(query):
+    match = SELECT_RE.match(query.strip())
+    if not match:
+        raise OperationalError('fake pymssql cannot parse query: %s' % query)
+    columns = [column.strip().lower() for column in match.group('columns').split(',')]
+    matches = compile_where(match.group('where'))
+    table = iter(table_rows(match.group('table')))
+    #~ Unknown columns fail in execute() like on a real server, the rows are produced while fetched
+    first = None
+    for first in table:
+        for column in columns:
+            if column not in first:
+                raise OperationalError('fake pymssql has no column %s' % column)
+        table = chain([first], table)
+        break
+    return select_rows(table, columns, matches, time.time())
+
+def select_rows(table, columns, matches, now):
+    for row in table:
+        if matches(row):
+            values = []
+            for column in columns:
+                value = row[column]
+                if column == 'cntr_value':
+                    value = counter_value(*(value + (now,)))
+                elif callable(value):
+                    value = value(now)
+                values.append(value)
+            yield tuple(values)
+
+class Cursor(object):
+
+    def __init__(self, timeout=0):
+        self.rows = iter([])
+        self.timeout = timeout
+
+    def execute(self, query, params=None):
+        count('queries')
+        if CONFIG['query_latency']:
+            if self.timeout and CONFIG['query_latency'] > self.timeout:
+                time.sleep(self.timeout)
+                raise OperationalError('Query timed out after %ss' % self.timeout)
+            time.sleep(CONFIG['query_latency'])
+        self.rows = run_query(query)
+
+    def fetchone(self):
+        for row in self.rows:
+            return row
+        return None
+
+    def fetchmany(self, size=1):
+        return list(islice(self.rows, size))
+
+    def fetchall(self):
+        return list(self.rows)
+
+    def close(self):
+        self.rows = iter([])
+
+class Connection(object):
+
+    def __init__(self, host, timeout=0):
+        self.host = host
+        self.timeout = timeout
+        self.closed = False
+
+    def cursor(self):
+        if self.closed:
+            raise InterfaceError('Connection is closed.')
+        return Cursor(self.timeout)
+
+    def commit(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+def connect(host='', user=None, password=None, database=None, login_timeout=60, timeout=0, **kwargs):
+    count('connections')
+    if CONFIG['connect_latency']:
+        if login_timeout and CONFIG['connect_latency'] > login_timeout:
+            time.sleep(login_timeout)
+            raise OperationalError('Unable to connect: login timed out after %ss (%s)' % (login_timeout, host))
+        time.sleep(CONFIG['connect_latency'])
+    if host.split('\\')[0].split(':')[0] in CONFIG['down_hosts']:
+        raise OperationalError('Unable to connect: Adaptive Server is unavailable or does not exist (%s)' % host)
+    return Connection(host, timeout)
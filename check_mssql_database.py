@@ -15,17 +15,66 @@
 # 2.0.0 -   Complete Revamp/Rewrite based on the server version of this plugin
 # 2.0.1 -   Fixed bug where temp file was named same as other for host and numbers
 #           were coming back bogus.
+# 2.1.0 -   All database checks reuse the initial connection and read the counter
+#           for every database with a single query
+#           Added --collector to run checks through a resident mssql_collector.py
+#           Delta modes keep their samples in a per host SQLite store (mssql_state.py),
+#           the pickle names were keyed by hash() and never found on Python 3
+#           Added --parallel and --database-timeout, databases that fail or time out
+#           are reported as unknown instead of failing the whole check
+#           Added --cache-ttl to answer checks from a counter snapshot shared by all
+#           checks of the host
+#           Added --batch to run many check specifications in one process and submit
+#           them as passive check results
+#           Thresholds are parsed once into compiled ranges and checked in parse_args
+#           Added --timing and --trace to report how long each phase of a check took
+#           Added --window and --aggregate to compute delta modes over a ring of recent
+#           samples (mssql_history.py), counter resets no longer give negative rates,
+#           windows longer than the ring holds at --check-interval are rejected
+#           Added --push to send the performance data to Graphite or InfluxDB in
+#           spooled batches (mssql_push.py)
+#           Added --login-timeout and --query-timeout, and a circuit breaker per host
+#           (--breaker-threshold, mssql_breaker.py) so checks of a host that is down
+#           fail at once instead of piling up on the poller
+#           Checking all databases reads sys.databases and leaves out offline, restoring
+#           and snapshot databases (mssql_catalog.py), --catalog-ttl caches the list
+#           Added --multi to evaluate several modes, each with its own thresholds, for
+#           every database from one counter snapshot, with optional passive results
+#           per database and mode (--cell-service)
+#           Added --top to summarize all databases in bounded output with statistics and
+#           the N worst databases (mssql_aggregate.py)
+#           Added --filelatency for the read and write latency and IOPS of every database
+#           file from sys.dm_io_virtual_file_stats (mssql_filestats.py)
+#           Added --record to append the query results of a check to a file that
+#           mssql_replay.py replays against the real query classes
+#           Added --metrics-dir to keep the performance data of every check in a
+#           columnar history, and mssql_metrics.py to backtest thresholds against it
 ########################################################################
 
 import pymssql
 import time
 import sys
-import tempfile
-try:
-    import cPickle as pickle
-except:
-    import pickle
+import socket
+import copy
+import threading
+import Queue
 from optparse import OptionParser, OptionGroup
+from mssql_snapshot import CounterSnapshot, get_cached_snapshot, quote, COUNTER_QUERY_RE
+from mssql_collector import request_check
+from mssql_state import DeltaStateStore
+from mssql_history import SampleHistory, AGGREGATES, CAPACITY, aggregate
+from mssql_batch import run_batch, write_checkresult
+from mssql_range import parse_range, classify
+from mssql_timing import make_timer, report_timing
+from mssql_push import parse_sink, push_result
+from mssql_breaker import get_breaker
+from mssql_replay import make_recorder, record_connect, record_connection, record_result
+from mssql_metrics import store_result
+from mssql_catalog import get_catalog, filter_catalog
+from mssql_aggregate import ResultAggregate, get_direction, SEVERITY
+from mssql_filestats import FILESTATS_QUERY, read_file_stats, calculate_file_stats
+
+PLUGIN_NAME = 'database'
 
 BASE_QUERY = "SELECT cntr_value FROM sys.dm_os_performance_counters WHERE counter_name='%s' AND instance_name='%%s';"
 DIVI_QUERY = "SELECT cntr_value FROM sys.dm_os_performance_counters WHERE counter_name LIKE '%s%%%%' AND instance_name='%%s';"
@@ -116,6 +165,14 @@ MODES     = {
                             'query'     : BASE_QUERY % 'Log File(s) Size (KB)',
                             'type'      : 'standard'
                             },
+    
+    'filelatency'       : { 'help'      : 'File I/O Latency',
+                            'stdout'    : 'Worst file latency is %sms',
+                            'label'     : 'file_latency',
+                            'unit'      : 'ms',
+                            'query'     : FILESTATS_QUERY,
+                            'type'      : 'filestats'
+                            },
    
     'time2connect'      : { 'help'      : 'Time to connect to the database.' },
     
@@ -126,6 +183,7 @@ STDOUT_PREFIX = {
     0 : 'OK: ',
     1 : 'WARNING: ',
     2 : 'CRITICAL: ',
+    3 : 'UNKNOWN: ',
 }
 
 DATASIZE_UNIT = {
@@ -159,47 +217,60 @@ class NagiosReturn(Exception):
 class MSSQLQuery(object):
     
     def __init__(self, query, options, label='', unit='', stdout='', host='', modifier=1, *args, **kwargs):
-        self.query = query % options.database
+        self.query = query % quote(options.database)
         self.label = label
         self.unit = unit
         self.stdout = stdout
         self.options = options
         self.host = host
         self.modifier = modifier
+        self.sample_time = None
     
     def run_on_connection(self, connection):
+        snapshot = get_cached_snapshot(connection, self.host, self.options.cache_ttl)
+        if snapshot is not None:
+            return self.run_on_snapshot(snapshot)
         cur = connection.cursor()
         cur.execute(self.query)
         self.query_result = cur.fetchone()[0]
     
-    def finish(self):
+    def run_on_snapshot(self, snapshot):
+        self.sample_time = snapshot.taken
+        self.query_result = snapshot.execute(self.query)[0][0]
+    
+    def get_output(self):
+        self.classify_result()
         stdout = self.stdout % str(self.result)
         stdout = '%s%s' % (STDOUT_PREFIX[self.code], stdout)
         if not self.options.no_perfdata:
             stdout = "%s|%s" % (stdout, self.perfdata)
-        raise NagiosReturn(stdout, self.code)
+        return stdout, self.code
+    
+    def finish(self):
+        stdout, code = self.options.timer.call('output', self.get_output)
+        raise NagiosReturn(stdout, code)
     
     def calculate_result(self):
         self.result = round(float(self.query_result) * self.modifier, 2)
 
-    def generate_perfdata(self):
-        if is_within_range(self.options.critical, self.result):
-           self.code = 2
-        elif is_within_range(self.options.warning, self.result):
-            self.code = 1
-        else:
-            self.code = 0
+    def classify_result(self):
+        self.code = classify([self.result], self.options.warning, self.options.critical)[0]
 
+    def generate_perfdata(self):
         self.perfdata = "'%s'=%s%s;%s;%s;;" % (  self.label,
                                                str(self.result),
                                                self.unit,
                                                self.options.warning or '',
                                                self.options.critical or '')
 
-    def do(self, connection):
-        self.run_on_connection(connection)
-        self.calculate_result()
-        self.generate_perfdata()
+    def do(self, connection, snapshot=None):
+        timer = self.options.timer
+        if snapshot is None:
+            timer.call('query', self.run_on_connection, connection)
+        else:
+            timer.call('query', self.run_on_snapshot, snapshot)
+        timer.call('state', self.calculate_result)
+        timer.call('output', self.generate_perfdata)
 
 class MSSQLDivideQuery(MSSQLQuery):
     
@@ -207,71 +278,58 @@ class MSSQLDivideQuery(MSSQLQuery):
         self.result = round((float(self.query_result[0]) / self.query_result[1]) * self.modifier, 2)
     
     def run_on_connection(self, connection):
+        snapshot = get_cached_snapshot(connection, self.host, self.options.cache_ttl)
+        if snapshot is not None:
+            return self.run_on_snapshot(snapshot)
         cur = connection.cursor()
         cur.execute(self.query)
         self.query_result = [x[0] for x in cur.fetchall()]
+    
+    def run_on_snapshot(self, snapshot):
+        self.sample_time = snapshot.taken
+        self.query_result = [x[0] for x in snapshot.execute(self.query)]
 
 class MSSQLDeltaQuery(MSSQLQuery):
     
-    def make_pickle_name(self):
-        tmpdir = tempfile.gettempdir()
-        tmpname = hash(self.host + self.database + self.query)
-        self.picklename = '%s/mssql-%s.tmp' % (tmpdir, tmpname)
+    def make_state_key(self):
+        #~ The query text names the counter and, for databases, the instance
+        return self.query
     
     def calculate_result(self):
-        self.make_pickle_name()
-        
-        try:
-            tmpfile = open(self.picklename)
-        except IOError:
-            tmpfile = open(self.picklename, 'w')
-            tmpfile.close()
-            tmpfile = open(self.picklename)
-        try:
-            try:
-                last_run = pickle.load(tmpfile)
-            except EOFError, ValueError:
-                last_run = { 'time' : None, 'value' : None }
-        finally:
-            tmpfile.close()
-        
-        if last_run['time']:
-            old_time = last_run['time']
-            new_time = time.time()
-            old_val  = last_run['query_result']
+        #~ A snapshot may come from the cache, so time the sample by when it was taken
+        new_time = self.sample_time or time.time()
+        if self.options.window:
+            self.calculate_window_result(new_time)
+            return
+        store = DeltaStateStore.for_host(self.host)
+        last_run = store.swap(self.make_state_key(), new_time, self.query_result)
+        self.calculate_delta(last_run, new_time)
+    
+    def calculate_delta(self, last_run, new_time):
+        #~ A counter that went backwards was reset by a server restart, wait for the next sample
+        if last_run and new_time > last_run[0] and self.query_result >= last_run[1]:
+            old_time, old_val = last_run
             new_val  = self.query_result
             self.result = round(((new_val - old_val) / (new_time - old_time)) * self.modifier, 2)
         else:
             self.result = None
-        
-        new_run = { 'time' : time.time(), 'query_result' : self.query_result }
-        
-        #~ Will throw IOError, leaving it to aquiesce
-        tmpfile = open(self.picklename, 'w')
-        pickle.dump(new_run, tmpfile)
-        tmpfile.close()
+    
+    def calculate_window_result(self, new_time):
+        history = SampleHistory.for_host(self.host)
+        samples = history.append(self.make_state_key(), new_time, self.query_result)
+        rate = aggregate(samples, new_time, self.options.window * 60, self.options.aggregate)
+        if rate is None:
+            self.result = None
+        else:
+            self.result = round(rate * self.modifier, 2)
 
 def is_within_range(nagstring, value):
-    if not nagstring:
-        return False
-    import re
-    import operator
-    first_float = r'(?P<first>(-?[0-9]+(\.[0-9]+)?))'
-    second_float= r'(?P<second>(-?[0-9]+(\.[0-9]+)?))'
-    actions = [ (r'^%s$' % first_float,lambda y: (value > float(y.group('first'))) or (value < 0)),
-                (r'^%s:$' % first_float,lambda y: value < float(y.group('first'))),
-                (r'^~:%s$' % first_float,lambda y: value > float(y.group('first'))),
-                (r'^%s:%s$' % (first_float,second_float), lambda y: (value < float(y.group('first'))) or (value > float(y.group('second')))),
-                (r'^@%s:%s$' % (first_float,second_float), lambda y: not((value < float(y.group('first'))) or (value > float(y.group('second')))))]
-    for regstr,func in actions:
-        res = re.match(regstr,nagstring)
-        if res: 
-            return func(res)
-    raise Exception('Improper warning/critical format.')
-
-def parse_args():
+    nagrange = parse_range(nagstring)
+    return nagrange is not None and nagrange.is_alert(value)
+
+def parse_args(args=None, parser_class=OptionParser):
     usage = "usage: %prog -H hostname -U user -P password -D database --mode"
-    parser = OptionParser(usage=usage)
+    parser = parser_class(usage=usage)
     
     required = OptionGroup(parser, "Required Options")
     required.add_option('-H', '--hostname', help='Specify MSSQL Server Address', default=None)
@@ -286,29 +344,110 @@ def parse_args():
     connection.add_option('--exclude-databases', help='Any database names matching this regex will be ignored', default=None) 
     connection.add_option('--include-databases', help='Only database names matching this regex will be checked', default=None) 
     connection.add_option('--case-sensitive', action="store_true", help='Make the include/exclude regex case-sensitive', default=False) 
+    connection.add_option('--catalog-ttl', type='float', help='Share the database list of the host with other checks for this many seconds', default=0)
+    connection.add_option('--parallel', type='int', help='Number of databases evaluated at once when checking all databases', default=1)
+    connection.add_option('--database-timeout', type='float', help='Seconds before a database is reported as unknown when running in parallel', default=30)
+    connection.add_option('--cache-ttl', type='float', help='Share a counter snapshot of the host with other checks for this many seconds', default=0)
+    connection.add_option('--collector', help='Run the check through the mssql_collector.py listening on this socket', default=None)
+    connection.add_option('--login-timeout', type='int', help='Seconds before a login attempt is given up', default=60)
+    connection.add_option('--query-timeout', type='int', help='Seconds before a query is given up, 0 waits forever', default=0)
+    connection.add_option('--breaker-threshold', type='int', help='Failed logins in a row after which checks of the host fail at once, 0 disables', default=0)
+    connection.add_option('--breaker-cooldown', type='int', help='Seconds before a login is tried again once the breaker is open', default=60)
     parser.add_option_group(connection)
     
     nagios = OptionGroup(parser, "Nagios Plugin Information")
     nagios.add_option('-w', '--warning', help='Specify warning range.', default=None)
     nagios.add_option('-c', '--critical', help='Specify critical range.', default=None)
     parser.add_option_group(nagios)
+    
+    history = OptionGroup(parser, "History Options")
+    history.add_option('--window', type='float', metavar='MINUTES', help='Compute delta modes over the samples of the last MINUTES instead of the previous run only. %d samples are kept per counter, the window must fit in them at --check-interval' % CAPACITY, default=0)
+    history.add_option('--check-interval', type='float', metavar='SECONDS', help='Seconds between two runs of the check, to verify that --window fits in the samples kept', default=60)
+    history.add_option('--aggregate', type='choice', choices=AGGREGATES, help='How delta modes combine the samples in the window: %s' % ', '.join(AGGREGATES), default='rate')
+    history.add_option('--metrics-dir', help='Append the performance data of the check to the history in this directory, see mssql_metrics.py', default=None)
+    parser.add_option_group(history)
 
     perfdata = OptionGroup(parser, "Performance Data Options")
     perfdata.add_option('-d', '--datasize-unit', help='Force a unit type for modes that return data size: B, KB, MB, GB, TB', default=None) 
     perfdata.add_option('-n', '--no-perfdata', action="store_true", help='Do not return performance data', default=False) 
+    perfdata.add_option('--top', type='int', metavar='N', help='When checking all databases, summarize them and only report the N worst', default=0)
     parser.add_option_group(perfdata)
     
     debug = OptionGroup(parser, "Debug Options")
     debug.add_option('-l', '--list-databases', action="store_true", help='List all databases on the server', default=False)
+    debug.add_option('--timing', action="store_true", help='Append the time spent in each phase of the check to the performance data', default=False)
+    debug.add_option('--trace', help='Append the time spent in each phase of the check, per database, to this JSON lines file', default=None)
+    debug.add_option('--record', help='Append the query results and result of the check to this file for mssql_replay.py, the snapshot and catalog caches are not used', default=None)
     parser.add_option_group(debug)
 
+    push = OptionGroup(parser, "Push Options")
+    push.add_option('--push', metavar='URL', help='Also send the performance data to graphite[+udp]://host[:port] or influx[+tcp]://host[:port]', default=None)
+    push.add_option('--push-prefix', help='Graphite path prefix or InfluxDB measurement', default='mssql')
+    push.add_option('--push-batch', type='int', metavar='BYTES', help='Send once this much is spooled for the sink', default=0)
+    push.add_option('--push-interval', type='float', metavar='SECONDS', help='Send once this long passed since the last send', default=0)
+    push.add_option('--push-buffer', type='int', metavar='BYTES', help='Newest data kept while the sink is down', default=8 * 1024 * 1024)
+    parser.add_option_group(push)
+    
+    multi = OptionGroup(parser, "Multi-Mode Options")
+    multi.add_option('--multi', action="append", metavar="MODE[,WARNING[,CRITICAL]]",
+                     help='Evaluate this mode for every database from a single counter snapshot. May be given several times.', default=None)
+    multi.add_option('--cell-service', metavar='TEMPLATE', help='Also write a passive result per database and mode to --spool-dir, for the service named by this template, e.g. "MSSQL %(database)s %(mode)s"', default=None)
+    multi.add_option('--cell-host', help='Nagios host of the passive results, the hostname by default', default=None)
+    parser.add_option_group(multi)
+    
+    batch = OptionGroup(parser, "Batch Options")
+    batch.add_option('--batch', help='Run the check specifications in this file (- for stdin) and print passive check results', default=None)
+    batch.add_option('--spool-dir', help='Write the batch results to this Nagios check result directory instead', default=None)
+    parser.add_option_group(batch)
+    
     mode = OptionGroup(parser, "Mode Options")
     global MODES
     for k, v in zip(MODES.keys(), MODES.values()):
         mode.add_option('--%s' % k, action="store_true", help=v.get('help'), default=False)
     parser.add_option_group(mode)
-    options, _ = parser.parse_args()
+    options, _ = parser.parse_args(args)
+    options.timer = make_timer(options)
+    options.recorder = make_recorder(parser, options, PLUGIN_NAME, args)
+    
+    for nagstring in (options.warning, options.critical):
+        try:
+            parse_range(nagstring)
+        except ValueError, e:
+            parser.error(str(e))
+    
+    if options.window < 0:
+        parser.error('Window must not be negative.')
+    if options.check_interval <= 0:
+        parser.error('Check interval must be positive.')
+    if options.window * 60 / options.check_interval > CAPACITY - 1:
+        parser.error('A window of %s minutes needs more than the %d samples kept per counter at a check interval of %ss.'
+                     % (options.window, CAPACITY, options.check_interval))
+    if options.login_timeout < 1 or options.query_timeout < 0 or options.breaker_threshold < 0:
+        parser.error('Timeouts and the breaker threshold must not be negative.')
+    if options.push:
+        try:
+            parse_sink(options.push)
+        except ValueError, e:
+            parser.error(str(e))
+    if options.record and (options.batch or options.collector):
+        parser.error('Record cannot be combined with --batch or --collector.')
+    if options.record:
+        #~ Every query of the check has to reach the server to be recorded
+        options.cache_ttl = 0
+        options.catalog_ttl = 0
     
+    if options.batch:
+        return options
+    if options.spool_dir and not options.cell_service:
+        parser.error('Spool directory can only be used with --batch or --cell-service.')
+    if options.cell_service and not (options.spool_dir and options.multi):
+        parser.error('Cell service needs --multi and --spool-dir.')
+    if options.cell_service:
+        #~ Formatted with every cell of the check, a template that does not fit would fail every run
+        try:
+            options.cell_service % { 'mode' : 'logfileusage', 'database' : 'master', 'query' : None, 'error' : '', 'code' : 0 }
+        except (KeyError, ValueError, TypeError), e:
+            parser.error('Invalid cell service template %s: %s' % (options.cell_service, e))
     if not options.hostname:
         parser.error('Hostname is a required option.')
     if not options.user:
@@ -319,12 +458,12 @@ def parse_args():
         parser.error('Cannot specify both instance and port.')
     if options.include_databases and options.exclude_databases:
         parser.error('Cannot both include and exclude databases. Pick only one.')
+    if options.parallel < 1:
+        parser.error('Parallel must be at least 1.')
+    if options.top < 0:
+        parser.error('Top must not be negative.')
     if options.datasize_unit and options.datasize_unit.upper() in DATASIZE_UNIT:
-        for v in ['datasize', 'logsize']:
-            options.datasize_unit = options.datasize_unit.upper() 
-            MODES[v]['unit'] = options.datasize_unit
-            MODES[v]['modifier'] = DATASIZE_UNIT[options.datasize_unit]
-            MODES[v]['stdout'] = MODES[v]['stdout'].rstrip('KB') + options.datasize_unit
+        options.datasize_unit = options.datasize_unit.upper() 
     elif options.datasize_unit and not options.datasize_unit in DATASIZE_UNIT:
         parser.error('Invalid datasize unit specified.')
     
@@ -338,6 +477,24 @@ def parse_args():
     if options.mode == 'test' and not options.database:
         parser.error('When running in test mode you must specify a database.')
     
+    if options.multi and options.mode:
+        parser.error("Cannot combine --multi with a Mode Option.")
+    checks = []
+    for spec in options.multi or []:
+        fields = spec.split(',')
+        if len(fields) > 3 or not COUNTER_QUERY_RE.match(MODES.get(fields[0], {}).get('query', '')):
+            parser.error("Invalid --multi specification: %s" % spec)
+        fields += [''] * (3 - len(fields))
+        for nagstring in fields[1:]:
+            try:
+                parse_range(nagstring)
+            except ValueError, e:
+                parser.error(str(e))
+        checks.append((fields[0], fields[1] or None, fields[2] or None))
+    if checks:
+        options.multi = checks
+        options.mode = 'multi'
+    
     return options
 
 def connect_db(options):
@@ -346,21 +503,66 @@ def connect_db(options):
         host += "\\" + options.instance
     elif options.port:
         host += ":" + options.port
+    breaker = get_breaker(host, options)
+    if breaker is not None:
+        wait = breaker.allow()
+        if wait is not None:
+            raise pymssql.InterfaceError('Circuit breaker open for %s after repeated login failures, next attempt in %ds.' % (host, wait))
     start = time.time()
-    mssql = pymssql.connect(host = host, user = options.user, password = options.password, database=options.database)
+    try:
+        mssql = pymssql.connect(host = host, user = options.user, password = options.password, database=options.database,
+                                login_timeout = options.login_timeout, timeout = options.query_timeout)
+    except (pymssql.OperationalError, pymssql.InterfaceError):
+        if breaker is not None:
+            breaker.failure()
+        raise
+    if breaker is not None:
+        breaker.success()
     total = time.time() - start
-    return mssql, total, host
+    record_connect(options, host, total)
+    return record_connection(options, mssql), total, host
 
 def main():
     options = parse_args()
     
+    if options.batch:
+        submitted = run_batch(sys.modules[__name__], options, sys.argv[1:])
+        if options.spool_dir:
+            raise NagiosReturn('%s%d check result(s) written to %s' % (STDOUT_PREFIX[0], submitted, options.spool_dir), 0)
+        return
+    
+    if options.collector and options.mode != 'test' and not options.list_databases:
+        run_on_collector(options, sys.argv[1:])
+    
     mssql, total, host = connect_db(options)
     
     if options.list_databases:
         databases = get_all_databases(mssql) 
         print "\n".join(databases)
+    else:
+        run_check(mssql, options, host, total)
+
+def run_on_collector(options, args):
+    #~ Falls through to the direct path when the collector cannot be reached
+    try:
+        stdout, code = request_check(options.collector, PLUGIN_NAME, args)
+    except (socket.error, ValueError, KeyError):
+        return
+    raise NagiosReturn(stdout, code)
+
+def run_check(mssql, options, host, total):
+    options.timer.add('connect', total)
+    try:
+        dispatch_check(mssql, options, host, total)
+    except NagiosReturn, e:
+        report_timing(options, PLUGIN_NAME, host, e)
+        push_result(options, PLUGIN_NAME, host, e)
+        record_result(options, e)
+        store_result(options, host, e)
+        raise
 
-    elif options.mode =='test':
+def dispatch_check(mssql, options, host, total):
+    if options.mode =='test':
         run_tests(mssql, options, host)
         
     elif not options.mode or options.mode == 'time2connect':
@@ -370,65 +572,386 @@ def main():
                         unit='s',
                         result=total )
                         
+    elif options.mode == 'multi':
+        run_matrix_check(mssql, options, host)
+        
+    elif MODES[options.mode].get('type') == 'filestats':
+        run_file_stats_check(mssql, options, host)
+        
     else:
         run_mode_check(mssql, options, host)
 
+def get_databases(mssql, options, host=''):
+    if options.database:
+        return [options.database]
+    #~ Only databases that can report counters, offline and restoring ones are left out
+    catalog = options.timer.call('query', get_catalog, mssql, host, options.catalog_ttl)
+    if options.exclude_databases:
+        return filter_catalog(catalog, options.exclude_databases, options.case_sensitive, True)
+    elif options.include_databases:
+        return filter_catalog(catalog, options.include_databases, options.case_sensitive, False)
+    return catalog.usable
+
 def run_mode_check(mssql, options, host=''):
-    check_all_databases = False
+    check_all_databases = not options.database
     results = {}
+    databases = get_databases(mssql, options, host)
+
+    #~ The counters are server wide and keyed by instance_name, so one query serves every database
+    snapshot = None
+    if check_all_databases:
+        snapshot = options.timer.call('query', get_cached_snapshot, mssql, host, options.cache_ttl)
+        if snapshot is None:
+            snapshot = options.timer.call('query', CounterSnapshot.fetch, mssql, [MODES[options.mode]['query'] % ''])
 
-    if not options.database:
-        databases = get_all_databases(mssql)
-        check_all_databases = True
+    if check_all_databases and options.top:
+        aggregate = ResultAggregate(options.top, get_direction(options.warning, options.critical))
+        def report(database, result):
+            code = result['code']
+            if code is None:
+                code = classify([result['result']], options.warning, options.critical)[0]
+            aggregate.add(database, result.get('result'), code, result.get('unit', ''))
+        evaluate_databases(mssql, options, host, databases, snapshot, report)
+        stdout, code = options.timer.call('output', get_aggregated_check_output, aggregate, options)
+        raise NagiosReturn(stdout, code)
+    elif check_all_databases:
+        results = evaluate_databases(mssql, options, host, databases, snapshot)
     else:
-        databases = [options.database]
+        for database in databases:
+            options.database = database
+            mssql_query = execute_query(mssql, options, host, check_all_databases, snapshot)
+            results[database] = { 'code' : mssql_query.code, 'perfdata' : mssql_query.perfdata }
 
-    if check_all_databases and options.exclude_databases:
-        databases = filter_database_list(databases, options.exclude_databases, options.case_sensitive, True)
-    elif check_all_databases and options.include_databases:
-        databases = filter_database_list(databases, options.include_databases, options.case_sensitive, False)
+    stdout, code = options.timer.call('output', get_multidb_check_output, results, options)
 
+    raise NagiosReturn(stdout, code)
+
+def run_file_stats_check(mssql, options, host=''):
+    #~ Every file of the server from one query, their previous samples swapped in one transaction
+    timer = options.timer
+    databases = get_databases(mssql, options, host)
+    sample_time, files = timer.call('query', read_file_stats, mssql, databases)
+    stats = timer.call('state', calculate_file_stats, DeltaStateStore.for_host(host), sample_time, files)
+    if options.database and options.database not in stats:
+        #~ -D is not checked against the catalog, a database without files does not exist
+        raise NagiosReturn('%sDatabase %s not found.' % (STDOUT_PREFIX[3], options.database), 3)
+    
+    results = {}
     for database in databases:
-        options.database = database
-        dbconnection, total, host = connect_db(options)
-        mssql_query = execute_query(dbconnection, options, host, check_all_databases)
-        results[database] = { 'code' : mssql_query.code, 'perfdata' : mssql_query.perfdata }
-        dbconnection.close()
+        results[database] = get_file_stats_result(database, stats.get(database), options)
+    if not options.database and options.top:
+        aggregate = ResultAggregate(options.top, get_direction(options.warning, options.critical))
+        codes = classify([results[database]['result'] for database in databases], options.warning, options.critical)
+        for database, code in zip(databases, codes):
+            aggregate.add(database, results[database]['result'], code, 'ms')
+        stdout, code = timer.call('output', get_aggregated_check_output, aggregate, options)
+    else:
+        stdout, code = timer.call('output', get_multidb_check_output, results, options)
+    raise NagiosReturn(stdout, code)
 
-    stdout, code = get_multidb_check_output(results, options)
+def get_file_stats_result(database, stats, options):
+    #~ The thresholds apply to the worst read or write latency of any file of the database
+    if stats is None:
+        return { 'code' : None, 'result' : None, 'perfdata' : None }
+    file_id, latency = stats['worst']
+    total = stats['total']
+    perfdata = ["'%s_latency'=%sms;%s;%s;;" % (database, latency, options.warning or '', options.critical or ''),
+                "'%s_read_latency'=%sms;;;;" % (database, total['read_latency']),
+                "'%s_write_latency'=%sms;;;;" % (database, total['write_latency']),
+                "'%s_iops'=%s;;;;" % (database, total['iops'])]
+    if options.database:
+        for file_id, summary in stats['files']:
+            perfdata += ["'%s_file%d_read_latency'=%sms;;;;" % (database, file_id, summary['read_latency']),
+                         "'%s_file%d_write_latency'=%sms;;;;" % (database, file_id, summary['write_latency']),
+                         "'%s_file%d_iops'=%s;;;;" % (database, file_id, summary['iops'])]
+    return { 'code' : None, 'result' : latency, 'perfdata' : " ".join(perfdata) }
 
+def run_matrix_check(mssql, options, host=''):
+    #~ Every database x mode cell from one catalog and one counter snapshot, whatever their number
+    timer = options.timer
+    databases = get_databases(mssql, options, host)
+    snapshot = timer.call('query', get_cached_snapshot, mssql, host, options.cache_ttl)
+    if snapshot is None:
+        snapshot = timer.call('query', CounterSnapshot.fetch, mssql, [MODES[mode]['query'] % '' for mode, warning, critical in options.multi])
+    
+    cells = []
+    for mode, warning, critical in options.multi:
+        #~ One options copy per mode, the queries only read database while they are made
+        mode_options = copy.copy(options)
+        mode_options.mode = mode
+        mode_options.warning = warning
+        mode_options.critical = critical
+        for database in databases:
+            mode_options.database = database
+            mssql_query = make_query(mode_options, host, True)
+            mssql_query.label = '%s_%s' % (database, mode)
+            try:
+                timer.call('query', mssql_query.run_on_snapshot, snapshot)
+            except (IndexError, ValueError, TypeError), e:
+                cells.append({ 'mode' : mode, 'database' : database, 'query' : None, 'error' : str(e) })
+                continue
+            cells.append({ 'mode' : mode, 'database' : database, 'query' : mssql_query })
+    timer.call('state', calculate_cells, cells, options, host)
+    
+    stdout, code = timer.call('output', get_matrix_check_output, cells, options, databases)
+    if options.cell_service:
+        timer.call('output', write_cell_results, cells, options)
     raise NagiosReturn(stdout, code)
 
-def filter_database_list(databases, regex_string, case_sensitive, invert):
-    import re
+def calculate_cells(cells, options, host):
+    #~ Delta samples of all cells go to the state store in one transaction
+    deltas = []
+    for cell in cells:
+        mssql_query = cell['query']
+        if mssql_query is None:
+            continue
+        try:
+            if isinstance(mssql_query, MSSQLDeltaQuery) and not options.window:
+                deltas.append(mssql_query)
+            else:
+                mssql_query.calculate_result()
+        except (ValueError, TypeError, ZeroDivisionError), e:
+            cell['query'], cell['error'] = None, str(e)
+    if deltas:
+        store = DeltaStateStore.for_host(host)
+        previous = store.swap_many([(q.make_state_key(), q.sample_time, q.query_result) for q in deltas])
+        for mssql_query, last_run in zip(deltas, previous):
+            mssql_query.calculate_delta(last_run, mssql_query.sample_time)
+    
+    for mode, warning, critical in options.multi:
+        mode_cells = [cell for cell in cells if cell['mode'] == mode and cell['query'] is not None]
+        codes = classify([cell['query'].result for cell in mode_cells], warning, critical)
+        for cell, code in zip(mode_cells, codes):
+            cell['code'] = code
+            cell['query'].code = code
+    for cell in cells:
+        if cell['query'] is None:
+            cell['code'] = 3
 
-    if not case_sensitive:
-        regex = re.compile(regex_string, re.IGNORECASE)
-    else :
-        regex = re.compile(regex_string)
+def format_summary(aggregate, prefix, suffix, unit, warning, critical):
+    #~ Perfdata of the summary statistics (prefix + name) followed by the N worst databases (name + suffix),
+    #~ values that are not available are left out
+    perfdata = ["'%scount'=%d;;;;" % (prefix, aggregate.count)]
+    for name, value in aggregate.get_statistics():
+        if value is not None:
+            perfdata.append("'%s%s'=%s%s;;;;" % (prefix, name, value, unit))
+    for database, value, code, extra in aggregate.get_worst():
+        if value is not None:
+            perfdata.append("'%s%s'=%s%s;%s;%s;;" % (database, suffix, value, extra or unit, warning or '', critical or ''))
+    return " ".join(perfdata)
 
-    if invert:
-        return [x for x in databases if not regex.match(x)]
+def get_aggregated_check_output(aggregate, options):
+    states = aggregate.states
+    stdout = "%d database(s) checked for %s." % (sum(states.values()), MODES[options.mode]['help'].lower())
+    for code, state in [(2, 'a critical'), (1, 'a warning'), (3, 'an unknown')]:
+        if states[code]:
+            stdout += " %d in %s state." % (states[code], state)
+    worst = ["%s (%s)" % (database, value) for database, value, code, extra in aggregate.get_worst() if code]
+    if worst:
+        stdout += " Worst: %s." % ", ".join(worst)
+    
+    if states[2] >= states[1] and states[2] > 0:
+        code = 2
+    elif states[1] > states[2]:
+        code = 1
+    elif states[3] > 0:
+        code = 3
     else:
-        return [x for x in databases if regex.match(x)]
+        code = 0
+    stdout = STDOUT_PREFIX[code] + stdout
+    if not options.no_perfdata:
+        unit = MODES[options.mode].get('unit', '')
+        if options.datasize_unit and options.mode in ('datasize', 'logsize'):
+            unit = options.datasize_unit
+        stdout += "|" + format_summary(aggregate, '', '', unit, options.warning, options.critical)
+    return stdout, code
+
+def get_matrix_check_output(cells, options, databases):
+    if options.top:
+        return get_aggregated_matrix_output(cells, options, databases)
+    states = { 1 : {}, 2 : {}, 3 : {} }
+    perfdata_output = []
+    for cell in cells:
+        if cell['code']:
+            states[cell['code']].setdefault(cell['mode'], []).append(cell['database'])
+        if cell['query'] is not None:
+            cell['query'].generate_perfdata()
+            perfdata_output.append(cell['query'].perfdata)
+    
+    stdout = "%d database(s) x %d mode(s) checked." % (len(databases), len(options.multi))
+    for code, state in [(2, 'a critical'), (1, 'a warning'), (3, 'an unknown')]:
+        count = sum([len(names) for names in states[code].values()])
+        if count:
+            stdout += " %d in %s state (%s)." % (count, state, "; ".join(["%s: %s" % (mode, ", ".join(states[code][mode]))
+                                                                          for mode in sorted(states[code].keys())]))
+    
+    if states[2]:
+        code = 2
+    elif states[1]:
+        code = 1
+    elif states[3]:
+        code = 3
+    else:
+        code = 0
+    stdout = STDOUT_PREFIX[code] + stdout
+    if perfdata_output and not options.no_perfdata:
+        stdout += "|" + " ".join(perfdata_output)
+    return stdout, code
+
+def get_aggregated_matrix_output(cells, options, databases):
+    aggregates = {}
+    for mode, warning, critical in options.multi:
+        aggregates[mode] = ResultAggregate(options.top, get_direction(warning, critical))
+    for cell in cells:
+        result = None
+        if cell['query'] is not None:
+            result = cell['query'].result
+        aggregates[cell['mode']].add(cell['database'], result, cell['code'])
+    
+    stdout = "%d database(s) x %d mode(s) checked." % (len(databases), len(options.multi))
+    perfdata_output = []
+    worst = 0
+    for mode, warning, critical in options.multi:
+        aggregate = aggregates[mode]
+        counts = []
+        for code, state in [(2, 'critical'), (1, 'warning'), (3, 'unknown')]:
+            if aggregate.states[code]:
+                counts.append("%d %s" % (aggregate.states[code], state))
+                if SEVERITY[code] > SEVERITY[worst]:
+                    worst = code
+        if counts:
+            names = [database for database, value, code, extra in aggregate.get_worst() if code]
+            stdout += " %s: %s (worst: %s)." % (mode, ", ".join(counts), ", ".join(names))
+        perfdata_output.append(format_summary(aggregate, mode + '_', '_' + mode, MODES[mode].get('unit', ''), warning, critical))
+    
+    stdout = STDOUT_PREFIX[worst] + stdout
+    if not options.no_perfdata:
+        stdout += "|" + " ".join(perfdata_output)
+    return stdout, worst
+
+def write_cell_results(cells, options):
+    now = time.time()
+    for cell in cells:
+        if cell['query'] is None:
+            stdout = '%s%s failed with: %s' % (STDOUT_PREFIX[3], cell['mode'], cell['error'])
+        else:
+            mssql_query = cell['query']
+            mssql_query.label = MODES[cell['mode']]['label']
+            mssql_query.generate_perfdata()
+            stdout, code = mssql_query.get_output()
+        write_checkresult(options.spool_dir, { 'time'                : int(now),
+                                               'host_name'           : options.cell_host or options.hostname,
+                                               'service_description' : options.cell_service % cell,
+                                               'start_time'          : now,
+                                               'finish_time'         : now,
+                                               'code'                : cell['code'],
+                                               'output'              : stdout })
+
+def evaluate_database(mssql, options, host, database, snapshot):
+    db_options = copy.copy(options)
+    db_options.database = database
+    db_options.timer = options.timer.child(database)
+    try:
+        mssql_query = execute_query(mssql, db_options, host, True, snapshot)
+    except Exception, e:
+        return { 'code' : 3, 'perfdata' : None, 'error' : str(e) }
+    #~ Left unclassified, get_multidb_check_output() classifies all databases in one pass
+    if options.top:
+        return { 'code' : None, 'result' : mssql_query.result, 'perfdata' : None, 'unit' : mssql_query.unit }
+    return { 'code' : None, 'result' : mssql_query.result, 'perfdata' : mssql_query.perfdata }
+
+def evaluate_databases(mssql, options, host, databases, snapshot, report=None):
+    #~ Results are handed to report(database, result) as they finish, or collected and returned
+    results = {}
+    if report is None:
+        report = results.__setitem__
+    if options.parallel <= 1:
+        for database in databases:
+            report(database, evaluate_database(mssql, options, host, database, snapshot))
+        return results
+
+    jobs = Queue.Queue()
+    done = Queue.Queue()
+    for database in databases:
+        jobs.put(database)
+
+    def worker():
+        while True:
+            try:
+                database = jobs.get_nowait()
+            except Queue.Empty:
+                return
+            done.put(('start', database, time.time()))
+            done.put(('done', database, evaluate_database(mssql, options, host, database, snapshot)))
+
+    def start_worker():
+        thread = threading.Thread(target=worker)
+        thread.setDaemon(True)
+        thread.start()
+
+    for i in range(min(options.parallel, len(databases))):
+        start_worker()
+
+    started = {}
+    finished = set()
+    while len(finished) < len(databases):
+        wait = None
+        if started:
+            wait = max(0, min(started.values()) + options.database_timeout - time.time())
+        try:
+            state, database, value = done.get(True, wait)
+        except Queue.Empty:
+            state = None
+        if state == 'start' and database not in finished:
+            started[database] = value
+        elif state == 'done' and database not in finished:
+            del started[database]
+            finished.add(database)
+            report(database, value)
+
+        now = time.time()
+        for database, start in started.items():
+            if now - start >= options.database_timeout:
+                #~ The stuck worker is left behind and replaced to keep the pool at its size
+                del started[database]
+                finished.add(database)
+                report(database, { 'code' : 3, 'perfdata' : None,
+                                   'error' : 'timed out after %ss' % options.database_timeout })
+                start_worker()
+    return results
 
 def get_multidb_check_output(results, options):
     warnings = []
     criticals = []
+    unknowns = []
     perfdata_output = []
 
-    for database in results.keys():
-        perfdata_output.append(results[database]['perfdata'])
+    pending = [database for database in sorted(results.keys()) if results[database]['code'] is None]
+    codes = classify([results[database]['result'] for database in pending], options.warning, options.critical)
+    for database, code in zip(pending, codes):
+        results[database]['code'] = code
+
+    for database in sorted(results.keys()):
+        if results[database]['perfdata']:
+            perfdata_output.append(results[database]['perfdata'])
         if results[database]['code'] == 1:
             warnings.append(database)
         elif results[database]['code'] == 2:
             criticals.append(database)
+        elif results[database]['code'] == 3:
+            #~ With the reason when there is one, a timeout or the error of the query
+            if results[database].get('error'):
+                unknowns.append('%s (%s)' % (database, results[database]['error']))
+            else:
+                unknowns.append(database)
 
     stdout = str(len(results)) + " database(s) checked for " + MODES[options.mode]['help'].lower() + "."
     if len(criticals) > 0:
         stdout = stdout + " " + str(len(criticals)) + " in a critical state (" + ", ".join(criticals) + ")." 
     if len(warnings) > 0:
         stdout = stdout + " " + str(len(warnings)) + " in a warning state (" + ", ".join(warnings) + ")."
+    if len(unknowns) > 0:
+        stdout = stdout + " " + str(len(unknowns)) + " in an unknown state (" + ", ".join(unknowns) + ")."
     if len(perfdata_output) > 0 and not options.no_perfdata:
         stdout = stdout + "|" + " ".join(perfdata_output)
 
@@ -436,27 +959,36 @@ def get_multidb_check_output(results, options):
         code = 2
     elif len(warnings) > len(criticals):
         code = 1
+    elif len(unknowns) > 0:
+        code = 3
     else:
         code = 0
     stdout = STDOUT_PREFIX[code] + stdout
 
     return stdout, code
 
-def execute_query(mssql, options, host='', check_all_databases=False):
-    sql_query = MODES[options.mode]
+def make_query(options, host='', check_all_databases=False):
+    sql_query = dict(MODES[options.mode])
     sql_query['options'] = options
     sql_query['host'] = host
     query_type = sql_query.get('type')
     if check_all_databases:
         sql_query['label'] = options.database
+    if options.datasize_unit and options.mode in ('datasize', 'logsize'):
+        sql_query['unit'] = options.datasize_unit
+        sql_query['modifier'] = DATASIZE_UNIT[options.datasize_unit]
+        sql_query['stdout'] = sql_query['stdout'].rstrip('KB') + options.datasize_unit
 
     if query_type == 'delta':
-        mssql_query = MSSQLDeltaQuery(**sql_query)
+        return MSSQLDeltaQuery(**sql_query)
     elif query_type == 'divide':
-        mssql_query = MSSQLDivideQuery(**sql_query)
+        return MSSQLDivideQuery(**sql_query)
     else:
-        mssql_query = MSSQLQuery(**sql_query)
-    mssql_query.do(mssql)
+        return MSSQLQuery(**sql_query)
+
+def execute_query(mssql, options, host='', check_all_databases=False, snapshot=None):
+    mssql_query = make_query(options, host, check_all_databases)
+    mssql_query.do(mssql, snapshot)
 
     if not check_all_databases:
         mssql_query.finish()
@@ -477,7 +1009,10 @@ def run_tests(mssql, options, host):
         total += 1
         options.mode = mode
         try:
-            execute_query(mssql, options, host)
+            if MODES[mode].get('type') == 'filestats':
+                run_file_stats_check(mssql, options, host)
+            else:
+                execute_query(mssql, options, host)
         except NagiosReturn:
             print "%s passed!" % mode
         except Exception, e:
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+########################################################################
+# check_mssql_fleet.py
+# Licence : GPL - http://www.fsf.org/licenses/gpl.txt
+#
+# Runs check_mssql_server.py and check_mssql_database.py checks against
+# many hosts from one process. Hosts are checked concurrently by a
+# bounded pool of worker threads, each host over a single connection,
+# and one result line is printed per host/mode as soon as it completes:
+#
+#   host;mode;code;output
+#
+# Inventory file, one check per line:
+#   host[\instance|:port]  credential  server|database  plugin options...
+#   sql01        monitor  server    --pagelife -w 300: -c 100:
+#   sql02\INST2  monitor  database  --logfileusage -w 80 -c 90
+#
+# Credentials file, one per line (keep it mode 0600):
+#   credential  user  password
+########################################################################
+
+import sys
+import time
+import shlex
+import threading
+import Queue
+import pymssql
+from optparse import OptionParser
+
+import check_mssql_server
+import check_mssql_database
+
+PLUGINS = {
+    'server'   : check_mssql_server,
+    'database' : check_mssql_database,
+}
+
+STDOUT_PREFIX = check_mssql_server.STDOUT_PREFIX
+
+#~ Order in which states win when folding many results into one exit code
+SEVERITY = { 0 : 0, 3 : 1, 1 : 2, 2 : 3 }
+
+def read_lines(filename):
+    for line in open(filename):
+        line = line.strip()
+        if line and not line.startswith('#'):
+            yield line
+
+def read_credentials(filename):
+    credentials = {}
+    for line in read_lines(filename):
+        fields = line.split(None, 2)
+        if len(fields) != 3:
+            raise ValueError('Invalid credentials line: %s' % line)
+        credentials[fields[0]] = (fields[1], fields[2])
+    return credentials
+
+def split_host(address):
+    if '\\' in address:
+        host, instance = address.split('\\', 1)
+        return host, ['-I', instance]
+    elif ':' in address:
+        host, port = address.split(':', 1)
+        return host, ['-p', port]
+    return address, []
+
+def read_inventory(filename, credentials):
+    #~ Checks are grouped per host and credential so each host uses one connection
+    hosts = []
+    index = {}
+    for line in read_lines(filename):
+        fields = shlex.split(line)
+        if len(fields) < 4 or fields[2] not in PLUGINS or fields[1] not in credentials:
+            raise ValueError('Invalid inventory line: %s' % line)
+        address, credential, plugin_name = fields[:3]
+        host, connection_args = split_host(address)
+        user, password = credentials[credential]
+        args = ['-H', host, '-U', user, '-P', password] + connection_args + fields[3:]
+        key = (address, credential)
+        if key not in index:
+            index[key] = len(hosts)
+            hosts.append({ 'address' : address, 'checks' : [] })
+        hosts[index[key]]['checks'].append((plugin_name, args))
+    return hosts
+
+def format_result(address, mode, code, stdout):
+    return '%s;%s;%d;%s' % (address, mode, code, stdout.replace('\n', '\\n'))
+
+def run_check_on_connection(plugin, mssql, options, host, total):
+    try:
+        plugin.run_check(mssql, options, host, total)
+    except plugin.NagiosReturn, e:
+        return e.code, e.message
+    except (pymssql.OperationalError, pymssql.InterfaceError), e:
+        return 3, '%s%s' % (STDOUT_PREFIX[3], e)
+    except Exception, e:
+        return 3, '%sCaught unexpected error: %s' % (STDOUT_PREFIX[3], e)
+    return 3, '%sCheck returned no result.' % STDOUT_PREFIX[3]
+
+def run_host(job, host, results):
+    checks = []
+    for i, (plugin_name, args) in enumerate(host['checks']):
+        plugin = PLUGINS[plugin_name]
+        try:
+            options = plugin.parse_args(args)
+        except SystemExit:
+            results.put(('result', job, i, 3, '%sInvalid plugin options.' % STDOUT_PREFIX[3]))
+            continue
+        options.collector = None
+        checks.append((i, plugin, options))
+
+    if not checks:
+        return
+    try:
+        mssql, total, address = check_mssql_server.connect_db(checks[0][2])
+    except (pymssql.OperationalError, pymssql.InterfaceError), e:
+        for i, plugin, options in checks:
+            results.put(('result', job, i, 3, '%s%s' % (STDOUT_PREFIX[3], e)))
+        return
+    try:
+        for i, plugin, options in checks:
+            code, stdout = run_check_on_connection(plugin, mssql, options, address, total)
+            results.put(('result', job, i, code, stdout))
+    finally:
+        mssql.close()
+
+def worker(hosts, jobs, results, abandoned, current):
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        current[threading.currentThread()] = job
+        results.put(('start', job, time.time()))
+        try:
+            run_host(job, hosts[job], results)
+        finally:
+            results.put(('done', job))
+        #~ A worker that outlived its host's timeout was already replaced
+        if job in abandoned:
+            return
+
+def start_worker(hosts, jobs, results, abandoned, current):
+    thread = threading.Thread(target=worker, args=(hosts, jobs, results, abandoned, current))
+    thread.setDaemon(True)
+    thread.start()
+    return thread
+
+def check_mode(check):
+    plugin_name, args = check
+    modes = [arg[2:] for arg in args if arg.startswith('--') and (arg[2:] in PLUGINS[plugin_name].MODES or arg in ('--multi', '--counter'))]
+    if modes:
+        return modes[0]
+    return plugin_name
+
+def run_fleet(hosts, workers, timeout, output=sys.stdout):
+    jobs = Queue.Queue()
+    results = Queue.Queue()
+    abandoned = set()
+    current = {}
+    threads = []
+    for job in range(len(hosts)):
+        jobs.put(job)
+    for i in range(min(workers, len(hosts))):
+        threads.append(start_worker(hosts, jobs, results, abandoned, current))
+
+    reported = [set() for host in hosts]
+    started = {}
+    pending = len(hosts)
+    worst = 0
+
+    def report(job, i, code, stdout):
+        host = hosts[job]
+        reported[job].add(i)
+        output.write(format_result(host['address'], check_mode(host['checks'][i]), code, stdout) + '\n')
+        output.flush()
+        return code
+
+    while pending:
+        wait = None
+        if started:
+            wait = max(0, min(started.values()) + timeout - time.time())
+        try:
+            message = results.get(True, wait)
+        except Queue.Empty:
+            message = None
+
+        if message and message[1] not in abandoned:
+            job = message[1]
+            if message[0] == 'start':
+                started[job] = message[2]
+            elif message[0] == 'result':
+                code = report(job, message[2], message[3], message[4])
+                if SEVERITY[code] > SEVERITY[worst]:
+                    worst = code
+            elif message[0] == 'done':
+                del started[job]
+                pending -= 1
+
+        now = time.time()
+        for job, start in started.items():
+            if now - start < timeout:
+                continue
+            abandoned.add(job)
+            del started[job]
+            pending -= 1
+            for i in range(len(hosts[job]['checks'])):
+                if i not in reported[job]:
+                    report(job, i, 3, '%sHost check timed out after %ss.' % (STDOUT_PREFIX[3], timeout))
+                    if SEVERITY[3] > SEVERITY[worst]:
+                        worst = 3
+            threads.append(start_worker(hosts, jobs, results, abandoned, current))
+
+    #~ Workers stuck on a timed out host are left behind as daemon threads
+    for thread in threads:
+        jobs.put(None)
+    for thread in threads:
+        if current.get(thread) not in abandoned:
+            thread.join()
+    return worst
+
+def parse_args():
+    usage = "usage: %prog -f inventory -C credentials"
+    parser = OptionParser(usage=usage)
+    parser.add_option('-f', '--inventory', help='Host inventory file', default=None)
+    parser.add_option('-C', '--credentials', help='Credentials file referenced by the inventory', default=None)
+    parser.add_option('-j', '--workers', type='int', help='Number of hosts checked at once', default=16)
+    parser.add_option('-t', '--timeout', type='float', help='Seconds allowed for all checks of one host', default=60)
+    options, _ = parser.parse_args()
+    if not options.inventory:
+        parser.error('Inventory is a required option.')
+    if not options.credentials:
+        parser.error('Credentials is a required option.')
+    if options.workers < 1:
+        parser.error('Workers must be at least 1.')
+    return options
+
+def main():
+    options = parse_args()
+    hosts = read_inventory(options.inventory, read_credentials(options.credentials))
+    sys.exit(run_fleet(hosts, options.workers, options.timeout))
+
+if __name__ == '__main__':
+    try:
+        main()
+    except (IOError, ValueError), e:
+        print e
+        sys.exit(3)
@@ -20,17 +20,60 @@
 #           legacy systems
 # 2.0.2 -   Fixed issues where the SQL cache hit queries were yielding improper results
 #           when done on large systems | Thanks CTrahan
+# 2.1.0 -   Added --multi to evaluate several modes, each with its own thresholds,
+#           from a single snapshot of sys.dm_os_performance_counters
+#           Added --collector to run checks through a resident mssql_collector.py
+#           Delta modes keep their samples in a per host SQLite store (mssql_state.py),
+#           the pickle names were keyed by hash() and never found on Python 3
+#           Added --cache-ttl to answer checks from a counter snapshot shared by all
+#           checks of the host
+#           Added --batch to run many check specifications in one process and submit
+#           them as passive check results
+#           Thresholds are parsed once into compiled ranges and checked in parse_args
+#           Added --timing and --trace to report how long each phase of a check took
+#           Added --window and --aggregate to compute delta modes over a ring of recent
+#           samples (mssql_history.py), counter resets no longer give negative rates,
+#           windows longer than the ring holds at --check-interval are rejected
+#           Added --counter to check any performance counter according to its cntr_type
+#           (mssql_counters.py), averagewait and lockwait now use it and no longer
+#           report a broken divide and a raw cumulative value
+#           Added --push to send the performance data to Graphite or InfluxDB in
+#           spooled batches (mssql_push.py)
+#           Added --login-timeout and --query-timeout, and a circuit breaker per host
+#           (--breaker-threshold, mssql_breaker.py) so checks of a host that is down
+#           fail at once instead of piling up on the poller
+#           Added --waitstats to report the top waits, the signal wait ratio and the
+#           wait time per category from diffs of sys.dm_os_wait_stats (mssql_waits.py)
+#           Added --querystats to report the statements using the most CPU since the
+#           previous run, streaming sys.dm_exec_query_stats (mssql_querystats.py)
+#           Added --record to append the query results of a check to a file that
+#           mssql_replay.py replays against the real query classes
+#           Added --metrics-dir to keep the performance data of every check in a
+#           columnar history, and mssql_metrics.py to backtest thresholds against it
 ########################################################################
 
 import pymssql
 import time
 import sys
-import tempfile
-try:
-    import cPickle as pickle
-except:
-    import pickle
+import copy
+import socket
 from optparse import OptionParser, OptionGroup
+from mssql_snapshot import CounterSnapshot, get_cached_snapshot, COUNTER_QUERY_RE
+from mssql_collector import request_check
+from mssql_state import DeltaStateStore
+from mssql_history import SampleHistory, AGGREGATES, CAPACITY, aggregate
+from mssql_batch import run_batch
+from mssql_range import parse_range
+from mssql_timing import make_timer, report_timing
+from mssql_push import parse_sink, push_result
+from mssql_breaker import get_breaker
+from mssql_replay import make_recorder, record_connect, record_connection, record_result
+from mssql_metrics import store_result
+from mssql_counters import parse_counter, counter_query, make_label, read_counter, calculate_counter, PERF_LARGE_RAW_FRACTION
+from mssql_waits import WaitStats, WAITSTATS_QUERY, CATEGORY_NAMES
+from mssql_querystats import QUERYSTATS_QUERY, scan_query_stats
+
+PLUGIN_NAME = 'server'
 
 BASE_QUERY = "SELECT cntr_value FROM sys.dm_os_performance_counters WHERE counter_name='%s' AND instance_name='';"
 INST_QUERY = "SELECT cntr_value FROM sys.dm_os_performance_counters WHERE counter_name='%s' AND instance_name='%s';"
@@ -155,20 +198,22 @@ MODES     = {
                             'type'      : 'delta',
                             },
     
-    'lockwait'          : { 'help'      : 'Lock Wait Average Time (ms)',
-                            'stdout'    : 'Lock Wait Average Time (ms) is %sms',
+    'lockwait'          : { 'help'      : 'Lock Wait Time (ms) / Sec',
+                            'stdout'    : 'Lock Wait Time (ms) / Sec is %sms',
                             'label'     : 'lockwait',
                             'unit'      : 'ms',
-                            'query'     : INST_QUERY % ('Lock Wait Time (ms)', '_Total'),
-                            'type'      : 'standard',
+                            'query'     : counter_query('Locks:Lock Wait Time (ms):_Total'),
+                            'counter'   : 'Locks:Lock Wait Time (ms):_Total',
+                            'type'      : 'counter',
                             },
     
     'averagewait'       : { 'help'      : 'Average Wait Time (ms)',
                             'stdout'    : 'Average Wait Time (ms) is %sms',
                             'label'     : 'averagewait',
                             'unit'      : 'ms',
-                            'query'     : DIVI_QUERY % ('Average Wait Time', '_Total'),
-                            'type'      : 'divice',
+                            'query'     : counter_query('Locks:Average Wait Time (ms):_Total'),
+                            'counter'   : 'Locks:Average Wait Time (ms):_Total',
+                            'type'      : 'counter',
                             },
     
     'pagesplits'        : { 'help'      : 'Page Splits / Sec',
@@ -215,6 +260,22 @@ MODES     = {
                             'type'      : 'standard'
                             },
     
+    'waitstats'         : { 'help'      : 'Wait Time (ms) / Sec from sys.dm_os_wait_stats',
+                            'stdout'    : 'Wait Time / Sec is %sms',
+                            'label'     : 'wait_time',
+                            'unit'      : 'ms',
+                            'query'     : WAITSTATS_QUERY,
+                            'type'      : 'waitstats',
+                            },
+    
+    'querystats'        : { 'help'      : 'Highest CPU Time (ms) / Sec of a statement from sys.dm_exec_query_stats',
+                            'stdout'    : 'Highest statement CPU Time / Sec is %sms',
+                            'label'     : 'statement_cpu',
+                            'unit'      : 'ms',
+                            'query'     : QUERYSTATS_QUERY,
+                            'type'      : 'querystats',
+                            },
+    
     #~ 'debug'             : { 'help'      : 'Used as a debugging tool.',
                             #~ 'stdout'    : 'Debugging: ',
                             #~ 'label'     : 'debug',
@@ -228,22 +289,30 @@ MODES     = {
 
 }
 
-def return_nagios(options, stdout='', result='', unit='', label=''):
+STDOUT_PREFIX = {
+    0 : 'OK: ',
+    1 : 'WARNING: ',
+    2 : 'CRITICAL: ',
+    3 : 'UNKNOWN: ',
+}
+
+def get_nagios_output(options, stdout='', result='', unit='', label=''):
     if is_within_range(options.critical, result):
-        prefix = 'CRITICAL: '
         code = 2
     elif is_within_range(options.warning, result):
-        prefix = 'WARNING: '
         code = 1
     else:
-        prefix = 'OK: '
         code = 0
     strresult = str(result)
     try:
         stdout = stdout % (strresult)
     except TypeError, e:
         pass
-    stdout = '%s%s|%s=%s%s;%s;%s;;;' % (prefix, stdout, label, strresult, unit, options.warning or '', options.critical or '')
+    stdout = '%s%s|%s=%s%s;%s;%s;;;' % (STDOUT_PREFIX[code], stdout, label, strresult, unit, options.warning or '', options.critical or '')
+    return stdout, code
+
+def return_nagios(options, stdout='', result='', unit='', label=''):
+    stdout, code = get_nagios_output(options, stdout, result, unit, label)
     raise NagiosReturn(stdout, code)
 
 class NagiosReturn(Exception):
@@ -262,25 +331,37 @@ class MSSQLQuery(object):
         self.options = options
         self.host = host
         self.modifier = modifier
+        self.sample_time = None
     
     def run_on_connection(self, connection):
+        snapshot = get_cached_snapshot(connection, self.host, self.options.cache_ttl)
+        if snapshot is not None:
+            return self.run_on_snapshot(snapshot)
         cur = connection.cursor()
         cur.execute(self.query)
         self.query_result = cur.fetchone()[0]
     
+    def run_on_snapshot(self, snapshot):
+        self.sample_time = snapshot.taken
+        self.query_result = snapshot.execute(self.query)[0][0]
+    
+    def get_output(self):
+        return get_nagios_output(   self.options,
+                                    self.stdout,
+                                    self.result,
+                                    self.unit,
+                                    self.label )
+    
     def finish(self):
-        return_nagios(  self.options,
-                        self.stdout,
-                        self.result,
-                        self.unit,
-                        self.label )
+        stdout, code = self.options.timer.call('output', self.get_output)
+        raise NagiosReturn(stdout, code)
     
     def calculate_result(self):
         self.result = float(self.query_result) * self.modifier
     
     def do(self, connection):
-        self.run_on_connection(connection)
-        self.calculate_result()
+        self.options.timer.call('query', self.run_on_connection, connection)
+        self.options.timer.call('state', self.calculate_result)
         self.finish()
 
 class MSSQLDivideQuery(MSSQLQuery):
@@ -292,53 +373,165 @@ class MSSQLDivideQuery(MSSQLQuery):
         self.result = round((float(self.query_result[0]) / self.query_result[1]) * self.modifier, 2)
     
     def run_on_connection(self, connection):
+        snapshot = get_cached_snapshot(connection, self.host, self.options.cache_ttl)
+        if snapshot is not None:
+            return self.run_on_snapshot(snapshot)
         cur = connection.cursor()
         cur.execute(self.query)
         self.query_result = [x[0] for x in cur.fetchall()]
+    
+    def run_on_snapshot(self, snapshot):
+        self.sample_time = snapshot.taken
+        self.query_result = [x[0] for x in snapshot.execute(self.query)]
 
 class MSSQLDeltaQuery(MSSQLQuery):
     
-    def make_pickle_name(self):
-        tmpdir = tempfile.gettempdir()
-        tmpname = hash(self.host + self.query)
-        self.picklename = '%s/mssql-%s.tmp' % (tmpdir, tmpname)
+    def make_state_key(self):
+        #~ The query text names the counter and, for databases, the instance
+        return self.query
     
     def calculate_result(self):
-        self.make_pickle_name()
-        
-        try:
-            tmpfile = open(self.picklename)
-        except IOError:
-            tmpfile = open(self.picklename, 'w')
-            tmpfile.close()
-            tmpfile = open(self.picklename)
-        try:
-            try:
-                last_run = pickle.load(tmpfile)
-            except EOFError, ValueError:
-                last_run = { 'time' : None, 'value' : None }
-        finally:
-            tmpfile.close()
-        
-        if last_run['time']:
-            old_time = last_run['time']
-            new_time = time.time()
-            old_val  = last_run['query_result']
+        #~ A snapshot may come from the cache, so time the sample by when it was taken
+        new_time = self.sample_time or time.time()
+        if self.options.window:
+            self.calculate_window_result(new_time)
+            return
+        store = DeltaStateStore.for_host(self.host)
+        last_run = store.swap(self.make_state_key(), new_time, self.query_result)
+        self.calculate_delta(last_run, new_time)
+    
+    def calculate_delta(self, last_run, new_time):
+        #~ A counter that went backwards was reset by a server restart, wait for the next sample
+        if last_run and new_time > last_run[0] and self.query_result >= last_run[1]:
+            old_time, old_val = last_run
             new_val  = self.query_result
             self.result = round(((new_val - old_val) / (new_time - old_time)) * self.modifier, 2)
         else:
             self.result = None
-        
-        new_run = { 'time' : time.time(), 'query_result' : self.query_result }
-        
-        #~ Will throw IOError, leaving it to aquiesce
-        tmpfile = open(self.picklename, 'w')
-        pickle.dump(new_run, tmpfile)
-        tmpfile.close()
+    
+    def calculate_window_result(self, new_time):
+        history = SampleHistory.for_host(self.host)
+        samples = history.append(self.make_state_key(), new_time, self.query_result)
+        rate = aggregate(samples, new_time, self.options.window * 60, self.options.aggregate)
+        if rate is None:
+            self.result = None
+        else:
+            self.result = round(rate * self.modifier, 2)
 
-def parse_args():
+class MSSQLCounterQuery(MSSQLQuery):
+    
+    def __init__(self, *args, **kwargs):
+        super(MSSQLCounterQuery, self).__init__(*args, **kwargs)
+        self.counter = kwargs['counter']
+    
+    def run_on_connection(self, connection):
+        snapshot = get_cached_snapshot(connection, self.host, self.options.cache_ttl)
+        if snapshot is None:
+            snapshot = CounterSnapshot.fetch(connection, [self.query])
+        self.run_on_snapshot(snapshot)
+    
+    def run_on_snapshot(self, snapshot):
+        self.sample_time = snapshot.taken
+        self.query_result = read_counter(snapshot, self.counter)
+    
+    def calculate_result(self):
+        result = calculate_counter(self.query_result, self.host, self.sample_time, self.options.window, self.options.aggregate)
+        if self.query_result['cntr_type'] == PERF_LARGE_RAW_FRACTION and not self.unit:
+            self.unit = '%'
+        if result is None:
+            self.result = None
+        else:
+            self.result = round(result * self.modifier, 2)
+    
+    def do(self, connection):
+        try:
+            self.options.timer.call('query', self.run_on_connection, connection)
+        except ValueError, e:
+            raise NagiosReturn('%s%s' % (STDOUT_PREFIX[3], e), 3)
+        self.options.timer.call('state', self.calculate_result)
+        self.finish()
+
+class MSSQLWaitStatsQuery(MSSQLDeltaQuery):
+    
+    def __init__(self, *args, **kwargs):
+        super(MSSQLWaitStatsQuery, self).__init__(*args, **kwargs)
+        self.waits = None
+    
+    def run_on_connection(self, connection):
+        cur = connection.cursor()
+        cur.execute(self.query)
+        self.sample_time = time.time()
+        self.query_result = WaitStats.from_rows(cur.fetchall())
+    
+    def run_on_snapshot(self, snapshot):
+        raise ValueError('Wait statistics are not part of the counter snapshot.')
+    
+    def calculate_result(self):
+        #~ The whole snapshot is one compressed blob in the delta state store
+        store = DeltaStateStore.for_host(self.host)
+        last_run = store.swap(self.make_state_key(), self.sample_time, buffer(self.query_result.pack()))
+        self.calculate_delta(last_run, self.sample_time)
+    
+    def calculate_delta(self, last_run, new_time):
+        self.result = None
+        if not last_run or new_time <= last_run[0]:
+            return
+        #~ None when the statistics were cleared or the server restarted, wait for the next sample
+        self.waits = self.query_result.diff(WaitStats.unpack(last_run[1]), new_time - last_run[0])
+        if self.waits is not None:
+            self.result = round(self.waits.total(self.options.wait_category) * self.modifier, 2)
+    
+    def get_output(self):
+        stdout, code = super(MSSQLWaitStatsQuery, self).get_output()
+        if self.waits is None:
+            return stdout, code
+        stdout, perfdata = stdout.split('|', 1)
+        top = ['%s %.2fms' % (name, wait) for name, wait in self.waits.top(self.options.wait_top)]
+        signal_ratio = round(self.waits.signal_ratio(), 2)
+        stdout += ', signal waits are %s%%' % signal_ratio
+        if top:
+            stdout += '. Top waits: %s' % ', '.join(top)
+        perfdata += ' signal_wait_ratio=%s%%;;;0;100' % signal_ratio
+        categories = self.waits.by_category()
+        for category in CATEGORY_NAMES:
+            perfdata += ' wait_%s=%sms;;;;' % (category, round(categories[category], 2))
+        return '%s|%s' % (stdout, perfdata), code
+
+class MSSQLQueryStatsQuery(MSSQLQuery):
+    
+    def __init__(self, *args, **kwargs):
+        super(MSSQLQueryStatsQuery, self).__init__(*args, **kwargs)
+        self.scan = None
+    
+    def run_on_connection(self, connection):
+        #~ The rows are diffed while they are fetched, only the top statements are kept
+        self.scan = scan_query_stats(connection, self.host, self.options.query_top)
+    
+    def run_on_snapshot(self, snapshot):
+        raise ValueError('Query statistics are not part of the counter snapshot.')
+    
+    def calculate_result(self):
+        self.top = []
+        self.result = None
+        if self.scan is not None:
+            self.top = self.scan.get_top()
+            self.result = self.scan.get_highest()
+    
+    def get_output(self):
+        stdout, code = super(MSSQLQueryStatsQuery, self).get_output()
+        if self.scan is None:
+            return stdout, code
+        stdout, perfdata = stdout.split('|', 1)
+        if self.top:
+            stdout += '. Top statements: %s' % ', '.join(['%s %sms cpu, %s reads, %sms elapsed' % statement
+                                                          for statement in self.top])
+        cpu, reads, elapsed = self.scan.get_totals()
+        perfdata += ' total_cpu=%sms;;;; logical_reads=%s;;;; total_elapsed=%sms;;;; statements=%d;;;;' % (cpu, reads, elapsed, self.scan.count)
+        return '%s|%s' % (stdout, perfdata), code
+
+def parse_args(args=None, parser_class=OptionParser):
     usage = "usage: %prog -H hostname -U user -P password -T table --mode"
-    parser = OptionParser(usage=usage)
+    parser = parser_class(usage=usage)
     
     required = OptionGroup(parser, "Required Options")
     required.add_option('-H' , '--hostname', help='Specify MSSQL Server Address', default=None)
@@ -349,6 +542,12 @@ def parse_args():
     connection = OptionGroup(parser, "Optional Connection Information")
     connection.add_option('-I', '--instance', help='Specify instance', default=None)
     connection.add_option('-p', '--port', help='Specify port.', default=None)
+    connection.add_option('--cache-ttl', type='float', help='Share a counter snapshot of the host with other checks for this many seconds', default=0)
+    connection.add_option('--collector', help='Run the check through the mssql_collector.py listening on this socket', default=None)
+    connection.add_option('--login-timeout', type='int', help='Seconds before a login attempt is given up', default=60)
+    connection.add_option('--query-timeout', type='int', help='Seconds before a query is given up, 0 waits forever', default=0)
+    connection.add_option('--breaker-threshold', type='int', help='Failed logins in a row after which checks of the host fail at once, 0 disables', default=0)
+    connection.add_option('--breaker-cooldown', type='int', help='Seconds before a login is tried again once the breaker is open', default=60)
     parser.add_option_group(connection)
     
     nagios = OptionGroup(parser, "Nagios Plugin Information")
@@ -356,13 +555,91 @@ def parse_args():
     nagios.add_option('-c', '--critical', help='Specify critical range.', default=None)
     parser.add_option_group(nagios)
     
+    history = OptionGroup(parser, "History Options")
+    history.add_option('--window', type='float', metavar='MINUTES', help='Compute delta modes over the samples of the last MINUTES instead of the previous run only. %d samples are kept per counter, the window must fit in them at --check-interval' % CAPACITY, default=0)
+    history.add_option('--check-interval', type='float', metavar='SECONDS', help='Seconds between two runs of the check, to verify that --window fits in the samples kept', default=60)
+    history.add_option('--aggregate', type='choice', choices=AGGREGATES, help='How delta modes combine the samples in the window: %s' % ', '.join(AGGREGATES), default='rate')
+    history.add_option('--metrics-dir', help='Append the performance data of the check to the history in this directory, see mssql_metrics.py', default=None)
+    parser.add_option_group(history)
+    
+    debug = OptionGroup(parser, "Debug Options")
+    debug.add_option('--timing', action="store_true", help='Append the time spent in each phase of the check to the performance data', default=False)
+    debug.add_option('--trace', help='Append the time spent in each phase of the check to this JSON lines file', default=None)
+    debug.add_option('--record', help='Append the query results and result of the check to this file for mssql_replay.py, the snapshot cache is not used', default=None)
+    parser.add_option_group(debug)
+    
+    multi = OptionGroup(parser, "Multi-Mode Options")
+    multi.add_option('--multi', action="append", metavar="MODE[,WARNING[,CRITICAL]]",
+                     help='Evaluate this mode from a single counter snapshot. May be given several times.', default=None)
+    parser.add_option_group(multi)
+    
+    push = OptionGroup(parser, "Push Options")
+    push.add_option('--push', metavar='URL', help='Also send the performance data to graphite[+udp]://host[:port] or influx[+tcp]://host[:port]', default=None)
+    push.add_option('--push-prefix', help='Graphite path prefix or InfluxDB measurement', default='mssql')
+    push.add_option('--push-batch', type='int', metavar='BYTES', help='Send once this much is spooled for the sink', default=0)
+    push.add_option('--push-interval', type='float', metavar='SECONDS', help='Send once this long passed since the last send', default=0)
+    push.add_option('--push-buffer', type='int', metavar='BYTES', help='Newest data kept while the sink is down', default=8 * 1024 * 1024)
+    parser.add_option_group(push)
+    
+    batch = OptionGroup(parser, "Batch Options")
+    batch.add_option('--batch', help='Run the check specifications in this file (- for stdin) and print passive check results', default=None)
+    batch.add_option('--spool-dir', help='Write the batch results to this Nagios check result directory instead', default=None)
+    parser.add_option_group(batch)
+    
     mode = OptionGroup(parser, "Mode Options")
     global MODES
     for k, v in zip(MODES.keys(), MODES.values()):
         mode.add_option('--%s' % k, action="store_true", help=v.get('help'), default=False)
+    mode.add_option('--counter', metavar='OBJECT:COUNTER:INSTANCE', help='Any performance counter, evaluated according to its cntr_type', default=None)
     parser.add_option_group(mode)
-    options, _ = parser.parse_args()
     
+    waits = OptionGroup(parser, "Wait Statistics Options")
+    waits.add_option('--wait-top', type='int', metavar='N', help='Number of waits listed by --waitstats', default=5)
+    waits.add_option('--wait-category', type='choice', choices=CATEGORY_NAMES, action='append',
+                     help='Put the thresholds of --waitstats on the wait time of this category only: %s. May be given several times.' % ', '.join(CATEGORY_NAMES), default=None)
+    parser.add_option_group(waits)
+    
+    statements = OptionGroup(parser, "Query Statistics Options")
+    statements.add_option('--query-top', type='int', metavar='N', help='Number of statements listed by --querystats', default=5)
+    parser.add_option_group(statements)
+    options, _ = parser.parse_args(args)
+    options.timer = make_timer(options)
+    options.recorder = make_recorder(parser, options, PLUGIN_NAME, args)
+    
+    for nagstring in (options.warning, options.critical):
+        try:
+            parse_range(nagstring)
+        except ValueError, e:
+            parser.error(str(e))
+    
+    if options.window < 0:
+        parser.error('Window must not be negative.')
+    if options.check_interval <= 0:
+        parser.error('Check interval must be positive.')
+    if options.window * 60 / options.check_interval > CAPACITY - 1:
+        parser.error('A window of %s minutes needs more than the %d samples kept per counter at a check interval of %ss.'
+                     % (options.window, CAPACITY, options.check_interval))
+    if options.wait_top < 0:
+        parser.error('Wait top must not be negative.')
+    if options.query_top < 1:
+        parser.error('Query top must be at least 1.')
+    if options.login_timeout < 1 or options.query_timeout < 0 or options.breaker_threshold < 0:
+        parser.error('Timeouts and the breaker threshold must not be negative.')
+    if options.push:
+        try:
+            parse_sink(options.push)
+        except ValueError, e:
+            parser.error(str(e))
+    if options.record and (options.batch or options.collector):
+        parser.error('Record cannot be combined with --batch or --collector.')
+    if options.record:
+        #~ Every query of the check has to reach the server to be recorded
+        options.cache_ttl = 0
+    
+    if options.batch:
+        return options
+    if options.spool_dir:
+        parser.error('Spool directory can only be used with --batch.')
     if not options.hostname:
         parser.error('Hostname is a required option.')
     if not options.user:
@@ -380,25 +657,40 @@ def parse_args():
         elif getattr(options, arg.dest):
             options.mode = arg.dest
     
+    if options.counter:
+        try:
+            parse_counter(options.counter)
+        except ValueError, e:
+            parser.error(str(e))
+    
+    if options.multi and options.mode:
+        parser.error("Cannot combine --multi with a Mode Option.")
+    checks = []
+    for spec in options.multi or []:
+        fields = spec.split(',')
+        if len(fields) > 3:
+            parser.error("Invalid --multi specification: %s" % spec)
+        try:
+            if not COUNTER_QUERY_RE.match(get_mode(fields[0]).get('query', '')):
+                parser.error("Invalid --multi specification: %s" % spec)
+        except (KeyError, ValueError):
+            parser.error("Invalid --multi specification: %s" % spec)
+        fields += [''] * (3 - len(fields))
+        for nagstring in fields[1:]:
+            try:
+                parse_range(nagstring)
+            except ValueError, e:
+                parser.error(str(e))
+        checks.append((fields[0], fields[1] or None, fields[2] or None))
+    if checks:
+        options.multi = checks
+        options.mode = 'multi'
+    
     return options
 
 def is_within_range(nagstring, value):
-    if not nagstring:
-        return False
-    import re
-    import operator
-    first_float = r'(?P<first>(-?[0-9]+(\.[0-9]+)?))'
-    second_float= r'(?P<second>(-?[0-9]+(\.[0-9]+)?))'
-    actions = [ (r'^%s$' % first_float,lambda y: (value > float(y.group('first'))) or (value < 0)),
-                (r'^%s:$' % first_float,lambda y: value < float(y.group('first'))),
-                (r'^~:%s$' % first_float,lambda y: value > float(y.group('first'))),
-                (r'^%s:%s$' % (first_float,second_float), lambda y: (value < float(y.group('first'))) or (value > float(y.group('second')))),
-                (r'^@%s:%s$' % (first_float,second_float), lambda y: not((value < float(y.group('first'))) or (value > float(y.group('second')))))]
-    for regstr,func in actions:
-        res = re.match(regstr,nagstring)
-        if res: 
-            return func(res)
-    raise Exception('Improper warning/critical format.')
+    nagrange = parse_range(nagstring)
+    return nagrange is not None and nagrange.is_alert(value)
 
 def connect_db(options):
     host = options.hostname
@@ -406,19 +698,66 @@ def connect_db(options):
         host += "\\" + options.instance
     elif options.port:
         host += ":" + options.port
+    breaker = get_breaker(host, options)
+    if breaker is not None:
+        wait = breaker.allow()
+        if wait is not None:
+            raise pymssql.InterfaceError('Circuit breaker open for %s after repeated login failures, next attempt in %ds.' % (host, wait))
     start = time.time()
-    mssql = pymssql.connect(host = host, user = options.user, password = options.password, database='master')
+    try:
+        mssql = pymssql.connect(host = host, user = options.user, password = options.password, database='master',
+                                login_timeout = options.login_timeout, timeout = options.query_timeout)
+    except (pymssql.OperationalError, pymssql.InterfaceError):
+        if breaker is not None:
+            breaker.failure()
+        raise
+    if breaker is not None:
+        breaker.success()
     total = time.time() - start
-    return mssql, total, host
+    record_connect(options, host, total)
+    return record_connection(options, mssql), total, host
 
 def main():
     options = parse_args()
     
-    mssql, total, host = connect_db(options)
+    if options.batch:
+        submitted = run_batch(sys.modules[__name__], options, sys.argv[1:])
+        if options.spool_dir:
+            raise NagiosReturn('%s%d check result(s) written to %s' % (STDOUT_PREFIX[0], submitted, options.spool_dir), 0)
+        return
     
+    if options.collector and options.mode != 'test':
+        run_on_collector(options, sys.argv[1:])
+    
+    mssql, total, host = connect_db(options)
+    run_check(mssql, options, host, total)
+
+def run_on_collector(options, args):
+    #~ Falls through to the direct path when the collector cannot be reached
+    try:
+        stdout, code = request_check(options.collector, PLUGIN_NAME, args)
+    except (socket.error, ValueError, KeyError):
+        return
+    raise NagiosReturn(stdout, code)
+
+def run_check(mssql, options, host, total):
+    options.timer.add('connect', total)
+    try:
+        dispatch_check(mssql, options, host, total)
+    except NagiosReturn, e:
+        report_timing(options, PLUGIN_NAME, host, e)
+        push_result(options, PLUGIN_NAME, host, e)
+        record_result(options, e)
+        store_result(options, host, e)
+        raise
+
+def dispatch_check(mssql, options, host, total):
     if options.mode =='test':
         run_tests(mssql, options, host)
         
+    elif options.mode == 'multi':
+        run_multi_check(mssql, options, host)
+        
     elif not options.mode or options.mode == 'time2connect':
         return_nagios(  options,
                         stdout='Time to connect was %ss',
@@ -429,19 +768,96 @@ def main():
     else:
         execute_query(mssql, options, host)
 
-def execute_query(mssql, options, host=''):
-    sql_query = MODES[options.mode]
+def get_mode(mode, counter=None):
+    #~ A mode name, or a counter given as object:counter:instance (--counter, --multi)
+    if mode == 'counter':
+        mode = counter
+    if mode in MODES:
+        return MODES[mode]
+    if ':' not in mode:
+        raise KeyError(mode)
+    return { 'help'      : mode,
+             'stdout'    : '%s is %%s' % parse_counter(mode)[1],
+             'label'     : make_label(mode),
+             'query'     : counter_query(mode),
+             'counter'   : mode,
+             'type'      : 'counter',
+             }
+
+def make_query(options, host=''):
+    sql_query = dict(get_mode(options.mode, options.counter))
     sql_query['options'] = options
     sql_query['host'] = host
     query_type = sql_query.get('type')
     if query_type == 'delta':
-        mssql_query = MSSQLDeltaQuery(**sql_query)
+        return MSSQLDeltaQuery(**sql_query)
     elif query_type == 'divide':
-        mssql_query = MSSQLDivideQuery(**sql_query)
+        return MSSQLDivideQuery(**sql_query)
+    elif query_type == 'counter':
+        return MSSQLCounterQuery(**sql_query)
+    elif query_type == 'waitstats':
+        return MSSQLWaitStatsQuery(**sql_query)
+    elif query_type == 'querystats':
+        return MSSQLQueryStatsQuery(**sql_query)
     else:
-        mssql_query = MSSQLQuery(**sql_query)
+        return MSSQLQuery(**sql_query)
+
+def execute_query(mssql, options, host=''):
+    mssql_query = make_query(options, host)
     mssql_query.do(mssql)
 
+def run_multi_check(mssql, options, host=''):
+    timer = options.timer
+    snapshot = timer.call('query', get_cached_snapshot, mssql, host, options.cache_ttl)
+    if snapshot is None:
+        snapshot = timer.call('query', CounterSnapshot.fetch, mssql, [get_mode(mode)['query'] for mode, warning, critical in options.multi])
+    results = []
+    for mode, warning, critical in options.multi:
+        mode_options = copy.copy(options)
+        mode_options.mode = mode
+        mode_options.warning = warning
+        mode_options.critical = critical
+        try:
+            mssql_query = make_query(mode_options, host)
+            timer.call('query', mssql_query.run_on_snapshot, snapshot)
+            timer.call('state', mssql_query.calculate_result)
+            stdout, code = timer.call('output', mssql_query.get_output)
+        except (IndexError, ValueError, TypeError, ZeroDivisionError), e:
+            stdout, code = '%s%s failed with: %s' % (STDOUT_PREFIX[3], mode, e), 3
+        results.append((mode, stdout, code))
+    
+    stdout, code = timer.call('output', get_multimode_check_output, results)
+    raise NagiosReturn(stdout, code)
+
+def get_multimode_check_output(results):
+    states = { 0 : [], 1 : [], 2 : [], 3 : [] }
+    perfdata_output = []
+    details = []
+    for mode, stdout, code in results:
+        states[code].append(mode)
+        if '|' in stdout:
+            stdout, perfdata = stdout.split('|', 1)
+            perfdata_output.append(perfdata)
+        details.append(stdout)
+    
+    stdout = "%d mode(s) checked." % len(results)
+    for code, state in [(2, 'a critical'), (1, 'a warning'), (3, 'an unknown')]:
+        if states[code]:
+            stdout += " %d in %s state (%s)." % (len(states[code]), state, ", ".join(states[code]))
+    
+    if states[2]:
+        code = 2
+    elif states[1]:
+        code = 1
+    elif states[3]:
+        code = 3
+    else:
+        code = 0
+    stdout = STDOUT_PREFIX[code] + stdout
+    if perfdata_output:
+        stdout += "|" + " ".join(perfdata_output)
+    return "\n".join([stdout] + details), code
+
 def run_tests(mssql, options, host):
     failed = 0
     total  = 0
@@ -0,0 +1,111 @@
+########################################################################
+# mssql_aggregate.py
+# Used by check_mssql_database.py
+# Licence : GPL - http://www.fsf.org/licenses/gpl.txt
+#
+# Fixed size summary of a mode over any number of databases (--top N):
+# count, sum, min, max, approximate percentiles from a log scaled
+# histogram (within ACCURACY of the true value), the number of databases
+# per state and a heap of the N worst databases. Results are added one
+# at a time and never kept, so output and memory stay bounded however
+# many databases the server has.
+########################################################################
+
+import math
+import heapq
+
+ACCURACY = 0.01
+PERCENTILES = [50, 90, 99]
+
+#~ Order in which states are worse, as in check_mssql_fleet.py
+SEVERITY = { 0 : 0, 3 : 1, 1 : 2, 2 : 3 }
+
+LOG_BASE = math.log(1 + 2 * ACCURACY)
+
+def get_direction(warning, critical):
+    #~ -1 when low values are bad (thresholds like 95: ), 1 when high values are
+    for nagstring in (critical, warning):
+        if nagstring and nagstring.rstrip().endswith(':') and not nagstring.startswith('@'):
+            return -1
+    return 1
+
+class ResultAggregate(object):
+
+    def __init__(self, top, direction=1):
+        self.top = top
+        self.direction = direction
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        self.states = { 0 : 0, 1 : 0, 2 : 0, 3 : 0 }
+        self.buckets = {}
+        self.worst = []
+        self.added = 0
+
+    def add(self, name, value, code, extra=None):
+        self.states[code] += 1
+        if value is not None:
+            self.count += 1
+            self.sum += value
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+            bucket = self.get_bucket(value)
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        #~ Ties keep the database added first, added is a tie breaker that never compares names
+        self.added += 1
+        if value is None:
+            rank = (SEVERITY[code], False, 0, -self.added)
+        else:
+            rank = (SEVERITY[code], True, value * self.direction, -self.added)
+        entry = (rank, name, value, code, extra)
+        if len(self.worst) < self.top:
+            heapq.heappush(self.worst, entry)
+        elif entry > self.worst[0]:
+            heapq.heapreplace(self.worst, entry)
+
+    def get_bucket(self, value):
+        if value == 0:
+            return 0
+        index = int(math.ceil(math.log(abs(value)) / LOG_BASE))
+        if value < 0:
+            return (-1, -index)
+        return (1, index)
+
+    def get_bucket_value(self, bucket):
+        if bucket == 0:
+            return 0.0
+        sign, index = bucket
+        #~ The middle of the bucket, off from any value in it by at most ACCURACY
+        return sign * math.exp((sign * index - 0.5) * LOG_BASE)
+
+    def percentile(self, percent):
+        if not self.count:
+            return None
+        rank = max(1, int(math.ceil(self.count * percent / 100.0)))
+        seen = 0
+        for bucket in sorted(self.buckets.keys(), key=self.get_bucket_value):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(max(self.get_bucket_value(bucket), self.min), self.max)
+        return self.max
+
+    def average(self):
+        if not self.count:
+            return None
+        return self.sum / self.count
+
+    def get_worst(self):
+        return [(name, value, code, extra) for rank, name, value, code, extra in sorted(self.worst, reverse=True)]
+
+    def get_statistics(self):
+        statistics = [('min', self.min), ('max', self.max), ('avg', self.average())]
+        statistics += [('p%d' % percent, self.percentile(percent)) for percent in PERCENTILES]
+        rounded = []
+        for name, value in statistics:
+            if value is not None:
+                value = round(value, 2)
+            rounded.append((name, value))
+        return rounded
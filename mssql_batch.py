@@ -0,0 +1,201 @@
+########################################################################
+# mssql_batch.py
+# Shared by check_mssql_server.py and check_mssql_database.py
+# Licence : GPL - http://www.fsf.org/licenses/gpl.txt
+#
+# Runs many check specifications in one process (--batch FILE, or - for
+# stdin) and submits them as passive check results. One spec per line:
+#
+#   nagios_host  service_description  plugin options...
+#   sql01  "MSSQL Page Life"  -H sql01.example.com --pagelife -w 300: -c 100:
+#
+# Options given on the command line next to --batch (e.g. -U, -P,
+# --cache-ttl) apply to every spec. Connections are reused between specs
+# for the same host and credentials.
+########################################################################
+
+import os
+import sys
+import time
+import shlex
+import tempfile
+import pymssql
+from optparse import OptionParser
+
+COMMAND_FORMAT = "[%d] PROCESS_SERVICE_CHECK_RESULT;%s;%s;%d;%s\n"
+
+CHECKRESULT_FORMAT = """### Passive Check Result File ###
+file_time=%(time)d
+
+### Nagios Service Check Result ###
+host_name=%(host_name)s
+service_description=%(service_description)s
+check_type=1
+check_options=0
+scheduled_check=0
+reschedule_check=0
+latency=0
+start_time=%(start_time)f
+finish_time=%(finish_time)f
+early_timeout=0
+exited_ok=1
+return_code=%(code)d
+output=%(output)s
+"""
+
+BATCH_OPTIONS = ['--batch', '--spool-dir']
+
+def strip_options(args, names):
+    stripped = []
+    skip = False
+    for arg in args:
+        if skip:
+            skip = False
+        elif arg in names:
+            skip = True
+        elif arg.split('=', 1)[0] not in names:
+            stripped.append(arg)
+    return stripped
+
+def read_specs(filename):
+    if filename == '-':
+        specfile = sys.stdin
+    else:
+        specfile = open(filename)
+    try:
+        for line in specfile:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = shlex.split(line)
+            if len(fields) < 3:
+                raise ValueError('Invalid batch specification: %s' % line)
+            yield fields[0], fields[1], fields[2:]
+    finally:
+        if specfile is not sys.stdin:
+            specfile.close()
+
+def escape_output(stdout):
+    return stdout.replace('\\', '\\\\').replace('\n', '\\n')
+
+def write_command(output, result):
+    output.write(COMMAND_FORMAT % (result['time'], result['host_name'], result['service_description'],
+                                   result['code'], escape_output(result['output'])))
+
+def write_checkresult(spool_dir, result):
+    fd, name = tempfile.mkstemp(prefix='c', dir=spool_dir)
+    resultfile = os.fdopen(fd, 'w')
+    try:
+        resultfile.write(CHECKRESULT_FORMAT % dict(result, output=escape_output(result['output'])))
+    finally:
+        resultfile.close()
+    #~ Nagios only reads a result file once its .ok marker exists
+    open(name + '.ok', 'w').close()
+
+class ConnectionCache(object):
+
+    def __init__(self, plugin):
+        self.plugin = plugin
+        self.connections = {}
+        self.failures = {}
+
+    def make_key(self, options):
+        return (options.hostname, options.instance, options.port, options.user, options.password)
+
+    def get(self, options, fresh=False):
+        #~ Raises the original error again for hosts that already failed to connect in this batch.
+        #~ A fresh login replaces the cached one, for modes reporting the time it took.
+        key = self.make_key(options)
+        if key in self.failures:
+            raise self.failures[key]
+        if fresh:
+            self.discard(options)
+        if key not in self.connections:
+            try:
+                self.connections[key] = self.plugin.connect_db(options)
+            except (pymssql.OperationalError, pymssql.InterfaceError), e:
+                self.failures[key] = e
+                raise
+        return self.connections[key]
+
+    def discard(self, options):
+        mssql = self.connections.pop(self.make_key(options), (None,))[0]
+        if mssql is not None:
+            mssql.close()
+
+    def close(self):
+        for mssql, total, host in self.connections.values():
+            mssql.close()
+        self.connections = {}
+
+class SpecError(Exception):
+    pass
+
+class SpecParser(OptionParser):
+    #~ Parses the options of a spec without printing or exiting, stdout carries the results
+
+    def error(self, msg):
+        raise SpecError(msg)
+
+    def exit(self, status=0, msg=None):
+        raise SpecError(msg or 'exited')
+
+    def print_help(self, file=None):
+        raise SpecError('--help cannot be used in a batch')
+
+    def print_usage(self, file=None):
+        raise SpecError('--help cannot be used in a batch')
+
+    def print_version(self, file=None):
+        raise SpecError('--version cannot be used in a batch')
+
+def run_spec(plugin, connections, base_args, args):
+    unknown = plugin.STDOUT_PREFIX[3]
+    try:
+        options = plugin.parse_args(base_args + args, SpecParser)
+    except SpecError, e:
+        return 3, '%sInvalid plugin options: %s' % (unknown, str(e).strip())
+    options.collector = None
+    if options.mode == 'test' or getattr(options, 'list_databases', False):
+        return 3, '%sMode cannot be run in a batch.' % unknown
+    #~ The login time is the result of these modes, it must not be that of an earlier spec
+    fresh = not options.mode or options.mode == 'time2connect'
+    try:
+        mssql, total, host = connections.get(options, fresh)
+    except (pymssql.OperationalError, pymssql.InterfaceError), e:
+        return 3, '%s%s' % (unknown, e)
+    try:
+        plugin.run_check(mssql, options, host, total)
+    except plugin.NagiosReturn, e:
+        return e.code, e.message
+    except (pymssql.OperationalError, pymssql.InterfaceError), e:
+        #~ The connection may be unusable, the next spec for this host logs in again
+        connections.discard(options)
+        return 3, '%s%s' % (unknown, e)
+    except Exception, e:
+        return 3, '%sCaught unexpected error: %s' % (unknown, e)
+    return 3, '%sCheck returned no result.' % unknown
+
+def run_batch(plugin, options, args, output=sys.stdout):
+    base_args = strip_options(args, BATCH_OPTIONS)
+    connections = ConnectionCache(plugin)
+    submitted = 0
+    try:
+        for host_name, service_description, spec_args in read_specs(options.batch):
+            start_time = time.time()
+            code, stdout = run_spec(plugin, connections, base_args, spec_args)
+            result = { 'time'                : int(start_time),
+                       'host_name'           : host_name,
+                       'service_description' : service_description,
+                       'start_time'          : start_time,
+                       'finish_time'         : time.time(),
+                       'code'                : code,
+                       'output'              : stdout }
+            if options.spool_dir:
+                write_checkresult(options.spool_dir, result)
+            else:
+                write_command(output, result)
+            submitted += 1
+    finally:
+        connections.close()
+    return submitted
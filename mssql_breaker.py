@@ -0,0 +1,93 @@
+########################################################################
+# mssql_breaker.py
+# Shared by check_mssql_server.py and check_mssql_database.py
+# Licence : GPL - http://www.fsf.org/licenses/gpl.txt
+#
+# Circuit breaker per host, shared by every check process on the poller
+# through a small state file. After --breaker-threshold consecutive
+# failed logins the breaker opens and checks of the host fail at once
+# instead of waiting for their login timeout. Once --breaker-cooldown
+# seconds passed, one check at a time is let through to probe the host;
+# a successful login closes the breaker again.
+########################################################################
+
+import time
+import fcntl
+from mssql_state import make_state_path
+
+class HostBreaker(object):
+
+    def __init__(self, host, threshold, cooldown, probe_timeout=60):
+        self.host = host
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.probe_timeout = probe_timeout
+        self.path = make_state_path(host, 'mssql-breaker', 'state')
+
+    def parse(self, statefile):
+        statefile.seek(0)
+        try:
+            failures, opened, probing = [float(x) for x in statefile.read().split()]
+        except ValueError:
+            return 0, 0, 0
+        return int(failures), opened, probing
+
+    def read(self):
+        #~ Under a shared lock, checks that only look do not wait on each other
+        try:
+            statefile = open(self.path, 'r')
+        except IOError:
+            return 0, 0, 0
+        try:
+            fcntl.flock(statefile.fileno(), fcntl.LOCK_SH)
+            return self.parse(statefile)
+        finally:
+            statefile.close()
+
+    def update(self, change):
+        #~ Runs change(state) under the lock and stores the state it returns if it differs
+        statefile = open(self.path, 'a+')
+        try:
+            fcntl.flock(statefile.fileno(), fcntl.LOCK_EX)
+            failures, opened, probing = self.parse(statefile)
+            state, result = change(failures, opened, probing, time.time())
+            if state != (failures, opened, probing):
+                statefile.seek(0)
+                statefile.truncate()
+                statefile.write('%d %f %f\n' % state)
+            return result
+        finally:
+            statefile.close()
+
+    def allow(self):
+        #~ Returns None when a login may be tried, or the seconds until the next probe
+        def change(failures, opened, probing, now):
+            if failures < self.threshold:
+                return (failures, opened, probing), None
+            if now - opened < self.cooldown:
+                return (failures, opened, probing), opened + self.cooldown - now
+            #~ Half open, one probe at a time until it reports back or is given up on
+            if now - probing < self.probe_timeout:
+                return (failures, opened, probing), probing + self.probe_timeout - now
+            return (failures, opened, now), None
+        return self.update(change)
+
+    def success(self):
+        #~ Every successful login ends here, the file is only rewritten when there is something to reset
+        if self.read() == (0, 0, 0):
+            return None
+        return self.update(lambda failures, opened, probing, now: ((0, 0, 0), None))
+
+    def failure(self):
+        def change(failures, opened, probing, now):
+            failures += 1
+            if failures >= self.threshold:
+                return (failures, now, 0), None
+            return (failures, opened, 0), None
+        return self.update(change)
+
+def get_breaker(host, options):
+    if not options.breaker_threshold:
+        return None
+    return HostBreaker(host, options.breaker_threshold, options.breaker_cooldown,
+                       max(options.login_timeout, options.breaker_cooldown))
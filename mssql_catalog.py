@@ -0,0 +1,100 @@
+########################################################################
+# mssql_catalog.py
+# Used by check_mssql_database.py
+# Licence : GPL - http://www.fsf.org/licenses/gpl.txt
+#
+# Database catalog of a host read from sys.databases, with the state,
+# recovery model and read-only flag of every database. Databases that
+# cannot report counters (offline, restoring, recovering, suspect,
+# snapshots) are left out of the all-database path before any work
+# starts. With --catalog-ttl the catalog is shared between the checks
+# of the host for that many seconds.
+########################################################################
+
+import re
+import time
+from mssql_state import make_state_path, read_cache, write_cache
+
+CATALOG_QUERY = "SELECT name, state_desc, recovery_model_desc, is_read_only, source_database_id FROM sys.databases;"
+
+USABLE_STATES = ['ONLINE']
+
+class DatabaseCatalog(object):
+
+    def __init__(self, rows, taken=None):
+        self.taken = taken or time.time()
+        self.rows = rows
+        self.databases = []
+        self.usable = []
+        for name, state, recovery_model, read_only, source_database_id in rows:
+            database = { 'name'           : name,
+                         'state'          : state,
+                         'recovery_model' : recovery_model,
+                         'read_only'      : bool(read_only),
+                         'snapshot'       : source_database_id is not None }
+            self.databases.append(database)
+            if state in USABLE_STATES and not database['snapshot']:
+                self.usable.append(name)
+        #~ Keys the filter results, catalogs with the same usable databases share them
+        self.version = tuple(self.usable)
+
+    def fetch(cls, connection):
+        cur = connection.cursor()
+        cur.execute(CATALOG_QUERY)
+        return cls([tuple(row) for row in cur.fetchall()])
+    fetch = classmethod(fetch)
+
+class CatalogCache(object):
+
+    def __init__(self, host, ttl):
+        self.ttl = ttl
+        self.path = make_state_path(host, 'mssql-catalog', 'cache')
+
+    def read(self):
+        cached = read_cache(self.path)
+        if cached is None:
+            return None
+        taken, rows = cached
+        if not 0 <= time.time() - taken < self.ttl:
+            return None
+        return DatabaseCatalog(rows, taken)
+
+    def write(self, catalog):
+        write_cache(self.path, (catalog.taken, catalog.rows))
+
+    def get(self, connection):
+        catalog = self.read()
+        if catalog is None:
+            catalog = DatabaseCatalog.fetch(connection)
+            self.write(catalog)
+        return catalog
+
+def get_catalog(connection, host, ttl):
+    if not ttl:
+        return DatabaseCatalog.fetch(connection)
+    return CatalogCache(host, ttl).get(connection)
+
+#~ Bounded, a long running collector sees a new catalog version now and then
+MAX_FILTERED = 64
+
+_regexes = {}
+_filtered = {}
+
+def compile_filter(regex_string, case_sensitive):
+    key = (regex_string, case_sensitive)
+    if key not in _regexes:
+        if case_sensitive:
+            _regexes[key] = re.compile(regex_string)
+        else:
+            _regexes[key] = re.compile(regex_string, re.IGNORECASE)
+    return _regexes[key]
+
+def filter_catalog(catalog, regex_string, case_sensitive, invert):
+    #~ Results are kept per filter and catalog version for processes running many checks
+    key = (regex_string, case_sensitive, invert, catalog.version)
+    if key not in _filtered:
+        if len(_filtered) >= MAX_FILTERED:
+            _filtered.clear()
+        regex = compile_filter(regex_string, case_sensitive)
+        _filtered[key] = [x for x in catalog.usable if bool(regex.match(x)) != invert]
+    return _filtered[key]
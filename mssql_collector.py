@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+########################################################################
+# mssql_collector.py
+# Licence : GPL - http://www.fsf.org/licenses/gpl.txt
+#
+# Resident collector for check_mssql_server.py and check_mssql_database.py.
+# Keeps a pool of authenticated connections per host/instance/port and
+# serves checks over a Unix domain socket, so the plugins (run with
+# --collector SOCKET) skip the interpreter start up cost of logging in.
+# The plugins fall back to connecting directly when the collector is down.
+#
+# usage: mssql_collector.py -s /var/run/mssql_collector.sock
+########################################################################
+
+import os
+import sys
+import time
+import socket
+import signal
+import threading
+import pymssql
+try:
+    import json
+except ImportError:
+    import simplejson as json
+from optparse import OptionParser
+
+DEFAULT_TIMEOUT = 30
+
+UNKNOWN_ERROR = "UNKNOWN: Caught unexpected error in the collector: %s"
+
+def request_check(path, plugin, args, timeout=DEFAULT_TIMEOUT):
+    #~ Raises socket.error when the collector is unavailable and ValueError on a bad reply
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+        sock.sendall(json.dumps({ 'plugin' : plugin, 'args' : args }) + '\n')
+        response = sock.makefile('rb').readline()
+    finally:
+        sock.close()
+    response = json.loads(response)
+    return response['message'], response['code']
+
+class ConnectionPool(object):
+
+    def __init__(self, max_idle=4, idle_timeout=300):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def make_key(self, options):
+        return (options.hostname, options.instance, options.port, options.user,
+                options.password, getattr(options, 'database', None))
+
+    def acquire(self, key, plugin, options, fresh=False):
+        expired = []
+        found = None
+        now = time.time()
+        self.lock.acquire()
+        try:
+            connections = self.idle.get(key, [])
+            while connections and not fresh:
+                entry = connections.pop()
+                if now - entry[3] > self.idle_timeout:
+                    expired.append(entry[0])
+                else:
+                    found = entry
+                    break
+        finally:
+            self.lock.release()
+        for mssql in expired:
+            self.discard(mssql)
+        if found:
+            return found[0], found[1], found[2], True
+        mssql, total, host = plugin.connect_db(options)
+        return mssql, total, host, False
+
+    def release(self, key, mssql, total, host):
+        self.lock.acquire()
+        try:
+            connections = self.idle.setdefault(key, [])
+            if len(connections) < self.max_idle:
+                connections.append((mssql, total, host, time.time()))
+                mssql = None
+        finally:
+            self.lock.release()
+        if mssql is not None:
+            self.discard(mssql)
+
+    def discard(self, mssql):
+        try:
+            mssql.close()
+        except Exception:
+            pass
+
+class Collector(object):
+
+    def __init__(self, plugins, pool):
+        self.plugins = plugins
+        self.pool = pool
+
+    def run(self, plugin_name, args):
+        plugin = self.plugins.get(plugin_name)
+        if plugin is None:
+            return 'UNKNOWN: Collector does not serve plugin %s' % plugin_name, 3
+        try:
+            options = plugin.parse_args(args)
+        except SystemExit:
+            return 'UNKNOWN: Collector rejected the arguments.', 3
+        options.collector = None
+        if options.mode == 'test' or getattr(options, 'list_databases', False):
+            return 'UNKNOWN: Mode is not served by the collector.', 3
+        fresh = not options.mode or options.mode == 'time2connect'
+        #~ Taken up front, the database plugin rewrites options.database while it runs
+        key = self.pool.make_key(options)
+
+        for attempt in (0, 1):
+            try:
+                mssql, total, host, reused = self.pool.acquire(key, plugin, options, fresh)
+            except (pymssql.OperationalError, pymssql.InterfaceError), e:
+                #~ Answered here, the plugin would only pay the login timeout again on its own
+                return str(e), 3
+            try:
+                plugin.run_check(mssql, options, host, total)
+            except plugin.NagiosReturn, e:
+                self.pool.release(key, mssql, total, host)
+                return e.message, e.code
+            except (pymssql.OperationalError, pymssql.InterfaceError), e:
+                self.pool.discard(mssql)
+                #~ A pooled connection may have gone stale, retry once on a new login
+                if reused and attempt == 0:
+                    continue
+                return str(e), 3
+            except Exception, e:
+                self.pool.discard(mssql)
+                return UNKNOWN_ERROR % e, 3
+            self.pool.release(key, mssql, total, host)
+            return UNKNOWN_ERROR % 'check returned no result', 3
+
+def make_handler(collector):
+    import SocketServer
+
+    class CollectorHandler(SocketServer.StreamRequestHandler):
+
+        def handle(self):
+            try:
+                request = json.loads(self.rfile.readline())
+                message, code = collector.run(request['plugin'], request['args'])
+            except (ValueError, KeyError, TypeError), e:
+                message, code = 'UNKNOWN: Invalid collector request: %s' % e, 3
+            self.wfile.write(json.dumps({ 'message' : message, 'code' : code }) + '\n')
+
+    return CollectorHandler
+
+def parse_args():
+    usage = "usage: %prog -s socket"
+    parser = OptionParser(usage=usage)
+    parser.add_option('-s', '--socket', help='Unix domain socket to listen on', default=None)
+    parser.add_option('--max-idle', type='int', help='Idle connections kept per host/instance/port', default=4)
+    parser.add_option('--idle-timeout', type='int', help='Seconds before an idle connection is closed', default=300)
+    options, _ = parser.parse_args()
+    if not options.socket:
+        parser.error('Socket is a required option.')
+    return options
+
+def main():
+    import SocketServer
+    import check_mssql_server
+    import check_mssql_database
+
+    options = parse_args()
+    collector = Collector({ 'server'   : check_mssql_server,
+                            'database' : check_mssql_database },
+                          ConnectionPool(options.max_idle, options.idle_timeout))
+
+    if os.path.exists(options.socket):
+        os.unlink(options.socket)
+    old_umask = os.umask(0177)
+    try:
+        server = SocketServer.ThreadingUnixStreamServer(options.socket, make_handler(collector))
+    finally:
+        os.umask(old_umask)
+    server.daemon_threads = True
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(options.socket)
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        sys.exit(0)
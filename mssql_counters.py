@@ -0,0 +1,123 @@
+########################################################################
+# mssql_counters.py
+# Used by check_mssql_server.py
+# Licence : GPL - http://www.fsf.org/licenses/gpl.txt
+#
+# Evaluates any performance counter (--counter "object:counter:instance")
+# the way perfmon would, from its cntr_type in a counter snapshot:
+#
+#   PERF_COUNTER_LARGE_RAWCOUNT  the value as is
+#   PERF_COUNTER_BULK_COUNT      change of the value per second
+#   PERF_LARGE_RAW_FRACTION      value / base * 100
+#   PERF_AVERAGE_BULK            change of the value / change of the base
+#
+# The base counter sits next to its counter in the same snapshot, so it
+# never costs a query of its own.
+#
+# Only the object name may hold a ':' after its server prefix (SQLServer:
+# or MSSQL$INSTANCE:), counter names never do, so anything after the
+# counter name is the instance, colons included.
+########################################################################
+
+import re
+from mssql_snapshot import normalize, quote
+from mssql_state import DeltaStateStore
+from mssql_history import SampleHistory, aggregate, get_increase
+
+PERF_COUNTER_LARGE_RAWCOUNT = 65792
+PERF_COUNTER_BULK_COUNT     = 272696576
+PERF_LARGE_RAW_FRACTION     = 537003264
+PERF_AVERAGE_BULK           = 1073874176
+PERF_LARGE_RAW_BASE         = 1073939712
+
+SERVER_PREFIX_RE = re.compile(r'^(?:SQLServer|SQLAgent|MSSQL\$[^:]*|SQLAgent\$[^:]*)$', re.IGNORECASE)
+
+COUNTER_QUERY = "SELECT cntr_value FROM sys.dm_os_performance_counters WHERE counter_name LIKE '%s%%' AND instance_name='%s';"
+
+def parse_counter(spec):
+    #~ The object name may carry the server prefix ('SQLServer:Locks'), the instance may hold colons
+    fields = spec.split(':')
+    if SERVER_PREFIX_RE.match(fields[0].strip()):
+        fields[:2] = [':'.join(fields[:2])]
+    if len(fields) < 3 or not fields[0].strip() or not fields[1].strip():
+        raise ValueError('Invalid counter, expected "object:counter:instance": %s' % spec)
+    return fields[0].strip(), fields[1].strip(), ':'.join(fields[2:]).strip()
+
+def get_stem(counter_name):
+    #~ 'Average Wait Time (ms)' has its base in 'Average Wait Time Base'
+    return re.sub(r'\s*\([^)]*\)$', '', counter_name)
+
+def counter_query(spec):
+    #~ Selects the counter and its base, used to restrict the snapshot to them
+    object_name, counter_name, instance_name = parse_counter(spec)
+    return COUNTER_QUERY % (quote(get_stem(counter_name)), quote(instance_name))
+
+def make_label(spec):
+    object_name, counter_name, instance_name = parse_counter(spec)
+    return re.sub(r'[^a-z0-9]+', '_', normalize('%s %s' % (counter_name, instance_name))).strip('_')
+
+def read_counter(snapshot, spec):
+    #~ Returns the sample of the counter (and its base) as { key, value, base, cntr_type }
+    object_name, counter_name, instance_name = parse_counter(spec)
+    try:
+        key, (value, cntr_type) = snapshot.find(object_name, counter_name, instance_name)
+    except KeyError:
+        raise ValueError('Counter not found: %s' % spec)
+    sample = { 'key' : ':'.join(key), 'value' : value, 'base' : None, 'cntr_type' : cntr_type }
+    if cntr_type in (PERF_LARGE_RAW_FRACTION, PERF_AVERAGE_BULK):
+        for base_name in (counter_name + ' base', get_stem(counter_name) + ' base'):
+            try:
+                base_key, (base, base_type) = snapshot.find(key[0], base_name, key[2])
+            except KeyError:
+                continue
+            sample['base'] = base
+            break
+        else:
+            raise ValueError('Base counter not found: %s' % spec)
+    return sample
+
+def calculate_counter(sample, host, sample_time, window=0, function='rate'):
+    #~ None until a counter needing a delta has two samples, or after it was reset
+    cntr_type = sample['cntr_type']
+    value, base = sample['value'], sample['base']
+    if cntr_type == PERF_LARGE_RAW_FRACTION:
+        if not base:
+            return None
+        return float(value) / base * 100
+    if cntr_type == PERF_COUNTER_BULK_COUNT:
+        return calculate_rate(sample['key'], host, sample_time, value, window, function)
+    if cntr_type == PERF_AVERAGE_BULK:
+        return calculate_average(sample['key'], host, sample_time, value, base, window)
+    return float(value)
+
+def calculate_rate(key, host, sample_time, value, window, function):
+    key = 'counter:' + key
+    if window:
+        samples = SampleHistory.for_host(host).append(key, sample_time, value)
+        return aggregate(samples, sample_time, window * 60, function)
+    last_run = DeltaStateStore.for_host(host).swap(key, sample_time, value)
+    if not last_run or sample_time <= last_run[0] or value < last_run[1]:
+        return None
+    return float(value - last_run[1]) / (sample_time - last_run[0])
+
+def calculate_average(key, host, sample_time, value, base, window):
+    key = 'counter:' + key
+    if window:
+        history = SampleHistory.for_host(host)
+        increases = [get_increase(history.append(name, sample_time, sample), sample_time, window * 60)
+                     for name, sample in ((key, value), (key + ':base', base))]
+        if None in increases:
+            return None
+        delta, base_delta = increases[0][1], increases[1][1]
+    else:
+        last_value, last_base = DeltaStateStore.for_host(host).swap_many([(key, sample_time, value),
+                                                                           (key + ':base', sample_time, base)])
+        if not last_value or not last_base or sample_time <= last_value[0]:
+            return None
+        delta, base_delta = value - last_value[1], base - last_base[1]
+        if delta < 0 or base_delta < 0:
+            return None
+    #~ Nothing was counted between the samples, e.g. no lock had to wait
+    if not base_delta:
+        return 0.0
+    return float(delta) / base_delta
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+########################################################################
+# mssql_exporter.py
+# Licence : GPL - http://www.fsf.org/licenses/gpl.txt
+#
+# Prometheus exporter for the counters of check_mssql_server.py and
+# check_mssql_database.py. Serves /metrics for every configured server:
+#
+#   mssql_server_<mode>{server="sql01"}
+#   mssql_database_<mode>{server="sql01",database="sales"}
+#
+# Delta modes, and counter modes whose value is a rate or an average, are
+# exported as their raw counter (<mode>_total, with <mode>_base_total for
+# averages) for rate() to work on, every other mode as a gauge of the
+# plugin's result. The delta state of the plugins is never touched.
+# Each server keeps one connection and is read with one DMV query per
+# scrape, and a scrape within --min-interval of the last one is answered
+# from its result, however many scrapers there are.
+#
+# Servers file, one per line (credentials file as for check_mssql_fleet.py):
+#   host[\instance|:port]  credential
+#
+# usage: mssql_exporter.py -f servers -C credentials -l :9399
+########################################################################
+
+import sys
+import time
+import copy
+import threading
+import pymssql
+from optparse import OptionParser
+
+import check_mssql_server
+import check_mssql_database
+from check_mssql_fleet import read_lines, read_credentials, split_host
+from mssql_snapshot import CounterSnapshot, COUNTER_QUERY_RE
+from mssql_counters import PERF_COUNTER_BULK_COUNT, PERF_AVERAGE_BULK
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+SCRAPE_ERRORS = (IndexError, KeyError, ValueError, TypeError, ZeroDivisionError)
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(labels):
+    return ','.join(['%s="%s"' % (name, escape_label(value)) for name, value in labels])
+
+def get_counter_name(query):
+    #~ The counter a database mode query reads, its instances are the databases
+    match = COUNTER_QUERY_RE.match(query % '')
+    return match.group('name') or match.group('prefix')
+
+def read_servers(filename, credentials):
+    servers = []
+    for line in read_lines(filename):
+        fields = line.split()
+        if len(fields) != 2 or fields[1] not in credentials:
+            raise ValueError('Invalid servers line: %s' % line)
+        address, credential = fields
+        host, connection_args = split_host(address)
+        user, password = credentials[credential]
+        servers.append(ServerExporter(address, ['-H', host, '-U', user, '-P', password] + connection_args))
+    return servers
+
+class ServerExporter(object):
+
+    def __init__(self, address, args):
+        self.address = address
+        self.server_options = check_mssql_server.parse_args(args)
+        self.database_options = check_mssql_database.parse_args(args)
+        self.connection = None
+        self.host = address
+        self.samples = []
+        self.scraped = 0
+        self.lock = threading.Lock()
+        #~ Modes that read other DMVs (--waitstats) are not part of the counter snapshot
+        self.queries = [mode['query'] for mode in check_mssql_server.MODES.values()
+                        if COUNTER_QUERY_RE.match(mode.get('query', ''))]
+        self.queries += [mode['query'] % '' for mode in check_mssql_database.MODES.values()
+                         if COUNTER_QUERY_RE.match(mode.get('query', ''))]
+
+    def get_samples(self, min_interval):
+        #~ Scrapes arriving together wait for the one in progress and share its result
+        self.lock.acquire()
+        try:
+            if time.time() - self.scraped >= min_interval:
+                self.samples = self.scrape()
+                self.scraped = time.time()
+            return self.samples
+        finally:
+            self.lock.release()
+
+    def scrape(self):
+        labels = [('server', self.address)]
+        start = time.time()
+        try:
+            if self.connection is None:
+                self.connection, total, self.host = check_mssql_server.connect_db(self.server_options)
+            snapshot = CounterSnapshot.fetch(self.connection, self.queries)
+        except (pymssql.OperationalError, pymssql.InterfaceError):
+            self.close()
+            return [('mssql_up', 'gauge', 'Whether the server could be read', labels, 0)]
+        samples = [('mssql_up', 'gauge', 'Whether the server could be read', labels, 1)]
+        samples += self.server_samples(snapshot, labels)
+        samples += self.database_samples(snapshot, labels)
+        samples.append(('mssql_scrape_duration_seconds', 'gauge', 'Seconds spent reading the server',
+                        labels, round(time.time() - start, 6)))
+        return samples
+
+    def server_samples(self, snapshot, labels):
+        samples = []
+        for mode in sorted(check_mssql_server.MODES.keys()):
+            definition = check_mssql_server.MODES[mode]
+            if not COUNTER_QUERY_RE.match(definition.get('query', '')):
+                continue
+            options = copy.copy(self.server_options)
+            options.mode = mode
+            try:
+                query = check_mssql_server.make_query(options, self.host)
+                samples += self.make_samples('mssql_server_' + mode, definition, query, snapshot, labels)
+            except SCRAPE_ERRORS:
+                continue
+        return samples
+
+    def database_samples(self, snapshot, labels):
+        samples = []
+        for mode in sorted(check_mssql_database.MODES.keys()):
+            definition = check_mssql_database.MODES[mode]
+            if not COUNTER_QUERY_RE.match(definition.get('query', '')):
+                continue
+            for database in snapshot.instances(get_counter_name(definition['query'])):
+                if database.lower() == '_total':
+                    continue
+                options = copy.copy(self.database_options)
+                options.mode = mode
+                options.database = database
+                try:
+                    query = check_mssql_database.make_query(options, self.host, True)
+                    samples += self.make_samples('mssql_database_' + mode, definition, query, snapshot,
+                                                 labels + [('database', database)])
+                except SCRAPE_ERRORS:
+                    continue
+        return samples
+
+    def make_samples(self, name, definition, query, snapshot, labels):
+        #~ Nothing that keeps delta state is calculated here, it is shared with the checks of the host
+        query.run_on_snapshot(snapshot)
+        if definition.get('type') == 'delta':
+            return [(name + '_total', 'counter', definition['help'], labels, query.query_result)]
+        if definition.get('type') == 'counter':
+            sample = query.query_result
+            if sample['cntr_type'] == PERF_COUNTER_BULK_COUNT:
+                return [(name + '_total', 'counter', definition['help'], labels, sample['value'])]
+            if sample['cntr_type'] == PERF_AVERAGE_BULK:
+                return [(name + '_total', 'counter', definition['help'], labels, sample['value']),
+                        (name + '_base_total', 'counter', definition['help'] + ' (base)', labels, sample['base'])]
+        query.calculate_result()
+        if query.result is None:
+            return []
+        return [(name, 'gauge', definition['help'], labels, query.result)]
+
+    def close(self):
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except Exception:
+                pass
+        self.connection = None
+
+def render_metrics(servers, min_interval):
+    #~ Samples of every server grouped under one HELP/TYPE header per metric
+    families = {}
+    order = []
+    for server in servers:
+        for name, metric_type, help, labels, value in server.get_samples(min_interval):
+            if name not in families:
+                families[name] = (metric_type, help, [])
+                order.append(name)
+            families[name][2].append((labels, value))
+    lines = []
+    for name in order:
+        metric_type, help, samples = families[name]
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s %s' % (name, metric_type))
+        for labels, value in samples:
+            lines.append('%s{%s} %s' % (name, format_labels(labels), repr(float(value))))
+    return '\n'.join(lines) + '\n'
+
+def make_handler(servers, min_interval):
+    import BaseHTTPServer
+
+    class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path.split('?', 1)[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = render_metrics(servers, min_interval)
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return MetricsHandler
+
+def parse_args():
+    usage = "usage: %prog -f servers -C credentials [-l [address]:port]"
+    parser = OptionParser(usage=usage)
+    parser.add_option('-f', '--servers', help='File listing the servers to export', default=None)
+    parser.add_option('-C', '--credentials', help='Credentials file referenced by the servers file', default=None)
+    parser.add_option('-l', '--listen', help='Address and port to serve /metrics on', default=':9399')
+    parser.add_option('--min-interval', type='float', help='Seconds a scrape result is reused for', default=15)
+    options, _ = parser.parse_args()
+    if not options.servers:
+        parser.error('Servers is a required option.')
+    if not options.credentials:
+        parser.error('Credentials is a required option.')
+    address, _, port = options.listen.rpartition(':')
+    try:
+        options.listen = (address, int(port))
+    except ValueError:
+        parser.error('Listen must be [address]:port.')
+    return options
+
+def main():
+    import BaseHTTPServer
+    import SocketServer
+
+    class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    options = parse_args()
+    servers = read_servers(options.servers, read_credentials(options.credentials))
+    server = ThreadingHTTPServer(options.listen, make_handler(servers, options.min_interval))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        for exporter in servers:
+            exporter.close()
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        sys.exit(0)
+    except (IOError, ValueError), e:
+        print e
+        sys.exit(3)
@@ -0,0 +1,90 @@
+########################################################################
+# mssql_filestats.py
+# Used by check_mssql_database.py
+# Licence : GPL - http://www.fsf.org/licenses/gpl.txt
+#
+# Read and write latency and IOPS per database file for --filelatency.
+# All files of the server are read with one query on
+# sys.dm_io_virtual_file_stats, the cumulative I/O and stall counters of
+# every file are kept in the delta state store (one packed sample per
+# file) and swapped in a single transaction. The latency of a file is
+# the stall time over the number of I/Os since the previous run, that
+# of a database is taken over all its files together.
+########################################################################
+
+import time
+import struct
+from mssql_snapshot import normalize
+
+FILESTATS_QUERY = ("SELECT DB_NAME(database_id), file_id, num_of_reads, io_stall_read_ms, num_of_writes, io_stall_write_ms "
+                   "FROM sys.dm_io_virtual_file_stats(NULL, NULL);")
+
+SAMPLE = struct.Struct('<4d')
+
+def make_state_key(database, file_id):
+    return 'filestats:%s:%d' % (database, file_id)
+
+def read_file_stats(connection, databases):
+    #~ Returns (sample time, [(database, file_id, counters)]) for the files of the given databases
+    #~ Matched like the counter instances, case-insensitively as the server collation does, and
+    #~ returned under the name that was asked for
+    wanted = dict([(normalize(database), database) for database in databases])
+    cur = connection.cursor()
+    cur.execute(FILESTATS_QUERY)
+    sample_time = time.time()
+    files = []
+    for row in cur.fetchall():
+        database = wanted.get(normalize(row[0]))
+        if database is not None:
+            files.append((database, int(row[1]), tuple([float(x) for x in row[2:]])))
+    return sample_time, files
+
+def get_file_delta(counters, last_run, sample_time):
+    #~ (reads, read stall, writes, write stall, seconds) since last_run, None without a usable previous sample
+    if not last_run or sample_time <= last_run[0]:
+        return None
+    previous = SAMPLE.unpack(str(last_run[1]))
+    delta = [new - old for new, old in zip(counters, previous)]
+    #~ Counters start over when the database is brought online again
+    if min(delta) < 0:
+        return None
+    return tuple(delta) + (sample_time - last_run[0],)
+
+def get_latency(ios, stall):
+    if not ios:
+        return 0.0
+    return stall / ios
+
+def summarize(deltas):
+    #~ Read and write latency in ms and IOPS over the given file deltas together
+    reads = sum([delta[0] for delta in deltas])
+    read_stall = sum([delta[1] for delta in deltas])
+    writes = sum([delta[2] for delta in deltas])
+    write_stall = sum([delta[3] for delta in deltas])
+    seconds = max([delta[4] for delta in deltas])
+    return { 'read_latency'  : round(get_latency(reads, read_stall), 2),
+             'write_latency' : round(get_latency(writes, write_stall), 2),
+             'iops'          : round((reads + writes) / seconds, 2) }
+
+def calculate_file_stats(store, sample_time, files):
+    #~ Returns { database : { 'files' : [(file_id, summary)], 'total' : summary, 'worst' : (file_id, latency) } },
+    #~ a database whose files have no previous sample yet maps to None
+    previous = store.swap_many([(make_state_key(database, file_id), sample_time, buffer(SAMPLE.pack(*counters)))
+                                for database, file_id, counters in files])
+    deltas = {}
+    for (database, file_id, counters), last_run in zip(files, previous):
+        deltas.setdefault(database, [])
+        delta = get_file_delta(counters, last_run, sample_time)
+        if delta is not None:
+            deltas[database].append((file_id, delta))
+    stats = {}
+    for database, file_deltas in deltas.items():
+        if not file_deltas:
+            stats[database] = None
+            continue
+        summaries = [(file_id, summarize([delta])) for file_id, delta in file_deltas]
+        worst = max([(max(summary['read_latency'], summary['write_latency']), file_id) for file_id, summary in summaries])
+        stats[database] = { 'files' : summaries,
+                            'total' : summarize([delta for file_id, delta in file_deltas]),
+                            'worst' : (worst[1], worst[0]) }
+    return stats
@@ -0,0 +1,161 @@
+########################################################################
+# mssql_history.py
+# Shared by check_mssql_server.py and check_mssql_database.py
+# Licence : GPL - http://www.fsf.org/licenses/gpl.txt
+#
+# Sample history for delta modes (--window). Every counter of a host
+# gets a fixed size ring of (time, value) pairs in one binary file per
+# host, so disk and memory use per counter stay constant however long
+# the checks run. The file is a header followed by append-only records:
+#
+#   header  'MSRB', capacity
+#   record  md5(key), head, count, capacity x (time, value) doubles
+#
+# Rates over a window survive missed runs, and a counter that went
+# backwards (server restart) is treated as restarted from zero.
+########################################################################
+
+import os
+import fcntl
+import struct
+import threading
+from array import array
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+from mssql_state import make_state_path
+
+MAGIC = 'MSRB'
+CAPACITY = 120
+FILE_HEADER = struct.Struct('<4sI')
+RECORD_HEADER = struct.Struct('<16sII')
+
+AGGREGATES = ['rate', 'average', 'max']
+
+_local = threading.local()
+
+class SampleHistory(object):
+
+    def __init__(self, path, capacity=CAPACITY):
+        self.path = path
+        self.capacity = capacity
+        self.record_size = RECORD_HEADER.size + capacity * 2 * array('d').itemsize
+        self.offsets = {}
+        self.indexed = FILE_HEADER.size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0600)
+        self.historyfile = os.fdopen(fd, 'r+b')
+
+    def for_host(cls, host):
+        #~ One open file per thread, flock then serialises threads and processes alike
+        histories = getattr(_local, 'histories', None)
+        if histories is None:
+            histories = _local.histories = {}
+        path = make_state_path(host, 'mssql-history', 'ring')
+        if path not in histories:
+            histories[path] = cls(path)
+        return histories[path]
+    for_host = classmethod(for_host)
+
+    def check_header(self):
+        #~ A file from another capacity (or a torn first write) is started over
+        self.historyfile.seek(0)
+        header = self.historyfile.read(FILE_HEADER.size)
+        if len(header) == FILE_HEADER.size and FILE_HEADER.unpack(header) == (MAGIC, self.capacity):
+            return
+        self.historyfile.seek(0)
+        self.historyfile.truncate()
+        self.historyfile.write(FILE_HEADER.pack(MAGIC, self.capacity))
+        self.offsets = {}
+        self.indexed = FILE_HEADER.size
+
+    def update_index(self):
+        #~ Records never move, so only records added since the last call are read
+        self.historyfile.seek(0, 2)
+        size = self.historyfile.tell()
+        if size < self.indexed:
+            self.offsets = {}
+            self.indexed = FILE_HEADER.size
+        while self.indexed + self.record_size <= size:
+            self.historyfile.seek(self.indexed)
+            digest = RECORD_HEADER.unpack(self.historyfile.read(RECORD_HEADER.size))[0]
+            self.offsets[digest] = self.indexed
+            self.indexed += self.record_size
+
+    def find_record(self, digest):
+        self.update_index()
+        offset = self.offsets.get(digest)
+        if offset is None:
+            offset = self.indexed
+            self.historyfile.seek(offset)
+            self.historyfile.write(RECORD_HEADER.pack(digest, 0, 0))
+            self.historyfile.write(array('d', [0.0] * self.capacity * 2).tostring())
+            self.offsets[digest] = offset
+            self.indexed += self.record_size
+        return offset
+
+    def read_samples(self, offset):
+        self.historyfile.seek(offset)
+        digest, head, count = RECORD_HEADER.unpack(self.historyfile.read(RECORD_HEADER.size))
+        ring = array('d')
+        ring.fromstring(self.historyfile.read(self.capacity * 2 * ring.itemsize))
+        samples = []
+        for i in range(head - count, head):
+            slot = (i % self.capacity) * 2
+            samples.append((ring[slot], ring[slot + 1]))
+        return head, count, samples
+
+    def append(self, key, time, value):
+        #~ Stores the sample unless it is no newer than the last one and returns
+        #~ the samples of the counter, oldest first
+        digest = md5(key).digest()
+        fcntl.flock(self.historyfile.fileno(), fcntl.LOCK_EX)
+        try:
+            self.check_header()
+            offset = self.find_record(digest)
+            head, count, samples = self.read_samples(offset)
+            if samples and time <= samples[-1][0]:
+                return samples
+            self.historyfile.seek(offset + RECORD_HEADER.size + head * 2 * array('d').itemsize)
+            self.historyfile.write(array('d', [time, float(value)]).tostring())
+            self.historyfile.seek(offset)
+            self.historyfile.write(RECORD_HEADER.pack(digest, (head + 1) % self.capacity, min(count + 1, self.capacity)))
+            self.historyfile.flush()
+            samples.append((time, float(value)))
+            return samples[-self.capacity:]
+        finally:
+            fcntl.flock(self.historyfile.fileno(), fcntl.LOCK_UN)
+
+def get_intervals(samples):
+    #~ (seconds, increase) between consecutive samples. A counter that went
+    #~ backwards was reset, it counted up from zero to its new value.
+    intervals = []
+    for (old_time, old_value), (new_time, new_value) in zip(samples, samples[1:]):
+        if new_value < old_value:
+            intervals.append((new_time - old_time, new_value))
+        else:
+            intervals.append((new_time - old_time, new_value - old_value))
+    return intervals
+
+def get_window_intervals(samples, now, window):
+    samples = [sample for sample in samples if sample[0] >= now - window]
+    return [interval for interval in get_intervals(samples) if interval[0] > 0]
+
+def get_increase(samples, now, window):
+    #~ (seconds, increase) over the samples taken in the last window seconds, None without two samples
+    intervals = get_window_intervals(samples, now, window)
+    if not intervals:
+        return None
+    return sum([seconds for seconds, increase in intervals]), sum([increase for seconds, increase in intervals])
+
+def aggregate(samples, now, window, function='rate'):
+    #~ Per second rate of the samples taken in the last window seconds, None without two samples
+    intervals = get_window_intervals(samples, now, window)
+    if not intervals:
+        return None
+    if function == 'rate':
+        return sum([increase for seconds, increase in intervals]) / sum([seconds for seconds, increase in intervals])
+    rates = [increase / seconds for seconds, increase in intervals]
+    if function == 'max':
+        return max(rates)
+    return sum(rates) / len(rates)
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+########################################################################
+# mssql_metrics.py
+# Shared by check_mssql_server.py and check_mssql_database.py
+# Licence : GPL - http://www.fsf.org/licenses/gpl.txt
+#
+# Columnar history of check results and backtesting of thresholds.
+#
+# With --metrics-dir DIR every check appends the values of its perfdata
+# to DIR/host/mode/YYYY-MM-DD.bin as fixed size records (time, label id,
+# value), the label names are kept in DIR/host/mode/labels. The store is
+# written without NumPy. A label whose id (crc32) is already taken by
+# another label is not stored, rather than mixing the samples of both.
+#
+# Run as a command it replays candidate ranges (same semantics as -w and
+# -c) over the stored samples and reports the alerts and flaps each would
+# have raised. With NumPy the day files are memory mapped and evaluated
+# as whole arrays, without it the samples are read record by record.
+#
+#   mssql_metrics.py -d DIR -H sql01 -m pagelife -r 300:,100: -r 500:,200:
+########################################################################
+
+import os
+import re
+import sys
+import time
+import fcntl
+import struct
+import zlib
+from optparse import OptionParser
+from mssql_push import parse_perfdata
+from mssql_range import parse_range, classify
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+RECORD = struct.Struct('<dId')
+DAY = 24 * 60 * 60
+
+if numpy is not None:
+    RECORD_DTYPE = numpy.dtype([('time', '<f8'), ('label', '<u4'), ('value', '<f8')])
+
+def make_path(directory, host, mode):
+    return os.path.join(directory, re.sub(r'[^A-Za-z0-9.-]', '_', host), re.sub(r'[^A-Za-z0-9.-]', '_', mode or 'time2connect'))
+
+def get_label_id(label):
+    return zlib.crc32(label) & 0xffffffff
+
+def get_day(when):
+    return time.strftime('%Y-%m-%d', time.gmtime(when))
+
+def read_labels(path):
+    labels = {}
+    try:
+        labelfile = open(os.path.join(path, 'labels'))
+    except IOError:
+        return labels
+    try:
+        for line in labelfile:
+            label_id, label = line.rstrip('\n').split('\t', 1)
+            labels[label] = int(label_id)
+    finally:
+        labelfile.close()
+    return labels
+
+def append_samples(directory, host, mode, when, metrics):
+    #~ One write per check into the file of the day, new labels are added to the label file
+    if not metrics:
+        return
+    path = make_path(directory, host, mode)
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+    known = read_labels(path)
+    new = [label for label, value in metrics if label not in known]
+    colliding = []
+    if new:
+        labelfile = open(os.path.join(path, 'labels'), 'a')
+        try:
+            fcntl.flock(labelfile.fileno(), fcntl.LOCK_EX)
+            #~ Another check may have added them since they were read
+            used = dict([(label_id, label) for label, label_id in read_labels(path).items()])
+            lines = []
+            for label in new:
+                label_id = get_label_id(label)
+                other = used.get(label_id)
+                if other == label:
+                    continue
+                if other is not None:
+                    #~ Stored under the same id the samples of both labels would mix
+                    colliding.append((label, other))
+                    continue
+                used[label_id] = label
+                lines.append('%d\t%s\n' % (label_id, label))
+            labelfile.write(''.join(lines))
+        finally:
+            labelfile.close()
+    skipped = [label for label, other in colliding]
+    records = ''.join([RECORD.pack(when, get_label_id(label), value) for label, value in metrics if label not in skipped])
+    datafile = open(os.path.join(path, get_day(when) + '.bin'), 'ab')
+    try:
+        fcntl.flock(datafile.fileno(), fcntl.LOCK_EX)
+        datafile.write(records)
+    finally:
+        datafile.close()
+    if colliding:
+        raise ValueError('Label id of %s not stored, already used by %s' % colliding[0])
+
+def store_result(options, host, result):
+    #~ Called with the NagiosReturn of a check, like push_result()
+    if not getattr(options, 'metrics_dir', None):
+        return
+    try:
+        append_samples(options.metrics_dir, host, options.mode, time.time(), parse_perfdata(result.message))
+    except (IOError, OSError, ValueError):
+        pass
+
+def get_day_files(path, since):
+    first = get_day(since)
+    return sorted([os.path.join(path, name) for name in os.listdir(path)
+                   if name.endswith('.bin') and name[:-4] >= first])
+
+def read_samples(path, label, since):
+    #~ (times, values) of label since the given time, ordered by time, as arrays with NumPy
+    label_id = get_label_id(label)
+    if numpy is not None:
+        times, values = [], []
+        for filename in get_day_files(path, since):
+            if not os.path.getsize(filename) // RECORD.size:
+                continue
+            records = numpy.memmap(filename, dtype=RECORD_DTYPE, mode='r',
+                                   shape=(os.path.getsize(filename) // RECORD.size,))
+            selected = records[(records['label'] == label_id) & (records['time'] >= since)]
+            times.append(numpy.array(selected['time']))
+            values.append(numpy.array(selected['value']))
+        if not times:
+            return numpy.zeros(0), numpy.zeros(0)
+        times, values = numpy.concatenate(times), numpy.concatenate(values)
+        order = numpy.argsort(times, kind='mergesort')
+        return times[order], values[order]
+    samples = []
+    for filename in get_day_files(path, since):
+        data = open(filename, 'rb').read()
+        for offset in xrange(0, len(data) - RECORD.size + 1, RECORD.size):
+            when, record_label, value = RECORD.unpack_from(data, offset)
+            if record_label == label_id and when >= since:
+                if value != value:
+                    value = None
+                samples.append((when, value))
+    samples.sort()
+    return [when for when, value in samples], [value for when, value in samples]
+
+def classify_samples(values, warning, critical):
+    #~ State of every sample as with -w and -c: 0 ok, 1 warning, 2 critical
+    if numpy is None:
+        return classify(values, warning, critical)
+    codes = numpy.zeros(len(values), dtype=numpy.int8)
+    #~ Comparing a NaN is expected here, NumPy would warn about it on stderr
+    old_settings = numpy.seterr(invalid='ignore')
+    try:
+        for code, nagstring in ((1, warning), (2, critical)):
+            nagrange = parse_range(nagstring)
+            if nagrange is None:
+                continue
+            inside = (values >= nagrange.start) & (values <= nagrange.end)
+            if nagrange.inside:
+                alert = inside
+            else:
+                #~ A missing sample (NaN) is outside every range but never alerts
+                alert = ~inside & ~numpy.isnan(values)
+            codes[alert] = code
+    finally:
+        numpy.seterr(**old_settings)
+    return codes
+
+def count_alerts(codes, flap_window):
+    #~ Returns (warning alerts, critical alerts, flaps, samples in warning, samples in critical). An alert
+    #~ is a change into a problem state, a flap a problem that cleared within flap_window samples.
+    if numpy is None:
+        warnings, criticals, flaps = 0, 0, 0
+        previous, started = 0, None
+        for i, code in enumerate(codes):
+            if code != previous:
+                if code == 1:
+                    warnings += 1
+                elif code == 2:
+                    criticals += 1
+                if code and not previous:
+                    started = i
+                elif previous and not code:
+                    if i - started < flap_window:
+                        flaps += 1
+            previous = code
+        return warnings, criticals, flaps, codes.count(1), codes.count(2)
+    codes = numpy.asarray(codes)
+    previous = numpy.concatenate(([0], codes[:-1]))
+    changed = codes != previous
+    problem = (codes > 0).astype(numpy.int8)
+    edges = numpy.diff(numpy.concatenate(([0], problem)))
+    starts = numpy.flatnonzero(edges == 1)
+    ends = numpy.flatnonzero(edges == -1)
+    #~ A problem still going on at the end is not a flap
+    lengths = ends - starts[:len(ends)]
+    return (int(numpy.count_nonzero(changed & (codes == 1))), int(numpy.count_nonzero(changed & (codes == 2))),
+            int(numpy.count_nonzero(lengths < flap_window)), int(numpy.count_nonzero(codes == 1)),
+            int(numpy.count_nonzero(codes == 2)))
+
+def backtest(path, label, since, candidates, flap_window):
+    times, values = read_samples(path, label, since)
+    results = []
+    for warning, critical in candidates:
+        warnings, criticals, flaps, warning_samples, critical_samples = count_alerts(
+            classify_samples(values, warning, critical), flap_window)
+        results.append((warning, critical, len(values), warnings, criticals, flaps, warning_samples, critical_samples))
+    return results
+
+HEADER = '%-24s %-12s %-12s %9s %8s %8s %6s %7s %7s' % ('label', 'warning', 'critical', 'samples', 'warnings', 'criticals',
+                                                      'flaps', 'warn_%', 'crit_%')
+ROW = '%-24s %-12s %-12s %9d %8d %8d %6d %7.2f %7.2f'
+
+def parse_args():
+    usage = "usage: %prog -d directory -H host -m mode -r WARNING,CRITICAL [-r ...]"
+    parser = OptionParser(usage=usage)
+    parser.add_option('-d', '--metrics-dir', help='Directory the checks were run with --metrics-dir', default=None)
+    parser.add_option('-H', '--host', help='Host as the checks named it, host[\\instance|:port]', default=None)
+    parser.add_option('-m', '--mode', help='Mode of the checks', default=None)
+    parser.add_option('-l', '--label', action='append', help='Perfdata label to test, all labels of the mode by default', default=None)
+    parser.add_option('-r', '--range', action='append', dest='ranges', metavar='WARNING,CRITICAL',
+                      help='Candidate warning and critical range, either may be empty. May be given several times.', default=None)
+    parser.add_option('--days', type='float', help='Days of samples to test against', default=90)
+    parser.add_option('--flap-window', type='int', metavar='SAMPLES', help='A problem that clears within this many samples is a flap', default=3)
+    options, _ = parser.parse_args()
+    if not options.metrics_dir or not options.host or not options.mode:
+        parser.error('Metrics directory, host and mode are required options.')
+    if not options.ranges:
+        parser.error('At least one candidate range is required.')
+    candidates = []
+    for spec in options.ranges:
+        fields = spec.split(',')
+        if len(fields) != 2:
+            parser.error('Invalid candidate range: %s' % spec)
+        for nagstring in fields:
+            try:
+                parse_range(nagstring)
+            except ValueError, e:
+                parser.error(str(e))
+        candidates.append((fields[0] or None, fields[1] or None))
+    options.ranges = candidates
+    return options
+
+def main():
+    options = parse_args()
+    path = make_path(options.metrics_dir, options.host, options.mode)
+    labels = options.label or sorted(read_labels(path).keys())
+    since = time.time() - options.days * DAY
+    start = time.time()
+    print HEADER
+    for label in labels:
+        for result in backtest(path, label, since, options.ranges, options.flap_window):
+            warning, critical, samples = result[:3]
+            percentages = [100.0 * count / max(samples, 1) for count in result[6:]]
+            print ROW % tuple([label, warning or '', critical or ''] + list(result[2:6]) + percentages)
+    sys.stderr.write('%d label(s) tested in %.3fs%s.\n' % (len(labels), time.time() - start,
+                                                          numpy is None and ' without NumPy' or ''))
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        sys.exit(0)
@@ -0,0 +1,233 @@
+########################################################################
+# mssql_push.py
+# Shared by check_mssql_server.py and check_mssql_database.py
+# Licence : GPL - http://www.fsf.org/licenses/gpl.txt
+#
+# Pushes the perfdata of every check straight to Graphite (plaintext) or
+# InfluxDB (line protocol) with --push, so it need not go through the
+# Nagios perfdata files:
+#
+#   --push graphite://carbon:2003      tcp, or graphite+udp://
+#   --push influx+udp://influx:8089    udp, or influx+tcp://
+#
+# Lines are appended to a spool file per sink and sent in bulk once the
+# spool holds --push-batch bytes or --push-interval seconds passed since
+# the last flush. While the sink is down the spool keeps the newest
+# --push-buffer bytes, and the next flush sends them. After a failed
+# flush no check tries again for RETRY_DELAY seconds, doubling with every
+# failure up to MAX_RETRY_DELAY, so an outage does not add the send
+# timeout to every check.
+########################################################################
+
+import os
+import re
+import time
+import fcntl
+import socket
+import tempfile
+from mssql_state import make_state_path
+
+SINK_RE = re.compile(r'^(?P<format>graphite|influx)(?:\+(?P<transport>tcp|udp))?://(?P<host>[^:/]+)(?::(?P<port>\d+))?/?$')
+
+DEFAULTS = {
+    'graphite' : ('tcp', 2003),
+    'influx'   : ('udp', 8089),
+}
+
+PERFDATA_RE = re.compile(r"""('(?:[^']|'')+'|[^\s=']+)=(-?[\d.]+(?:[eE][-+]?\d+)?)""")
+
+CHUNK_SIZE = 65536
+DATAGRAM_SIZE = 1400
+SEND_TIMEOUT = 5
+RETRY_DELAY = 10
+MAX_RETRY_DELAY = 600
+
+def parse_sink(url):
+    #~ Returns (format, transport, host, port), raises ValueError on an unknown sink
+    match = SINK_RE.match(url)
+    if not match:
+        raise ValueError('Invalid push sink: %s' % url)
+    transport, port = DEFAULTS[match.group('format')]
+    return (match.group('format'), match.group('transport') or transport,
+            match.group('host'), int(match.group('port') or port))
+
+def parse_perfdata(stdout):
+    #~ (label, value) pairs of every perfdata section, values that are not numbers are left out
+    metrics = []
+    for line in stdout.split('\n'):
+        if '|' not in line:
+            continue
+        for label, value in PERFDATA_RE.findall(line.split('|', 1)[1]):
+            if label.startswith("'"):
+                label = label[1:-1].replace("''", "'")
+            metrics.append((label, float(value)))
+    return metrics
+
+def graphite_name(name):
+    return re.sub(r'[^A-Za-z0-9_-]+', '_', name).strip('_') or '_'
+
+def influx_escape(name):
+    return re.sub(r'([,= ])', r'\\\1', name)
+
+def format_graphite(prefix, plugin, host, mode, code, metrics, now):
+    path = '.'.join([graphite_name(part) for part in (prefix, host, plugin, mode or 'time2connect')])
+    lines = ['%s.state %d %d\n' % (path, code, now)]
+    for label, value in metrics:
+        lines.append('%s.%s %r %d\n' % (path, graphite_name(label), value, now))
+    return ''.join(lines)
+
+def format_influx(prefix, plugin, host, mode, code, metrics, now):
+    fields = ['state=%di' % code] + ['%s=%r' % (influx_escape(label), value) for label, value in metrics]
+    return '%s,host=%s,plugin=%s,mode=%s %s %d\n' % (influx_escape(prefix), influx_escape(host), plugin,
+                                                    influx_escape(mode or 'time2connect'), ','.join(fields),
+                                                    int(now * 1000000000))
+
+FORMATTERS = {
+    'graphite' : format_graphite,
+    'influx'   : format_influx,
+}
+
+class PushSpool(object):
+
+    def __init__(self, url, batch=0, interval=0, buffer_size=8 * 1024 * 1024):
+        self.format, self.transport, self.host, self.port = parse_sink(url)
+        self.batch = batch
+        self.interval = interval
+        self.buffer_size = buffer_size
+        self.path = make_state_path('%s-%s-%d' % (self.format, self.host, self.port), 'mssql-push', 'spool')
+        self.flushed_path = self.path + '.flushed'
+        self.failed_path = self.path + '.failed'
+
+    def add(self, lines):
+        #~ Never raises for a sink that is down, the lines stay in the spool
+        #~ The spool is replaced on every flush, so the lock lives in a file of its own
+        lockfile = open(self.path + '.lock', 'a')
+        try:
+            fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX)
+            spoolfile = open(self.path, 'ab')
+            try:
+                spoolfile.write(lines)
+            finally:
+                spoolfile.close()
+            if self.is_due(os.path.getsize(self.path)):
+                try:
+                    self.flush()
+                except (socket.error, IOError):
+                    self.record_failure()
+            size = os.path.getsize(self.path)
+            if size > self.buffer_size:
+                self.keep_tail(size - self.buffer_size)
+        finally:
+            lockfile.close()
+
+    def is_due(self, size):
+        if time.time() < self.get_retry_time():
+            return False
+        if size >= self.batch:
+            return True
+        try:
+            return time.time() - os.path.getmtime(self.flushed_path) >= self.interval
+        except OSError:
+            return True
+
+    def flush(self):
+        #~ Sends the spool in chunks of whole lines, what was not sent stays in the spool
+        sent = 0
+        spoolfile = open(self.path, 'rb')
+        try:
+            connection = self.connect()
+            try:
+                while True:
+                    chunk = spoolfile.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    if not chunk.endswith('\n'):
+                        chunk += spoolfile.readline()
+                    self.send(connection, chunk)
+                    sent += len(chunk)
+            finally:
+                connection.close()
+        finally:
+            spoolfile.close()
+            self.keep_tail(sent)
+        open(self.flushed_path, 'w').close()
+        if os.path.exists(self.failed_path):
+            os.unlink(self.failed_path)
+
+    def get_retry_time(self):
+        #~ The failed file holds the number of failures in a row, its mtime is the last one
+        try:
+            failures = int(open(self.failed_path).read() or 1)
+            failed = os.path.getmtime(self.failed_path)
+        except (IOError, OSError, ValueError):
+            return 0
+        return failed + min(RETRY_DELAY * 2 ** min(failures - 1, 16), MAX_RETRY_DELAY)
+
+    def record_failure(self):
+        try:
+            failures = int(open(self.failed_path).read() or 0)
+        except (IOError, ValueError):
+            failures = 0
+        failedfile = open(self.failed_path, 'w')
+        try:
+            failedfile.write(str(failures + 1))
+        finally:
+            failedfile.close()
+
+    def keep_tail(self, offset):
+        #~ Drops the spool up to offset (rounded up to a whole line) by copying the rest aside
+        if offset <= 0:
+            return
+        spoolfile = open(self.path, 'rb')
+        try:
+            spoolfile.seek(offset - 1)
+            if spoolfile.read(1) != '\n':
+                spoolfile.readline()
+            fd, tmpname = tempfile.mkstemp(prefix=os.path.basename(self.path), dir=os.path.dirname(self.path))
+            tmpfile = os.fdopen(fd, 'wb')
+            try:
+                while True:
+                    chunk = spoolfile.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    tmpfile.write(chunk)
+            finally:
+                tmpfile.close()
+        finally:
+            spoolfile.close()
+        os.rename(tmpname, self.path)
+
+    def connect(self):
+        if self.transport == 'udp':
+            connection = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            connection.connect((self.host, self.port))
+        else:
+            connection = socket.create_connection((self.host, self.port), SEND_TIMEOUT)
+        connection.settimeout(SEND_TIMEOUT)
+        return connection
+
+    def send(self, connection, chunk):
+        if self.transport == 'tcp':
+            connection.sendall(chunk)
+            return
+        #~ One datagram per group of whole lines
+        datagram = ''
+        for line in chunk.splitlines(True):
+            if datagram and len(datagram) + len(line) > DATAGRAM_SIZE:
+                connection.send(datagram)
+                datagram = ''
+            datagram += line
+        if datagram:
+            connection.send(datagram)
+
+def push_result(options, plugin, host, result):
+    #~ Called with the NagiosReturn of a check, like report_timing()
+    if not getattr(options, 'push', None):
+        return
+    formatter = FORMATTERS[parse_sink(options.push)[0]]
+    lines = formatter(options.push_prefix, plugin, host, options.mode, result.code,
+                      parse_perfdata(result.message), time.time())
+    try:
+        PushSpool(options.push, options.push_batch, options.push_interval, options.push_buffer).add(lines)
+    except (IOError, OSError):
+        pass
@@ -0,0 +1,160 @@
+########################################################################
+# mssql_querystats.py
+# Used by check_mssql_server.py
+# Licence : GPL - http://www.fsf.org/licenses/gpl.txt
+#
+# Most expensive statements for --querystats. sys.dm_exec_query_stats
+# is streamed with fetchmany() and every statement (plan_handle and
+# statement offset, kept as a 52 bit digest) is diffed against the
+# totals of the previous run. Those are kept in a binary state file per
+# host as sorted arrays of keys and doubles, about 32 bytes a statement,
+# and looked up by bisection. Only a heap of the N statements with the
+# highest CPU time is kept, so memory does not grow with the rows read
+# beyond the arrays.
+########################################################################
+
+import os
+import time
+import heapq
+import struct
+import tempfile
+import binascii
+from array import array
+from bisect import bisect_left
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+from mssql_state import make_state_path
+
+QUERYSTATS_QUERY = ("SELECT plan_handle, statement_start_offset, total_worker_time, total_logical_reads, total_elapsed_time "
+                    "FROM sys.dm_exec_query_stats;")
+
+FETCH_SIZE = 1000
+
+HEADER = struct.Struct('<4sId')
+MAGIC = 'MSQS'
+
+KEY_MASK = (1 << 52) - 1
+
+def make_key(plan_handle, offset):
+    #~ Small enough to be exact in a double, so keys share the array type of the totals
+    return float(struct.unpack('<Q', md5(plan_handle + struct.pack('<i', offset)).digest()[:8])[0] & KEY_MASK)
+
+class QueryStatsState(object):
+
+    def __init__(self, host):
+        self.path = make_state_path(host, 'mssql-querystats', 'state')
+
+    def read(self):
+        #~ Returns (time, keys, cpu, reads, elapsed), or None without a usable previous run
+        try:
+            statefile = open(self.path, 'rb')
+        except IOError:
+            return None
+        try:
+            header = statefile.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return None
+            magic, count, taken = HEADER.unpack(header)
+            if magic != MAGIC:
+                return None
+            columns = [array('d') for i in range(4)]
+            try:
+                for column in columns:
+                    column.fromfile(statefile, count)
+            except EOFError:
+                return None
+        finally:
+            statefile.close()
+        return tuple([taken] + columns)
+
+    def write(self, taken, keys, cpu, reads, elapsed):
+        #~ Sorted by key for bisection, the rows come from the server in no particular order
+        order = sorted(xrange(len(keys)), key=keys.__getitem__)
+        fd, tmpname = tempfile.mkstemp(prefix=os.path.basename(self.path), dir=os.path.dirname(self.path))
+        tmpfile = os.fdopen(fd, 'wb')
+        try:
+            tmpfile.write(HEADER.pack(MAGIC, len(keys), taken))
+            for column in (keys, cpu, reads, elapsed):
+                array('d', (column[i] for i in order)).tofile(tmpfile)
+        finally:
+            tmpfile.close()
+        os.rename(tmpname, self.path)
+
+class QueryStatsScan(object):
+
+    def __init__(self, top):
+        self.top = top
+        self.heap = []
+        self.count = 0
+        self.totals = [0.0, 0.0, 0.0]
+        self.highest = 0.0
+        self.seconds = None
+
+    def add(self, plan_handle, offset, deltas):
+        self.count += 1
+        for i in range(3):
+            self.totals[i] += deltas[i]
+        self.highest = max(self.highest, deltas[0])
+        entry = (deltas[0], self.count, plan_handle, offset, deltas)
+        if len(self.heap) < self.top:
+            heapq.heappush(self.heap, entry)
+        elif self.heap and entry > self.heap[0]:
+            heapq.heapreplace(self.heap, entry)
+
+    def get_top(self):
+        #~ (statement, cpu ms/sec, logical reads/sec, elapsed ms/sec), highest CPU first
+        top = []
+        for cpu, count, plan_handle, offset, deltas in sorted(self.heap, reverse=True):
+            statement = '0x%s:%d' % (binascii.hexlify(plan_handle), offset)
+            top.append((statement, round(deltas[0] / 1000 / self.seconds, 2), round(deltas[1] / self.seconds, 2),
+                        round(deltas[2] / 1000 / self.seconds, 2)))
+        return top
+
+    def get_highest(self):
+        #~ CPU ms/sec of the most expensive statement, whatever the size of the top
+        return round(self.highest / 1000 / self.seconds, 2)
+
+    def get_totals(self):
+        return (round(self.totals[0] / 1000 / self.seconds, 2), round(self.totals[1] / self.seconds, 2),
+                round(self.totals[2] / 1000 / self.seconds, 2))
+
+def scan_query_stats(connection, host, top, fetch_size=FETCH_SIZE):
+    #~ Returns the QueryStatsScan since the previous run, or None on the first run
+    state = QueryStatsState(host)
+    previous = state.read()
+    cur = connection.cursor()
+    cur.execute(QUERYSTATS_QUERY)
+    sample_time = time.time()
+    keys, cpu, reads, elapsed = array('d'), array('d'), array('d'), array('d')
+    scan = QueryStatsScan(top)
+    while True:
+        rows = cur.fetchmany(fetch_size)
+        if not rows:
+            break
+        for plan_handle, offset, worker_time, logical_reads, elapsed_time in rows:
+            key = make_key(plan_handle, offset)
+            keys.append(key)
+            cpu.append(worker_time)
+            reads.append(logical_reads)
+            elapsed.append(elapsed_time)
+            if previous is None:
+                continue
+            totals = (worker_time, logical_reads, elapsed_time)
+            old_keys = previous[1]
+            i = bisect_left(old_keys, key)
+            if i < len(old_keys) and old_keys[i] == key:
+                #~ A statement whose totals went backwards was recompiled, all of them are new
+                deltas = [new - old[i] for new, old in zip(totals, previous[2:])]
+                if min(deltas) < 0:
+                    deltas = totals
+            else:
+                #~ Cached since the previous run
+                deltas = totals
+            scan.add(plan_handle, offset, deltas)
+    state.write(sample_time, keys, cpu, reads, elapsed)
+    if previous is None or sample_time <= previous[0]:
+        return None
+    scan.seconds = sample_time - previous[0]
+    return scan
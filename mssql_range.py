@@ -0,0 +1,72 @@
+########################################################################
+# mssql_range.py
+# Shared by check_mssql_server.py and check_mssql_database.py
+# Licence : GPL - http://www.fsf.org/licenses/gpl.txt
+#
+# Nagios threshold ranges, parsed once per process:
+#   10      alert if < 0 or > 10
+#   10:     alert if < 10
+#   ~:10    alert if > 10
+#   10:20   alert if < 10 or > 20
+#   @10:20  alert if >= 10 and <= 20
+# A missing sample (None) never alerts.
+########################################################################
+
+import re
+
+NUMBER = r'[-+]?(?:\d+(?:\.\d*)?|\.\d+)'
+RANGE_RE = re.compile(r'^(?P<inside>@)?(?:(?P<start>~|%s)?(?P<colon>:))?(?P<end>%s)?$' % (NUMBER, NUMBER))
+
+INFINITY = float('inf')
+
+class NagiosRange(object):
+
+    def __init__(self, nagstring):
+        match = RANGE_RE.match(nagstring.strip())
+        if not match or not (match.group('start') or match.group('end')):
+            raise ValueError('Improper warning/critical format: %s' % nagstring)
+        self.nagstring = nagstring
+        self.inside = bool(match.group('inside'))
+        start = match.group('start')
+        if start == '~':
+            self.start = -INFINITY
+        elif start:
+            self.start = float(start)
+        else:
+            self.start = 0.0
+        if match.group('end'):
+            self.end = float(match.group('end'))
+        else:
+            self.end = INFINITY
+        if self.start > self.end:
+            raise ValueError('Improper warning/critical format: %s' % nagstring)
+
+    def is_alert(self, value):
+        if value is None:
+            return False
+        return (self.start <= value <= self.end) == self.inside
+
+    def alerts(self, values):
+        start, end, inside = self.start, self.end, self.inside
+        return [value is not None and (start <= value <= end) == inside for value in values]
+
+_ranges = {}
+
+def parse_range(nagstring):
+    #~ Returns None when no threshold is set, raises ValueError on a malformed range
+    if not nagstring:
+        return None
+    if nagstring not in _ranges:
+        _ranges[nagstring] = NagiosRange(nagstring)
+    return _ranges[nagstring]
+
+def classify(values, warning=None, critical=None):
+    codes = [0] * len(values)
+    for code, nagstring in ((1, warning), (2, critical)):
+        nagrange = parse_range(nagstring)
+        if nagrange is None:
+            continue
+        for i, alert in enumerate(nagrange.alerts(values)):
+            if alert:
+                codes[i] = code
+    return codes
@@ -0,0 +1,388 @@
+#!/usr/bin/env python
+########################################################################
+# mssql_replay.py
+# Licence : GPL - http://www.fsf.org/licenses/gpl.txt
+#
+# Record and replay of checks, for profiling and validating changes
+# against real workloads without the servers.
+#
+# With --record FILE, check_mssql_server.py and check_mssql_database.py
+# append the options of the check, the login time, every query with its
+# result and latency, and the check result to FILE. Each check adds one
+# gzip member holding pickled records, written in a single append under
+# a lock, so the file can be shared by all checks on the poller.
+#
+# Replaying feeds the recorded results to the real query classes in
+# place of a connection, with the clock set to the recorded times so
+# delta modes see the recorded intervals, and reports every check whose
+# result differs from the recorded one:
+#
+#   mssql_replay.py checks.rec                    as fast as possible
+#   mssql_replay.py checks.rec --speed 1          in real time
+#   mssql_replay.py checks.rec --profile 20       with the 20 hottest functions
+########################################################################
+
+import re
+import sys
+import time
+import gzip
+import fcntl
+import shutil
+import tempfile
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+from optparse import OptionParser
+
+STDOUT_PREFIX = {
+    0 : 'OK: ',
+    1 : 'WARNING: ',
+    2 : 'CRITICAL: ',
+    3 : 'UNKNOWN: ',
+}
+
+#~ Rates depend on when the plugin read the clock, a few microseconds off the recorded query time
+TOLERANCE = 0.001
+NUMBER_RE = re.compile(r'-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?')
+
+#~ Destinations of the options that are not replayed, and of the password that is not recorded
+UNREPLAYED_DESTS = ['record', 'metrics_dir']
+MASKED_DESTS = ['password']
+
+class Recorder(object):
+
+    def __init__(self, path, plugin, args):
+        self.path = path
+        self.records = [('run', time.time(), plugin, args)]
+
+    def add(self, record):
+        self.records.append(record)
+
+    def flush(self):
+        #~ One gzip member per check, appended in one write so concurrent checks never interleave
+        buf = StringIO()
+        member = gzip.GzipFile(fileobj=buf, mode='wb')
+        try:
+            for record in self.records:
+                pickle.dump(record, member, pickle.HIGHEST_PROTOCOL)
+        finally:
+            member.close()
+        recordfile = open(self.path, 'ab')
+        try:
+            fcntl.flock(recordfile.fileno(), fcntl.LOCK_EX)
+            recordfile.write(buf.getvalue())
+        finally:
+            recordfile.close()
+        self.records = self.records[:1]
+
+def normalize_args(parser, args):
+    #~ Yields (option or None, option string, value) for args that parser accepted, with long options
+    #~ unabbreviated and short option clusters and attached values (-Psecret) split apart
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if arg == '--':
+            for arg in args:
+                yield None, None, arg
+            return
+        if arg.startswith('--'):
+            name, equals, value = arg.partition('=')
+            option = parser.get_option(parser._match_long_opt(name))
+            if not option.takes_value():
+                yield option, option.get_opt_string(), None
+            elif equals:
+                yield option, option.get_opt_string(), value
+            else:
+                yield option, option.get_opt_string(), args.pop(0)
+        elif arg.startswith('-') and len(arg) > 1:
+            for i in range(1, len(arg)):
+                option = parser.get_option('-' + arg[i])
+                if option.takes_value():
+                    yield option, option.get_opt_string(), arg[i + 1:] or args.pop(0)
+                    break
+                yield option, option.get_opt_string(), None
+        else:
+            yield None, None, arg
+
+def mask_args(parser, args):
+    #~ The args as replay passes them to the plugin, without the password in any form optparse takes
+    masked = []
+    for option, name, value in normalize_args(parser, args):
+        if option is None:
+            masked.append(value)
+        elif option.dest in UNREPLAYED_DESTS:
+            continue
+        elif value is None:
+            masked.append(name)
+        elif option.dest in MASKED_DESTS:
+            masked += [name, 'x']
+        else:
+            masked += [name, value]
+    return masked
+
+def make_recorder(parser, options, plugin, args):
+    #~ Called from parse_args once the args were accepted by parser
+    if not getattr(options, 'record', None):
+        return None
+    if args is None:
+        args = sys.argv[1:]
+    return Recorder(options.record, plugin, mask_args(parser, args))
+
+def record_connect(options, host, total):
+    if getattr(options, 'recorder', None) is not None:
+        options.recorder.add(('connect', time.time(), total, host))
+
+def record_result(options, result):
+    #~ Called with the NagiosReturn of a check, like push_result()
+    if getattr(options, 'recorder', None) is not None:
+        options.recorder.add(('result', time.time(), result.code, result.message))
+        options.recorder.flush()
+
+class ResultCursor(object):
+    #~ Hands out a result that was read in full
+
+    def fetchone(self):
+        for row in self.rows:
+            return row
+        return None
+
+    def fetchmany(self, size=1):
+        rows = []
+        for row in self.rows:
+            rows.append(row)
+            if len(rows) >= size:
+                break
+        return rows
+
+    def fetchall(self):
+        return list(self.rows)
+
+class RecordingCursor(ResultCursor):
+
+    def __init__(self, cursor, recorder):
+        self.cursor = cursor
+        self.recorder = recorder
+        self.rows = iter([])
+
+    def execute(self, query, params=None):
+        #~ The rows are read at once so the latency covers the whole result
+        start = time.time()
+        if params is None:
+            self.cursor.execute(query)
+        else:
+            self.cursor.execute(query, params)
+        rows = [tuple(row) for row in self.cursor.fetchall()]
+        self.recorder.add(('query', start, time.time() - start, query, rows))
+        self.rows = iter(rows)
+
+    def close(self):
+        self.cursor.close()
+
+class RecordingConnection(object):
+
+    def __init__(self, connection, recorder):
+        self.connection = connection
+        self.recorder = recorder
+
+    def cursor(self):
+        return RecordingCursor(self.connection.cursor(), self.recorder)
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+def record_connection(options, connection):
+    if getattr(options, 'recorder', None) is None:
+        return connection
+    return RecordingConnection(connection, options.recorder)
+
+def read_recording(path):
+    #~ Yields one list of records per recorded check
+    recordfile = gzip.open(path, 'rb')
+    try:
+        run = None
+        while True:
+            try:
+                record = pickle.load(recordfile)
+            except EOFError:
+                break
+            if record[0] == 'run':
+                if run:
+                    yield run
+                run = []
+            if run is not None:
+                run.append(record)
+        if run:
+            yield run
+    finally:
+        recordfile.close()
+
+class ReplayClock(object):
+
+    def __init__(self, now=time.time):
+        self.now = now
+        self.offset = 0.0
+
+    def set(self, when):
+        self.offset = when - self.now()
+
+    def time(self):
+        return self.now() + self.offset
+
+class ReplayCursor(ResultCursor):
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.rows = iter([])
+
+    def execute(self, query, params=None):
+        self.rows = iter(self.connection.answer(query))
+
+    def close(self):
+        pass
+
+class ReplayConnection(object):
+
+    def __init__(self, records, clock, speed, error):
+        self.clock = clock
+        self.speed = speed
+        self.error = error
+        self.queries = {}
+        for record in records:
+            if record[0] == 'query':
+                self.queries.setdefault(record[3], []).append(record)
+
+    def answer(self, query):
+        #~ Results of the same query are handed out in the order they were recorded
+        recorded = self.queries.get(query)
+        if not recorded:
+            raise self.error('Query not in the recording: %s' % query)
+        kind, start, latency, text, rows = recorded.pop(0)
+        if self.speed:
+            time.sleep(latency / self.speed)
+        self.clock.set(start + latency)
+        return rows
+
+    def cursor(self):
+        return ReplayCursor(self)
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+def replay_run(plugins, run, clock, speed, error):
+    #~ Returns (plugin, args, recorded result, replayed result), results being (code, message) or None
+    kind, started, plugin_name, args = run[0]
+    plugin = plugins[plugin_name]
+    recorded, connect = None, None
+    for record in run:
+        if record[0] == 'result':
+            recorded = (record[2], record[3])
+        elif record[0] == 'connect':
+            connect = record
+    clock.set(started)
+    try:
+        options = plugin.parse_args(args)
+    except SystemExit:
+        return plugin_name, args, recorded, (3, '%sInvalid plugin options.' % STDOUT_PREFIX[3])
+    options.collector = None
+    if connect is None:
+        return plugin_name, args, recorded, (3, '%sNo login in the recording.' % STDOUT_PREFIX[3])
+    kind, connected, total, host = connect
+    clock.set(connected)
+    try:
+        plugin.run_check(ReplayConnection(run, clock, speed, error), options, host, total)
+    except plugin.NagiosReturn, e:
+        return plugin_name, args, recorded, (e.code, e.message)
+    except Exception, e:
+        return plugin_name, args, recorded, (3, '%sCaught unexpected error: %s' % (STDOUT_PREFIX[3], e))
+    return plugin_name, args, recorded, (3, '%sCheck returned no result.' % STDOUT_PREFIX[3])
+
+def is_same_result(recorded, replayed):
+    if recorded is None or recorded[0] != replayed[0]:
+        return False
+    if NUMBER_RE.split(recorded[1]) != NUMBER_RE.split(replayed[1]):
+        return False
+    for old, new in zip(NUMBER_RE.findall(recorded[1]), NUMBER_RE.findall(replayed[1])):
+        old, new = float(old), float(new)
+        if abs(old - new) > max(abs(old) * TOLERANCE, 0.01):
+            return False
+    return True
+
+def replay(path, speed=0, output=sys.stdout):
+    import pymssql
+    import check_mssql_server
+    import check_mssql_database
+    plugins = { 'server'   : check_mssql_server,
+                'database' : check_mssql_database }
+
+    clock = ReplayClock()
+    real_time = time.time
+    time.time = clock.time
+    runs, differed, previous = 0, 0, None
+    start = real_time()
+    try:
+        for run in read_recording(path):
+            if speed and previous is not None:
+                time.sleep(max(0, run[0][1] - previous) / speed)
+            previous = run[0][1]
+            plugin_name, args, recorded, replayed = replay_run(plugins, run, clock, speed, pymssql.OperationalError)
+            runs += 1
+            same = is_same_result(recorded, replayed)
+            if not same:
+                differed += 1
+            output.write('%s;%s;%s;%d;%s\n' % (same and 'same' or 'DIFFERENT', plugin_name, ' '.join(args),
+                                               replayed[0], replayed[1].replace('\n', '\\n')))
+            if not same and recorded is not None:
+                output.write('recorded;%s;%s;%d;%s\n' % (plugin_name, ' '.join(args), recorded[0],
+                                                         recorded[1].replace('\n', '\\n')))
+    finally:
+        time.time = real_time
+    return runs, differed, real_time() - start
+
+def parse_args():
+    usage = "usage: %prog recording [--speed N] [--state-dir directory] [--profile N]"
+    parser = OptionParser(usage=usage)
+    parser.add_option('--speed', type='float', help='Replay N times faster than recorded, 0 as fast as possible', default=0)
+    parser.add_option('--state-dir', help='Delta state directory of the replay, a new temporary one by default', default=None)
+    parser.add_option('--profile', type='int', metavar='N', help='Profile the replay and print the N functions with the most time', default=0)
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('Recording is a required argument.')
+    if options.speed < 0:
+        parser.error('Speed must not be negative.')
+    return options, args[0]
+
+def main():
+    import mssql_state
+    options, path = parse_args()
+    #~ Replayed delta modes must not see the samples of the live checks
+    state_dir = options.state_dir or tempfile.mkdtemp(prefix='mssql-replay-')
+    mssql_state.STATE_DIR = state_dir
+    try:
+        if options.profile:
+            import cProfile
+            import pstats
+            profiler = cProfile.Profile()
+            runs, differed, elapsed = profiler.runcall(replay, path, options.speed)
+            pstats.Stats(profiler, stream=sys.stderr).sort_stats('cumulative').print_stats(options.profile)
+        else:
+            runs, differed, elapsed = replay(path, options.speed)
+    finally:
+        if not options.state_dir:
+            shutil.rmtree(state_dir, True)
+    sys.stderr.write('%d check(s) replayed in %.3fs, %d with a different result.\n' % (runs, elapsed, differed))
+    if differed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        sys.exit(0)
@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+########################################################################
+# mssql_scheduler.py
+# Licence : GPL - http://www.fsf.org/licenses/gpl.txt
+#
+# Resident poller that runs counter checks of check_mssql_server.py and
+# check_mssql_database.py at an interval adapted to each check, and
+# submits them as passive check results. A check that alerts, is near
+# its warning threshold or changed a lot is polled more often (down to
+# --min-interval), one that stays flat and far from its threshold less
+# often (up to --max-interval). Checks of a host that are due within
+# --batch-window seconds of each other are answered by one counter
+# snapshot query. Hosts are polled by --workers threads, so a host that
+# is slow or down only delays its own checks.
+#
+# Checks file, one check per line:
+#   nagios_host  service_description  host[\instance|:port]  credential  server|database  plugin options...
+#   sql01  "MSSQL Page Life"  sql01  monitor  server    --pagelife -w 300: -c 100:
+#   sql02  "MSSQL Log Usage"  sql02  monitor  database  -D sales --logfileusage -w 80 -c 90
+#
+# Every --stats-interval seconds (and on exit) the number of queries
+# issued is printed to stderr next to what polling every check on its
+# own at --base-interval would have taken, with the estimated detection
+# latency of both.
+########################################################################
+
+import sys
+import time
+import shlex
+import signal
+import Queue
+import threading
+import traceback
+import pymssql
+from optparse import OptionParser
+
+import check_mssql_server
+import check_mssql_database
+from check_mssql_fleet import read_lines, read_credentials, split_host
+from mssql_snapshot import CounterSnapshot, COUNTER_QUERY_RE
+from mssql_batch import write_command, write_checkresult
+from mssql_range import parse_range
+
+PLUGINS = {
+    'server'   : check_mssql_server,
+    'database' : check_mssql_database,
+}
+
+STDOUT_PREFIX = check_mssql_server.STDOUT_PREFIX
+
+EVALUATION_ERRORS = (IndexError, KeyError, ValueError, TypeError, ZeroDivisionError)
+
+#~ Weight of the newest change in the volatility average
+ALPHA = 0.3
+#~ Relative change per poll above which a check is volatile, and below which it is flat
+VOLATILE = 0.05
+FLAT = 0.01
+#~ Relative distance to the warning threshold below which a check is near it
+NEAR = 0.1
+GROWTH = 1.5
+INFINITY = float('inf')
+
+class ScheduledCheck(object):
+
+    def __init__(self, host_name, service_description, address, plugin_name, args, interval):
+        self.host_name = host_name
+        self.service_description = service_description
+        self.address = address
+        self.plugin = PLUGINS[plugin_name]
+        try:
+            self.options = self.plugin.parse_args(args)
+        except SystemExit:
+            raise ValueError('Invalid plugin options: %s' % ' '.join(args))
+        if plugin_name == 'database' and not self.options.database:
+            raise ValueError('Database checks need -D: %s' % ' '.join(args))
+        self.query = self.make_query('').query
+        if not COUNTER_QUERY_RE.match(self.query):
+            raise ValueError('Only counter modes can be scheduled: %s' % ' '.join(args))
+        self.interval = interval
+        self.due = 0
+        self.last = None
+        self.volatility = 0.0
+        self.code = None
+
+    def make_query(self, host):
+        if self.plugin is check_mssql_database:
+            return self.plugin.make_query(self.options, host, False)
+        return self.plugin.make_query(self.options, host)
+
+    def evaluate(self, snapshot, host):
+        #~ Returns (code, stdout, value)
+        mssql_query = self.make_query(host)
+        try:
+            mssql_query.run_on_snapshot(snapshot)
+            mssql_query.calculate_result()
+            if hasattr(mssql_query, 'generate_perfdata'):
+                mssql_query.generate_perfdata()
+            stdout, code = mssql_query.get_output()
+        except EVALUATION_ERRORS, e:
+            return 3, '%s%s failed with: %s' % (STDOUT_PREFIX[3], self.options.mode, e), None
+        return code, stdout, mssql_query.result
+
+def get_proximity(nagstring, value):
+    #~ Distance of value to the nearest bound of the range, relative to that bound
+    nagrange = parse_range(nagstring)
+    if nagrange is None:
+        return None
+    distances = [abs(value - bound) / max(abs(bound), 1.0) for bound in (nagrange.start, nagrange.end)
+                 if abs(bound) != float('inf')]
+    if not distances:
+        return None
+    return min(distances)
+
+class AdaptiveScheduler(object):
+
+    def __init__(self, checks, min_interval, max_interval, base_interval, batch_window, workers=1):
+        self.checks = checks
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.base_interval = base_interval
+        self.batch_window = batch_window
+        self.connections = {}
+        #~ Guards the checks, the stats and submit(), the workers share them
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.busy = set()
+        self.tasks = Queue.Queue()
+        for i in range(workers):
+            worker = threading.Thread(target=self.work)
+            worker.setDaemon(True)
+            worker.start()
+        self.started = time.time()
+        self.polls = 0
+        self.queries = 0
+        self.changes = 0
+        self.latency = 0.0
+
+    def get_next_due(self):
+        self.lock.acquire()
+        try:
+            return min([check.due for check in self.checks])
+        finally:
+            self.lock.release()
+
+    def run_due(self, now, submit):
+        #~ Checks due soon are polled with the due ones of their host, so they share its query. A host
+        #~ still being polled is left alone, its checks are due again once that poll is done.
+        hosts = {}
+        self.lock.acquire()
+        try:
+            due = set([check.address for check in self.checks if check.due <= now])
+            for check in self.checks:
+                if check.due <= now + self.batch_window and check.address in due and check.address not in self.busy:
+                    hosts.setdefault(check.address, []).append(check)
+            for address, checks in hosts.items():
+                self.busy.add(address)
+                for check in checks:
+                    check.due = INFINITY
+        finally:
+            self.lock.release()
+        for address, checks in hosts.items():
+            self.tasks.put((address, checks, now, submit))
+
+    def work(self):
+        while True:
+            address, checks, now, submit = self.tasks.get()
+            try:
+                try:
+                    self.poll_host(address, checks, now, submit)
+                except Exception, e:
+                    #~ Whatever went wrong, the daemon and the other hosts carry on
+                    sys.stderr.write('Polling %s failed:\n%s' % (address.split(';')[0], traceback.format_exc()))
+                    self.close_connection(address)
+                    try:
+                        self.fail_host(checks, '%sCaught unexpected error: %s' % (STDOUT_PREFIX[3], e), now, submit)
+                    except Exception:
+                        sys.stderr.write(traceback.format_exc())
+            finally:
+                self.lock.acquire()
+                try:
+                    #~ No check is left unscheduled, even if reporting its failure failed too
+                    for check in checks:
+                        if check.due == INFINITY:
+                            check.due = now + check.interval
+                    self.busy.discard(address)
+                finally:
+                    self.lock.release()
+                self.wakeup.set()
+
+    def get_connection(self, address, options):
+        if address not in self.connections:
+            self.connections[address] = check_mssql_server.connect_db(options)
+        return self.connections[address]
+
+    def close_connection(self, address):
+        mssql = self.connections.pop(address, (None,))[0]
+        if mssql is not None:
+            try:
+                mssql.close()
+            except Exception:
+                pass
+
+    def poll_host(self, address, checks, now, submit):
+        try:
+            mssql, total, host = self.get_connection(address, checks[0].options)
+            snapshot = CounterSnapshot.fetch(mssql, [check.query for check in checks])
+        except (pymssql.OperationalError, pymssql.InterfaceError), e:
+            self.close_connection(address)
+            self.fail_host(checks, '%s%s' % (STDOUT_PREFIX[3], e), now, submit)
+            return
+        results = [check.evaluate(snapshot, host) for check in checks]
+        self.lock.acquire()
+        try:
+            self.queries += 1
+            for check, (code, stdout, value) in zip(checks, results):
+                submit(check, code, stdout, now)
+                self.reschedule(check, code, value, now)
+        finally:
+            self.lock.release()
+
+    def fail_host(self, checks, stdout, now, submit):
+        self.lock.acquire()
+        try:
+            for check in checks:
+                if check.due == INFINITY:
+                    self.reschedule(check, 3, None, now)
+                    submit(check, 3, stdout, now)
+        finally:
+            self.lock.release()
+
+    def reschedule(self, check, code, value, now):
+        self.polls += 1
+        if check.code is not None and code != check.code:
+            #~ The change happened at some point during the interval that just ended
+            self.changes += 1
+            self.latency += check.interval / 2.0
+        check.code = code
+        if code:
+            check.interval = self.min_interval
+        elif value is not None and check.last is not None:
+            change = abs(value - check.last) / max(abs(check.last), abs(value), 1e-9)
+            check.volatility = ALPHA * change + (1 - ALPHA) * check.volatility
+            proximity = get_proximity(check.options.warning, value)
+            if (proximity is not None and proximity < NEAR) or check.volatility > VOLATILE:
+                check.interval = max(self.min_interval, check.interval / 2.0)
+            elif check.volatility < FLAT:
+                check.interval = min(self.max_interval, check.interval * GROWTH)
+        if value is not None:
+            check.last = value
+        check.due = now + check.interval
+
+    def get_stats(self, now):
+        self.lock.acquire()
+        try:
+            return self.format_stats(now)
+        finally:
+            self.lock.release()
+
+    def format_stats(self, now):
+        elapsed = max(now - self.started, 1e-9)
+        #~ A fixed poller runs every check on its own, one query each per base interval
+        fixed_queries = len(self.checks) * max(1, int(elapsed / self.base_interval) + 1)
+        saved = 100.0 * (fixed_queries - self.queries) / fixed_queries
+        if self.changes:
+            latency = self.latency / self.changes
+        else:
+            latency = sum([check.interval for check in self.checks]) / 2.0 / len(self.checks)
+        intervals = [check.interval for check in self.checks]
+        #~ A check being polled keeps the interval it was polled at
+        return ('checks=%d polls=%d queries=%d fixed_queries=%d saved=%.1f%% state_changes=%d '
+                'detection_latency=%.1fs fixed_detection_latency=%.1fs interval_min=%.1fs interval_max=%.1fs'
+                % (len(self.checks), self.polls, self.queries, fixed_queries, saved, self.changes,
+                   latency, self.base_interval / 2.0, min(intervals), max(intervals)))
+
+    def close(self):
+        for address in self.connections.keys():
+            self.close_connection(address)
+
+def read_checks(filename, credentials, interval):
+    checks = []
+    for line in read_lines(filename):
+        fields = shlex.split(line)
+        if len(fields) < 6 or fields[4] not in PLUGINS or fields[3] not in credentials:
+            raise ValueError('Invalid checks line: %s' % line)
+        host_name, service_description, address, credential, plugin_name = fields[:5]
+        host, connection_args = split_host(address)
+        user, password = credentials[credential]
+        args = ['-H', host, '-U', user, '-P', password] + connection_args + fields[5:]
+        checks.append(ScheduledCheck(host_name, service_description, '%s;%s' % (address, credential),
+                                     plugin_name, args, interval))
+    return checks
+
+def make_submit(spool_dir, output=sys.stdout):
+    def submit(check, code, stdout, now):
+        result = { 'time'                : int(now),
+                   'host_name'           : check.host_name,
+                   'service_description' : check.service_description,
+                   'start_time'          : now,
+                   'finish_time'         : time.time(),
+                   'code'                : code,
+                   'output'              : stdout }
+        if spool_dir:
+            write_checkresult(spool_dir, result)
+        else:
+            write_command(output, result)
+            output.flush()
+    return submit
+
+def parse_args():
+    usage = "usage: %prog -f checks -C credentials [--spool-dir directory]"
+    parser = OptionParser(usage=usage)
+    parser.add_option('-f', '--checks', help='File listing the checks to schedule', default=None)
+    parser.add_option('-C', '--credentials', help='Credentials file referenced by the checks file', default=None)
+    parser.add_option('--spool-dir', help='Write the results to this Nagios check result directory instead of stdout', default=None)
+    parser.add_option('--min-interval', type='float', help='Shortest seconds between two polls of a check', default=30)
+    parser.add_option('--max-interval', type='float', help='Longest seconds between two polls of a check', default=900)
+    parser.add_option('--base-interval', type='float', help='Fixed interval the checks would otherwise run at, first interval of every check', default=300)
+    parser.add_option('--batch-window', type='float', help='Checks of a host due within this many seconds share one query', default=5)
+    parser.add_option('--workers', type='int', help='Hosts polled at the same time', default=4)
+    parser.add_option('--stats-interval', type='float', help='Seconds between two stats lines on stderr, 0 only on exit', default=300)
+    parser.add_option('--duration', type='float', help='Exit after this many seconds, 0 runs until stopped', default=0)
+    options, _ = parser.parse_args()
+    if not options.checks:
+        parser.error('Checks is a required option.')
+    if not options.credentials:
+        parser.error('Credentials is a required option.')
+    if not 0 < options.min_interval <= options.base_interval <= options.max_interval:
+        parser.error('Intervals must satisfy 0 < min <= base <= max.')
+    if options.workers < 1:
+        parser.error('Workers must be at least 1.')
+    return options
+
+def main():
+    options = parse_args()
+    checks = read_checks(options.checks, read_credentials(options.credentials), options.base_interval)
+    if not checks:
+        return
+    scheduler = AdaptiveScheduler(checks, options.min_interval, options.max_interval,
+                                  options.base_interval, options.batch_window, options.workers)
+    submit = make_submit(options.spool_dir)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    stats_due = time.time() + (options.stats_interval or float('inf'))
+    try:
+        while True:
+            now = time.time()
+            if options.duration and now - scheduler.started >= options.duration:
+                break
+            #~ Cleared before dispatching, so a poll that is done early still wakes the loop
+            scheduler.wakeup.clear()
+            scheduler.run_due(now, submit)
+            if now >= stats_due:
+                sys.stderr.write(scheduler.get_stats(now) + '\n')
+                stats_due = now + options.stats_interval
+            wakeup = min(scheduler.get_next_due(), stats_due)
+            if options.duration:
+                wakeup = min(wakeup, scheduler.started + options.duration)
+            #~ Woken early when a poll is done, its checks may be due again before anything else
+            scheduler.wakeup.wait(max(0, wakeup - time.time()))
+    finally:
+        sys.stderr.write(scheduler.get_stats(time.time()) + '\n')
+        scheduler.close()
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        sys.exit(0)
@@ -0,0 +1,176 @@
+########################################################################
+# mssql_snapshot.py
+# Shared by check_mssql_server.py and check_mssql_database.py
+# Licence : GPL - http://www.fsf.org/licenses/gpl.txt
+#
+# Reads sys.dm_os_performance_counters once and answers the plugins'
+# single counter queries (BASE_QUERY, INST_QUERY, OBJE_QUERY, DIVI_QUERY)
+# from memory, so that any number of modes cost one DMV scan.
+#
+# SnapshotCache shares a snapshot between plugin processes checking the
+# same host for a few seconds. Only one process fetches while the others
+# wait on the lock and then read its result.
+########################################################################
+
+import re
+import time
+import fcntl
+from mssql_state import make_state_path, read_cache, write_cache
+
+SNAPSHOT_QUERY = "SELECT object_name, counter_name, instance_name, cntr_value, cntr_type FROM sys.dm_os_performance_counters%s;"
+
+#~ Matches every query template used by the plugins' MODES
+COUNTER_QUERY_RE = re.compile(r"^SELECT cntr_value FROM sys\.dm_os_performance_counters "
+                              r"WHERE counter_name(?:='(?P<name>(?:[^']|'')*)'| LIKE '(?P<prefix>(?:[^']|'')*)%')"
+                              r"(?: AND instance_name='(?P<instance>(?:[^']|'')*)')?;$")
+
+def quote(value):
+    #~ For names put in a string literal of a query, a database may be called O'Brien
+    return value.replace("'", "''")
+
+def unquote(value):
+    return value.replace("''", "'")
+
+def normalize(name):
+    #~ The DMV columns are padded nchar and compared case-insensitively
+    return (name or '').strip().lower()
+
+def make_snapshot_query(queries=None):
+    #~ Restricts the scan to the counters the given queries ask for, across all instances
+    if not queries:
+        return SNAPSHOT_QUERY % ''
+    conditions = []
+    for query in queries:
+        match = COUNTER_QUERY_RE.match(query)
+        if not match:
+            raise ValueError('Query cannot be answered from a counter snapshot: %s' % query)
+        if match.group('prefix') is not None:
+            condition = "counter_name LIKE '%s%%'" % match.group('prefix')
+        else:
+            condition = "counter_name='%s'" % match.group('name')
+        if condition not in conditions:
+            conditions.append(condition)
+    return SNAPSHOT_QUERY % (' WHERE ' + ' OR '.join(conditions))
+
+class CounterSnapshot(object):
+
+    def __init__(self, rows, taken=None):
+        self.taken = taken or time.time()
+        self.rows = []
+        self.instance_names = []
+        self.counters = {}
+        self.by_name = {}
+        self.by_instance = {}
+        self.prefixes = {}
+        for row in rows:
+            object_name, counter_name, instance_name, value = row[:4]
+            cntr_type = None
+            if len(row) > 4:
+                cntr_type = row[4]
+            key = (normalize(object_name), normalize(counter_name), normalize(instance_name))
+            self.counters[key] = (value, cntr_type)
+            self.by_name.setdefault(key[1], []).append(len(self.rows))
+            self.by_instance.setdefault(key[1:], []).append(len(self.rows))
+            self.rows.append(key)
+            self.instance_names.append((instance_name or '').strip())
+
+    def fetch(cls, connection, queries=None):
+        cur = connection.cursor()
+        cur.execute(make_snapshot_query(queries))
+        return cls(cur.fetchall())
+    fetch = classmethod(fetch)
+
+    def get(self, object_name, counter_name, instance_name=''):
+        return self.counters[(normalize(object_name), normalize(counter_name), normalize(instance_name))][0]
+
+    def find(self, object_name, counter_name, instance_name=''):
+        #~ Returns (key, (value, cntr_type)). The object name may leave out the
+        #~ server prefix, 'Buffer Manager' matches 'SQLServer:Buffer Manager'.
+        object_name = normalize(object_name)
+        for index in self.by_instance.get((normalize(counter_name), normalize(instance_name)), []):
+            key = self.rows[index]
+            if key[0] == object_name or key[0].endswith(':' + object_name):
+                return key, self.counters[key]
+        raise KeyError((object_name, normalize(counter_name), normalize(instance_name)))
+
+    def instances(self, counter_name):
+        #~ Instance names of a counter as the server spells them, in server order
+        return [self.instance_names[index] for index in self.by_name.get(normalize(counter_name), [])]
+
+    def names_prefixed(self, prefix):
+        prefix = normalize(prefix)
+        if prefix not in self.prefixes:
+            self.prefixes[prefix] = [name for name in self.by_name if name.startswith(prefix)]
+        return self.prefixes[prefix]
+
+    def execute(self, query):
+        match = COUNTER_QUERY_RE.match(query)
+        if not match:
+            raise ValueError('Query cannot be answered from a counter snapshot: %s' % query)
+        if match.group('prefix') is not None:
+            names = self.names_prefixed(unquote(match.group('prefix')))
+        else:
+            names = [normalize(unquote(match.group('name')))]
+        instance = match.group('instance')
+        indexes = []
+        for name in names:
+            if instance is None:
+                indexes.extend(self.by_name.get(name, []))
+            else:
+                indexes.extend(self.by_instance.get((name, normalize(unquote(instance))), []))
+        #~ Rows come back in the order the server returned them, as the query would
+        if len(names) > 1:
+            indexes.sort()
+        return [(self.counters[self.rows[index]][0],) for index in indexes]
+
+class SnapshotCache(object):
+
+    #~ Snapshots already read by this process, keyed by cache path
+    loaded = {}
+
+    def __init__(self, host, ttl):
+        self.ttl = ttl
+        self.path = make_state_path(host, 'mssql-snapshot', 'cache')
+        self.lockpath = self.path + '.lock'
+
+    def is_fresh(self, snapshot):
+        return snapshot is not None and 0 <= time.time() - snapshot.taken < self.ttl
+
+    def read(self):
+        snapshot = self.loaded.get(self.path)
+        if self.is_fresh(snapshot):
+            return snapshot
+        cached = read_cache(self.path)
+        if cached is None:
+            return None
+        taken, rows = cached
+        snapshot = CounterSnapshot(rows, taken)
+        if not self.is_fresh(snapshot):
+            return None
+        self.loaded[self.path] = snapshot
+        return snapshot
+
+    def get(self, connection):
+        snapshot = self.read()
+        if snapshot is not None:
+            return snapshot
+        lockfile = open(self.lockpath, 'a')
+        try:
+            fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX)
+            #~ Another process may have fetched while this one waited for the lock
+            snapshot = self.read()
+            if snapshot is None:
+                cur = connection.cursor()
+                cur.execute(make_snapshot_query())
+                taken, rows = time.time(), [tuple(row) for row in cur.fetchall()]
+                write_cache(self.path, (taken, rows))
+                snapshot = CounterSnapshot(rows, taken)
+                self.loaded[self.path] = snapshot
+        finally:
+            lockfile.close()
+        return snapshot
+
+def get_cached_snapshot(connection, host, ttl):
+    if not ttl:
+        return None
+    return SnapshotCache(host, ttl).get(connection)
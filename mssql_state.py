@@ -0,0 +1,113 @@
+########################################################################
+# mssql_state.py
+# Shared by check_mssql_server.py and check_mssql_database.py
+# Licence : GPL - http://www.fsf.org/licenses/gpl.txt
+#
+# Delta state for a host is kept in one SQLite database in WAL mode,
+# keyed by the query text. Reading the previous sample and writing the
+# new one happen in a single write transaction, so concurrent checks
+# never see a half written sample.
+#
+# Shared caches (counter snapshot, database catalog) are JSON files only
+# read back when the running user owns them, the temp dir is shared.
+########################################################################
+
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+STATE_DIR = tempfile.gettempdir()
+BUSY_TIMEOUT = 30
+
+SCHEMA = """CREATE TABLE IF NOT EXISTS delta_state (
+                key     TEXT PRIMARY KEY,
+                time    REAL NOT NULL,
+                value   NUMERIC NOT NULL
+            );"""
+
+_local = threading.local()
+
+def make_state_path(host, prefix='mssql-state', suffix='db'):
+    return '%s/%s-%s.%s' % (STATE_DIR, prefix, re.sub(r'[^A-Za-z0-9.-]', '_', host), suffix)
+
+def read_cache(path):
+    #~ Returns None when missing, damaged or planted by another user
+    try:
+        cachefile = open(path, 'rb')
+    except IOError:
+        return None
+    try:
+        if os.fstat(cachefile.fileno()).st_uid != os.getuid():
+            return None
+        try:
+            return json.load(cachefile)
+        except ValueError:
+            return None
+    finally:
+        cachefile.close()
+
+def write_cache(path, data):
+    #~ Written aside (mkstemp creates it 0600) and renamed so readers never see a partial file
+    fd, tmpname = tempfile.mkstemp(prefix=os.path.basename(path), dir=os.path.dirname(path))
+    tmpfile = os.fdopen(fd, 'wb')
+    try:
+        json.dump(data, tmpfile)
+    finally:
+        tmpfile.close()
+    os.rename(tmpname, path)
+
+def to_number(value):
+    #~ Binary samples (--waitstats snapshots) are stored as they are
+    if isinstance(value, (int, long, buffer)):
+        return value
+    return float(value)
+
+class DeltaStateStore(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL;')
+        self.connection.execute('PRAGMA synchronous=NORMAL;')
+        self.connection.execute(SCHEMA)
+
+    def for_host(cls, host):
+        #~ sqlite3 connections cannot be shared between threads, so cache one per thread
+        stores = getattr(_local, 'stores', None)
+        if stores is None:
+            stores = _local.stores = {}
+        path = make_state_path(host)
+        if path not in stores:
+            stores[path] = cls(path)
+        return stores[path]
+    for_host = classmethod(for_host)
+
+    def swap(self, key, time, value):
+        return self.swap_many([(key, time, value)])[0]
+
+    def swap_many(self, samples):
+        #~ Returns the previous (time, value) for every key, or None, and stores the new samples.
+        #~ A sample no newer than the stored one (e.g. from a cached snapshot) is not stored.
+        previous = []
+        cur = self.connection.cursor()
+        cur.execute('BEGIN IMMEDIATE;')
+        try:
+            for key, time, value in samples:
+                cur.execute('SELECT time, value FROM delta_state WHERE key=?;', (key,))
+                row = cur.fetchone()
+                previous.append(row)
+                if row is not None and time <= row[0]:
+                    continue
+                cur.execute('INSERT OR REPLACE INTO delta_state (key, time, value) VALUES (?, ?, ?);',
+                            (key, time, to_number(value)))
+        except:
+            cur.execute('ROLLBACK;')
+            raise
+        cur.execute('COMMIT;')
+        return previous
@@ -0,0 +1,101 @@
+########################################################################
+# mssql_timing.py
+# Shared by check_mssql_server.py and check_mssql_database.py
+# Licence : GPL - http://www.fsf.org/licenses/gpl.txt
+#
+# Times the phases of a check: connect (login), query (DMV reads),
+# state (delta state store) and output (building the Nagios result).
+# The totals can be appended to the perfdata (--timing) and written as
+# JSON lines to a trace file (--trace), per database on the all
+# database path.
+########################################################################
+
+import time
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+PHASES = ['connect', 'query', 'state', 'output']
+
+class PhaseTimer(object):
+
+    def __init__(self):
+        self.phases = {}
+        self.children = {}
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def call(self, phase, func, *args, **kwargs):
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.add(phase, time.time() - start)
+
+    def child(self, name):
+        #~ Children are only created and filled by the thread that owns them
+        timer = PhaseTimer()
+        self.children[name] = timer
+        return timer
+
+    def totals(self):
+        totals = dict(self.phases)
+        for child in self.children.values():
+            for phase, seconds in child.totals().items():
+                totals[phase] = totals.get(phase, 0.0) + seconds
+        return totals
+
+    def perfdata(self):
+        totals = self.totals()
+        return ' '.join(["'time_%s'=%.6fs;;;;" % (phase, totals[phase]) for phase in PHASES if phase in totals])
+
+    def records(self, **fields):
+        record = dict(fields, phases=self.totals())
+        yield record
+        for name in sorted(self.children.keys()):
+            yield dict(fields, database=name, phases=self.children[name].totals())
+
+class NullTimer(object):
+
+    def add(self, phase, seconds):
+        pass
+
+    def call(self, phase, func, *args, **kwargs):
+        return func(*args, **kwargs)
+
+    def child(self, name):
+        return self
+
+def make_timer(options):
+    if options.timing or options.trace:
+        return PhaseTimer()
+    return NullTimer()
+
+def add_perfdata(stdout, perfdata):
+    lines = stdout.split('\n', 1)
+    if '|' in lines[0]:
+        lines[0] = '%s %s' % (lines[0], perfdata)
+    else:
+        lines[0] = '%s|%s' % (lines[0], perfdata)
+    return '\n'.join(lines)
+
+def write_trace(path, records):
+    tracefile = open(path, 'a')
+    try:
+        for record in records:
+            tracefile.write(json.dumps(record, sort_keys=True) + '\n')
+    finally:
+        tracefile.close()
+
+def report_timing(options, plugin, host, result):
+    #~ Adds the timings to a NagiosReturn before it is printed
+    timer = options.timer
+    if not isinstance(timer, PhaseTimer):
+        return
+    if options.trace:
+        write_trace(options.trace, timer.records(time=time.time(), plugin=plugin, host=host,
+                                                 mode=options.mode, code=result.code))
+    if options.timing and not getattr(options, 'no_perfdata', False):
+        result.message = add_perfdata(result.message, timer.perfdata())
@@ -0,0 +1,170 @@
+########################################################################
+# mssql_waits.py
+# Used by check_mssql_server.py
+# Licence : GPL - http://www.fsf.org/licenses/gpl.txt
+#
+# Wait statistics for --waitstats. A snapshot of sys.dm_os_wait_stats is
+# kept in the delta state store as one zlib compressed blob (names and
+# three columns of doubles) and diffed against the previous snapshot
+# column by column. Benign waits (idle threads, background tasks) are
+# left out through a set built once, and the rest are grouped in
+# categories that thresholds can be put on.
+########################################################################
+
+import zlib
+import struct
+from array import array
+from operator import sub
+
+WAITSTATS_QUERY = "SELECT wait_type, waiting_tasks_count, wait_time_ms, signal_wait_time_ms FROM sys.dm_os_wait_stats;"
+
+BENIGN_WAITS = frozenset([
+    'BROKER_EVENTHANDLER', 'BROKER_RECEIVE_WAITFOR', 'BROKER_TASK_STOP', 'BROKER_TO_FLUSH',
+    'BROKER_TRANSMITTER', 'CHECKPOINT_QUEUE', 'CHKPT', 'CLR_AUTO_EVENT', 'CLR_MANUAL_EVENT',
+    'CLR_SEMAPHORE', 'DBMIRROR_DBM_EVENT', 'DBMIRROR_EVENTS_QUEUE', 'DBMIRROR_WORKER_QUEUE',
+    'DBMIRRORING_CMD', 'DIRTY_PAGE_POLL', 'DISPATCHER_QUEUE_SEMAPHORE', 'EXECSYNC', 'FSAGENT',
+    'FT_IFTS_SCHEDULER_IDLE_WAIT', 'FT_IFTSHC_MUTEX', 'HADR_CLUSAPI_CALL',
+    'HADR_FILESTREAM_IOMGR_IOCOMPLETION', 'HADR_LOGCAPTURE_WAIT', 'HADR_NOTIFICATION_DEQUEUE',
+    'HADR_TIMER_TASK', 'HADR_WORK_QUEUE', 'KSOURCE_WAKEUP', 'LAZYWRITER_SLEEP', 'LOGMGR_QUEUE',
+    'MEMORY_ALLOCATION_EXT', 'ONDEMAND_TASK_QUEUE', 'PARALLEL_REDO_DRAIN_WORKER',
+    'PARALLEL_REDO_LOG_CACHE', 'PARALLEL_REDO_TRAN_LIST', 'PARALLEL_REDO_WORKER_SYNC',
+    'PARALLEL_REDO_WORKER_WAIT_WORK', 'PREEMPTIVE_XE_GETTARGETSTATE', 'PWAIT_ALL_COMPONENTS_INITIALIZED',
+    'PWAIT_DIRECTLOGCONSUMER_GETNEXT', 'QDS_PERSIST_TASK_MAIN_LOOP_SLEEP', 'QDS_ASYNC_QUEUE',
+    'QDS_CLEANUP_STALE_QUERIES_TASK_MAIN_LOOP_SLEEP', 'QDS_SHUTDOWN_QUEUE', 'REDO_THREAD_PENDING_WORK',
+    'REQUEST_FOR_DEADLOCK_SEARCH', 'RESOURCE_QUEUE', 'SERVER_IDLE_CHECK', 'SLEEP_BPOOL_FLUSH',
+    'SLEEP_DBSTARTUP', 'SLEEP_DCOMSTARTUP', 'SLEEP_MASTERDBREADY', 'SLEEP_MASTERMDREADY',
+    'SLEEP_MASTERUPGRADED', 'SLEEP_MSDBSTARTUP', 'SLEEP_SYSTEMTASK', 'SLEEP_TASK',
+    'SLEEP_TEMPDBSTARTUP', 'SNI_HTTP_ACCEPT', 'SOS_WORK_DISPATCHER', 'SP_SERVER_DIAGNOSTICS_SLEEP',
+    'SQLTRACE_BUFFER_FLUSH', 'SQLTRACE_INCREMENTAL_FLUSH_SLEEP', 'SQLTRACE_WAIT_ENTRIES',
+    'WAIT_FOR_RESULTS', 'WAITFOR', 'WAITFOR_TASKSHUTDOWN', 'WAIT_XTP_RECOVERY',
+    'WAIT_XTP_HOST_WAIT', 'WAIT_XTP_OFFLINE_CKPT_NEW_LOG', 'WAIT_XTP_CKPT_CLOSE',
+    'XE_DISPATCHER_JOIN', 'XE_DISPATCHER_WAIT', 'XE_TIMER_EVENT',
+])
+
+#~ First matching prefix wins, anything else is 'other'
+CATEGORIES = [
+    ('lock',         ['LCK_M_']),
+    ('buffer_io',    ['PAGEIOLATCH_']),
+    ('buffer_latch', ['PAGELATCH_']),
+    ('latch',        ['LATCH_']),
+    ('log_io',       ['WRITELOG', 'LOGBUFFER', 'LOG_RATE_GOVERNOR']),
+    ('network_io',   ['ASYNC_NETWORK_IO', 'NET_WAITFOR_PACKET']),
+    ('cpu',          ['SOS_SCHEDULER_YIELD', 'THREADPOOL']),
+    ('parallelism',  ['CXPACKET', 'CXCONSUMER', 'EXCHANGE']),
+    ('memory',       ['RESOURCE_SEMAPHORE', 'CMEMTHREAD']),
+    ('io',           ['IO_COMPLETION', 'ASYNC_IO_COMPLETION', 'BACKUPIO']),
+]
+
+CATEGORY_NAMES = [name for name, prefixes in CATEGORIES] + ['other']
+
+HEADER = struct.Struct('<I')
+
+_categories = {}
+
+def get_category(wait_type):
+    if wait_type not in _categories:
+        _categories[wait_type] = 'other'
+        for name, prefixes in CATEGORIES:
+            if [prefix for prefix in prefixes if wait_type.startswith(prefix)]:
+                _categories[wait_type] = name
+                break
+    return _categories[wait_type]
+
+class WaitStats(object):
+
+    def __init__(self, names, tasks, wait_ms, signal_ms):
+        self.names = names
+        self.tasks = tasks
+        self.wait_ms = wait_ms
+        self.signal_ms = signal_ms
+
+    def from_rows(cls, rows):
+        #~ Benign waits are dropped here, so they are neither stored nor diffed
+        names, tasks, wait_ms, signal_ms = [], array('d'), array('d'), array('d')
+        for wait_type, waiting_tasks, wait_time, signal_wait_time in rows:
+            wait_type = wait_type.strip()
+            if wait_type in BENIGN_WAITS:
+                continue
+            names.append(wait_type)
+            tasks.append(waiting_tasks)
+            wait_ms.append(wait_time)
+            signal_ms.append(signal_wait_time)
+        return cls(names, tasks, wait_ms, signal_ms)
+    from_rows = classmethod(from_rows)
+
+    def pack(self):
+        names = '\n'.join(self.names)
+        return zlib.compress(HEADER.pack(len(names)) + names + self.tasks.tostring() +
+                             self.wait_ms.tostring() + self.signal_ms.tostring())
+
+    def unpack(cls, data):
+        data = zlib.decompress(str(data))
+        length = HEADER.unpack(data[:HEADER.size])[0]
+        offset = HEADER.size + length
+        names = data[HEADER.size:offset].split('\n')
+        size = len(names) * array('d').itemsize
+        columns = []
+        for i in range(3):
+            column = array('d')
+            column.fromstring(data[offset + i * size:offset + (i + 1) * size])
+            columns.append(column)
+        return cls(names, *columns)
+    unpack = classmethod(unpack)
+
+    def align(self, previous):
+        #~ The DMV returns its rows in the same order every time, so this is nearly always a no-op
+        if previous.names == self.names:
+            return previous
+        #~ A wait missing from previous takes its current totals, they were counted since startup,
+        #~ not in the interval, so it shows no waits until the next run
+        index = dict(zip(previous.names, range(len(previous.names))))
+        columns = [array('d'), array('d'), array('d')]
+        for j, name in enumerate(self.names):
+            i = index.get(name)
+            for column, old, new in zip(columns, (previous.tasks, previous.wait_ms, previous.signal_ms),
+                                        (self.tasks, self.wait_ms, self.signal_ms)):
+                if i is None:
+                    column.append(new[j])
+                else:
+                    column.append(old[i])
+        return WaitStats(self.names, *columns)
+
+    def diff(self, previous, seconds):
+        #~ Waits per second since previous as WaitDiff, None when the statistics were cleared
+        previous = self.align(previous)
+        tasks = map(sub, self.tasks, previous.tasks)
+        wait_ms = map(sub, self.wait_ms, previous.wait_ms)
+        signal_ms = map(sub, self.signal_ms, previous.signal_ms)
+        if wait_ms and min(wait_ms) < 0:
+            return None
+        return WaitDiff(self.names, [x / seconds for x in tasks], [x / seconds for x in wait_ms],
+                        [x / seconds for x in signal_ms])
+
+class WaitDiff(object):
+
+    def __init__(self, names, tasks, wait_ms, signal_ms):
+        self.names = names
+        self.tasks = tasks
+        self.wait_ms = wait_ms
+        self.signal_ms = signal_ms
+
+    def total(self, categories=None):
+        if not categories:
+            return sum(self.wait_ms)
+        return sum([wait for name, wait in zip(self.names, self.wait_ms) if get_category(name) in categories])
+
+    def signal_ratio(self):
+        total = sum(self.wait_ms)
+        if not total:
+            return 0.0
+        return sum(self.signal_ms) / total * 100
+
+    def by_category(self):
+        totals = dict([(name, 0.0) for name in CATEGORY_NAMES])
+        for name, wait in zip(self.names, self.wait_ms):
+            totals[get_category(name)] += wait
+        return totals
+
+    def top(self, count):
+        ranked = sorted(zip(self.wait_ms, self.names), reverse=True)[:count]
+        return [(name, wait) for wait, name in ranked if wait > 0]
@@ -0,0 +1,57 @@
+########################################################################
+# test_mssql_replay.py
+# Licence : GPL - http://www.fsf.org/licenses/gpl.txt
+#
+# The password never reaches a recording, in whatever form optparse
+# accepts it. Runs against the fake pymssql in bench/fake:
+#
+#   python -m unittest test_mssql_replay
+########################################################################
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench', 'fake'))
+
+import check_mssql_server
+import check_mssql_database
+
+BASE_ARGS = ['-H', 'rec1', '-U', 'u', '--record', '/dev/null']
+
+class MaskArgsTest(unittest.TestCase):
+
+    def get_recorded_args(self, plugin, args):
+        options = plugin.parse_args(args)
+        return options.recorder.records[0][3]
+
+    def assert_masked(self, password_args, plugin=check_mssql_server, mode='--batchreq'):
+        recorded = self.get_recorded_args(plugin, BASE_ARGS + [mode] + password_args)
+        self.assertFalse([arg for arg in recorded if 'secret' in arg], recorded)
+        self.assertEqual(recorded[recorded.index('--password') + 1], 'x')
+        self.assertFalse('--record' in recorded)
+        #~ What was recorded is what replay passes to the plugin
+        self.assertEqual(plugin.parse_args(recorded).password, 'x')
+
+    def test_separate_value(self):
+        self.assert_masked(['-P', 'secret'])
+        self.assert_masked(['--password', 'secret'])
+
+    def test_attached_value(self):
+        self.assert_masked(['-Psecret'])
+        self.assert_masked(['--password=secret'])
+
+    def test_abbreviated_long_option(self):
+        self.assert_masked(['--pass=secret'])
+        self.assert_masked(['--passw', 'secret'])
+
+    def test_database_plugin(self):
+        self.assert_masked(['-D', 'sales', '-Psecret'], check_mssql_database, '--logfileusage')
+
+    def test_other_options_kept(self):
+        recorded = self.get_recorded_args(check_mssql_server, BASE_ARGS + ['--batchreq', '-Psecret', '-w10', '--crit=20'])
+        self.assertEqual(recorded, ['--hostname', 'rec1', '--user', 'u', '--batchreq', '--password', 'x',
+                                    '--warning', '10', '--critical', '20'])
+
+if __name__ == '__main__':
+    unittest.main()